@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Benchmark building a master array from many cases.
+
+Compares the graph size and build time of `convert._stack_dims` against
+the previous implementation, which recursed over each case dimension and
+nested one `dask.array.stack` per interior node.
+
+    $ python benchmarks/bench_master.py
+
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+import dask.array as da
+import xarray as xr
+
+# Run against this checkout, even if the package isn't installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from experiment import Experiment, Case
+from experiment.convert import _case_layout, _master_dataarray
+
+LEAF_SHAPE = (12, 4, 4)
+
+
+def _recursive_stack(data, cases, set_cases, exp):
+    """ The previous, recursive implementation of `_stack_dims`. """
+    idx = len(set_cases)
+    if idx >= len(cases):
+        return data[exp.case_tuple(**set_cases)].data
+    new_set_cases = set_cases.copy()
+    case = cases[idx]
+    to_stack = []
+    for val in case.vals:
+        new_set_cases[case.shortname] = val
+        to_stack.append(_recursive_stack(data, cases, new_set_cases, exp))
+    return da.stack(to_stack)
+
+
+def _make_experiment(n_per_case, n_dims):
+    cases = [Case("c{}".format(i), "Case {}".format(i),
+                  ["v{}".format(j) for j in range(n_per_case)])
+             for i in range(n_dims)]
+    exp = Experiment("bench", cases, case_path="", validate_data=False)
+
+    leaf = xr.DataArray(da.zeros(LEAF_SHAPE, chunks=LEAF_SHAPE),
+                        dims=['time', 'y', 'x'], name='TS')
+    data = {exp.case_tuple(*case): leaf for case in exp.all_cases()}
+    return exp, data
+
+
+def main():
+    print("{:>8s} {:>14s} {:>8s} {:>8s} {:>14s} {:>8s} {:>8s}".format(
+        "cases", "recursive [s]", "tasks", "layers",
+        "vectorized [s]", "tasks", "layers"
+    ))
+    # (values per case, number of cases) -> 10^2, 10^3, 10^4 cases
+    for n_per_case, n_dims in [(10, 2), (10, 3), (10, 4)]:
+        exp, data = _make_experiment(n_per_case, n_dims)
+        case_list = [exp._case_data[case] for case in exp.cases]
+
+        t_old = min(timeit.repeat(
+            lambda: _recursive_stack(data, case_list, {}, exp),
+            number=1, repeat=3
+        ))
+        old = _recursive_stack(data, case_list, {}, exp)
+
+        def _vectorized():
+            layout = _case_layout(exp, 'dense')
+            proto = data[layout.cases[0]]
+            return _master_dataarray(layout, data, proto)
+
+        t_new = min(timeit.repeat(_vectorized, number=1, repeat=3))
+        new = _vectorized().data
+
+        old_graph, new_graph = old.__dask_graph__(), new.__dask_graph__()
+        print("{:8d} {:14.4f} {:8d} {:8d} {:14.4f} {:8d} {:8d}".format(
+            n_per_case**n_dims,
+            t_old, len(old_graph), len(old_graph.layers),
+            t_new, len(new_graph), len(new_graph.layers)
+        ))
+
+
+if __name__ == "__main__":
+    main()
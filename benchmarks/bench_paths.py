@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Benchmark resolving file paths for a large Experiment.
+
+Compares `Experiment.get_file_fieldcases` against the previous
+implementation, which formatted the path of every case via `walk_files`
+and filtered them by comparing case dictionaries, and enumerating every
+file for several fields with the compiled templates against formatting
+each part of each path by keyword.
+
+    $ python benchmarks/bench_paths.py
+
+"""
+from __future__ import print_function
+
+import os
+import random
+import sys
+import timeit
+
+# Run against this checkout, even if the package isn't installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from experiment import Experiment, Case
+
+FIELDS = ["TS", "PS", "PRECT", "CLDTOT"]
+
+
+def _linear_fieldcases(exp, field, **case_kws):
+    """ The previous, linear-scan implementation of
+    `get_file_fieldcases`. """
+    return [fn for case, fn in exp.walk_files(field) if case_kws == case]
+
+
+def _keyword_files(exp, fields):
+    """ The previous way of enumerating files: build a dictionary of case
+    keywords and format each part of the path for every case. """
+    paths = {}
+    for field in fields:
+        paths[field] = []
+        for case_bits in exp.all_cases():
+            case_kws = exp.get_case_kws(*case_bits)
+            paths[field].append(os.path.join(
+                exp.data_dir,
+                exp._case_path.format(**case_kws),
+                exp.output_prefix.format(**case_kws) + field +
+                exp.output_suffix.format(**case_kws)
+            ))
+    return paths
+
+
+def _make_experiment():
+    # 10 x 10 x 10 x 10 = 10^4 cases
+    cases = [Case("c{}".format(i), "Case {}".format(i),
+                  ["v{}".format(j) for j in range(10)])
+             for i in range(4)]
+    return Experiment(
+        "bench", cases, data_dir="/path/to/data",
+        case_path="{c0}/{c1}", output_prefix="{c0}.{c1}.{c2}.{c3}.",
+        output_suffix=".nc", validate_data=False
+    )
+
+
+def _rate(func, lookups, repeat=3):
+    """ Return the best rate of lookups per second. """
+    def _run():
+        for field, case_kws in lookups:
+            func(field, **case_kws)
+    best = min(timeit.repeat(_run, number=1, repeat=repeat))
+    return len(lookups) / best
+
+
+def main():
+    exp = _make_experiment()
+    rs = random.Random(0)
+    all_cases = list(exp.all_cases())
+
+    def _lookups(n):
+        return [(rs.choice(FIELDS), exp.get_case_kws(*rs.choice(all_cases)))
+                for _ in range(n)]
+
+    linear = _rate(lambda field, **kws: _linear_fieldcases(exp, field, **kws),
+                   _lookups(20), repeat=1)
+    # Cold: every lookup is for a path that hasn't been resolved yet
+    exp._path_cache.clear()
+    cold_lookups = [(field, exp.get_case_kws(*case))
+                    for field in FIELDS[:1] for case in all_cases]
+    cold = _rate(exp.get_file_fieldcases, cold_lookups, repeat=1)
+    # Warm: paths are served from the memoized cache
+    warm = _rate(exp.get_file_fieldcases, _lookups(10**5))
+
+    print("{} cases".format(len(all_cases)))
+    print("{:>24s} {:>16s}".format("", "lookups/sec"))
+    print("{:>24s} {:16.1f}".format("linear scan", linear))
+    print("{:>24s} {:16.1f}".format("indexed (cold cache)", cold))
+    print("{:>24s} {:16.1f}".format("indexed (warm cache)", warm))
+
+    t_keyword = min(timeit.repeat(lambda: _keyword_files(exp, FIELDS),
+                                  number=1, repeat=3))
+    t_compiled = min(timeit.repeat(lambda: exp.get_files(FIELDS),
+                                   number=1, repeat=3))
+    assert _keyword_files(exp, FIELDS) == dict(exp.get_files(FIELDS))
+
+    n_files = len(FIELDS) * len(all_cases)
+    print()
+    print("{:>24s} {:>16s}".format("", "files/sec"))
+    print("{:>24s} {:16.1f}".format("keyword formatting",
+                                    n_files / t_keyword))
+    print("{:>24s} {:16.1f}".format("compiled templates",
+                                    n_files / t_compiled))
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,7 @@ logging.getLogger(__name__).addHandler(NullHandler())
 logger = logging.getLogger(__name__)
 
 from . experiment import Experiment, Case
+from . loading import CaseLoadError
 from . var import Var, VarList
 
 from . version import  __version__
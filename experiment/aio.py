@@ -0,0 +1,210 @@
+"""
+Asyncio interface for loading Experiment data.
+
+Opening files and pre-processing datasets are blocking operations, so here
+they're handed off to an executor while the event loop gets on with other
+work. A semaphore caps how many cases may be open at once, and results are
+streamed back in the order in which they finish loading.
+
+These are usually accessed through `Experiment.aload` and
+`Experiment.aiter_load`.
+
+"""
+import asyncio
+
+from collections import OrderedDict
+from functools import partial
+
+from . import logger
+from . cache import _close
+from . loading import (CaseLoadError, _load_case, _loader_kws, case_sources,
+                       finish_load, shared_state)
+from . parallel import SerialExecutor, get_executor
+
+#: Hack for Py2/3 basestring type compatibility
+if 'basestring' not in globals():
+    basestring = str
+
+
+def _check_options(errors, max_open, executor):
+    if errors not in ('warn', 'raise'):
+        raise ValueError("`errors` must be one of 'warn' or 'raise'")
+    if max_open < 1:
+        raise ValueError("`max_open` must be at least 1")
+    if (executor is None) or isinstance(executor, SerialExecutor):
+        # Running serially would block the event loop
+        executor = "threads"
+    return executor
+
+
+def _close_late(future):
+    """ Close the dataset from a load which finished after nobody was
+    waiting for it any more. """
+    if not future.cancelled() and (future.exception() is None):
+        _close(future.result())
+
+
+async def _load_cases(exp, var, fix_times, preprocess, load_kws, pool,
+                      max_open, hold, datasets=None, cache=None, time=None):
+    """ Load every case of a variable on `pool`, yielding (case, dataset,
+    error) as each finishes. At most `max_open` cases are loaded at once;
+    with `hold`, a case also keeps its slot until the caller resumes this
+    generator, so that `max_open` bounds the number of datasets open. Files
+    are opened through the DatasetPool `datasets`, and results memoized in
+    the LoadCache `cache`, if given. With several files per case, only
+    those overlapping the window of `time` are opened. """
+    loop = asyncio.get_running_loop()
+    field = var if isinstance(var, basestring) else var.varname
+    loader, case_files, exists = case_sources(exp, field, time, fix_times)
+    # Discovering files may touch the filesystem, too
+    case_files = await loop.run_in_executor(None, list, case_files)
+
+    sem = asyncio.Semaphore(max_open)
+
+    async def _load_one(case_kws, filename):
+        case = exp.case_tuple(**case_kws)
+        if (exists is not None) and not exists(filename):
+            return case, None, IOError("No files catalogued for %r" %
+                                       (case, ))
+        await sem.acquire()
+        future = pool.submit(_load_case, loader, field, filename, fix_times,
+                             preprocess, load_kws, case_kws, datasets, cache)
+        try:
+            ds = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # A load which has already started can't be interrupted, so
+            # close its dataset whenever it does finish
+            future.add_done_callback(_close_late)
+            raise
+        except Exception as e:
+            sem.release()
+            return case, None, e
+        if not hold:
+            sem.release()
+        return case, ds, None
+
+    tasks = [asyncio.ensure_future(_load_one(case_kws, filename))
+             for case_kws, filename in case_files]
+    consumed = set()
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            case, ds, error = await next_done
+            consumed.add(case)
+            try:
+                yield case, ds, error
+            finally:
+                if hold and (error is None):
+                    sem.release()
+    finally:
+        # If we stopped early, cancel any cases which haven't started
+        # loading and close whatever had already been loaded but never
+        # handed over
+        for task in tasks:
+            task.cancel()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, tuple) and \
+                    (result[0] not in consumed) and (result[2] is None):
+                _close(result[1])
+
+
+async def aload(exp, var, fix_times=False, master=False, preprocess=None,
+                load_kws={}, executor=None, max_workers=None, max_open=8,
+                errors='warn', chunks=None, time=None, isel=None, sel=None,
+                **case_kws):
+    """ Load a variable from an Experiment without blocking the event loop.
+
+    This accepts the same arguments as `Experiment.load` (which it
+    mirrors), plus `max_open`, the maximum number of cases to open at
+    once. File opens and any `preprocess` calls run on `executor` - a
+    thread pool by default - and the returned data is in case order, as
+    with `load`.
+
+    """
+    executor = _check_options(errors, max_open, executor)
+    if case_kws and not exp._is_single_case(case_kws):
+        # Load just the matching cases, as usual
+        exp = exp.subset(**case_kws)
+        case_kws = {}
+    pool, owned = get_executor(executor, max_workers)
+    loop = asyncio.get_running_loop()
+    try:
+        if case_kws:
+            # Load/return a single case
+            return await loop.run_in_executor(pool, partial(
+                exp.load, var, fix_times=fix_times, preprocess=preprocess,
+                load_kws=load_kws, chunks=chunks, time=time, isel=isel,
+                sel=sel, **case_kws
+            ))
+
+        load_kws = _loader_kws(load_kws, chunks, time, isel, sel)
+        loaded, failures = {}, OrderedDict()
+        datasets, cache = shared_state(exp, pool)
+        cases = _load_cases(exp, var, fix_times, preprocess, load_kws, pool,
+                            max_open, hold=False, datasets=datasets,
+                            cache=cache, time=time)
+        try:
+            async for case, ds, error in cases:
+                if error is None:
+                    loaded[case] = ds
+                else:
+                    logger.warning("Could not load case %r (%s)" %
+                                   (case, error))
+                    failures[case] = error
+        except BaseException:
+            # e.g. if we're cancelled, nobody else will close these
+            for ds in loaded.values():
+                _close(ds)
+            raise
+        finally:
+            await cases.aclose()
+
+        # Return the cases in order, regardless of completion order
+        data = OrderedDict()
+        for case in exp.all_cases():
+            case = exp.case_tuple(*case)
+            if case in loaded:
+                data[case] = loaded[case]
+        field = var if isinstance(var, basestring) else var.varname
+        return await loop.run_in_executor(None, partial(
+            finish_load, exp, var, field, data, failures, master, errors,
+            load_kws
+        ))
+    finally:
+        if owned:
+            pool.shutdown(wait=False)
+
+
+async def aiter_load(exp, var, fix_times=False, preprocess=None, load_kws={},
+                     executor=None, max_workers=None, max_open=4,
+                     errors='warn', chunks=None, time=None, isel=None,
+                     sel=None):
+    """ Asynchronously iterate over the cases of a variable, as they
+    finish loading.
+
+    Yields (case_tuple, dataset) pairs in completion order. At most
+    `max_open` cases are open at once - including the one being consumed
+    - and each is closed as soon as the next is requested. The remaining
+    arguments are as in `Experiment.iter_load`.
+
+    """
+    executor = _check_options(errors, max_open, executor)
+    load_kws = _loader_kws(load_kws, chunks, time, isel, sel)
+    pool, owned = get_executor(executor, max_workers)
+    _, cache = shared_state(exp, pool)
+    cases = _load_cases(exp, var, fix_times, preprocess, load_kws, pool,
+                        max_open, hold=True, cache=cache, time=time)
+    try:
+        async for case, ds, error in cases:
+            if error is not None:
+                if errors == 'raise':
+                    raise CaseLoadError(OrderedDict([(case, error)]))
+                logger.warning("Could not load case %r (%s)" % (case, error))
+                continue
+            try:
+                yield case, ds
+            finally:
+                _close(ds)
+    finally:
+        await cases.aclose()
+        if owned:
+            pool.shutdown(wait=False)
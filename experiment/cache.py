@@ -0,0 +1,189 @@
+"""
+Small caching utilities shared across the package.
+
+"""
+import os
+
+from collections import OrderedDict
+from threading import RLock
+
+
+class LRUCache(object):
+    """ A thread-safe mapping which holds at most `maxsize` items,
+    discarding the least-recently used ones when full.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of items to hold or, if `sizeof` is given, their
+        maximum total size
+    on_evict : function (optional)
+        Called with each (key, value) pair as it's discarded
+    sizeof : function (optional)
+        Returns the size of a value; by default, each counts as 1
+
+    """
+
+    def __init__(self, maxsize, on_evict=None, sizeof=None):
+        if maxsize < 1:
+            raise ValueError("`maxsize` must be positive")
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.sizeof = sizeof
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._total = 0
+        self._lock = RLock()
+
+    @property
+    def total(self):
+        """ The total size of the cached values. """
+        return self._total
+
+    def _discard(self, key):
+        value = self._data.pop(key)
+        self._total -= self._sizes.pop(key)
+        return value
+
+    def get(self, key, default=None):
+        """ Return the value for `key` (marking it as recently used), or
+        `default` if it isn't cached. """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        """ Cache `value` under `key`, evicting old items if necessary.
+        Values larger than the whole cache are discarded immediately. """
+        size = 1 if self.sizeof is None else self.sizeof(value)
+        evicted = []
+        with self._lock:
+            if key in self._data:
+                self._discard(key)
+            self._data[key] = value
+            self._sizes[key] = size
+            self._total += size
+            while self._total > self.maxsize:
+                old_key = next(iter(self._data))
+                evicted.append((old_key, self._discard(old_key)))
+        if self.on_evict is not None:
+            for old_key, old_value in evicted:
+                self.on_evict(old_key, old_value)
+
+    def pop(self, key, default=None):
+        """ Remove and return the value for `key`, without evicting it. """
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._discard(key)
+
+    def clear(self):
+        """ Discard every item in the cache. """
+        with self._lock:
+            items = list(self._data.items())
+            self._data.clear()
+            self._sizes.clear()
+            self._total = 0
+        if self.on_evict is not None:
+            for key, value in items:
+                self.on_evict(key, value)
+
+    def items(self):
+        """ Return a list of the cached (key, value) pairs, from least to
+        most recently used. """
+        with self._lock:
+            return list(self._data.items())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _close(ds):
+    close = getattr(ds, 'close', None)
+    if close is not None:
+        close()
+
+
+class DatasetPool(object):
+    """ A bounded pool of open datasets, so that repeatedly loading the same
+    files re-uses the datasets (and file handles) already open rather than
+    opening them again.
+
+    Datasets are keyed by the loader used to open them, the path(s) to
+    their files (along with each file's size and modification time, so
+    changed files are re-opened) and the options they were opened with.
+    Once more than `max_open` datasets are held, the least-recently used
+    are closed. Callers always receive a shallow copy of the pooled
+    dataset, so they're free to modify it (and closing it has no effect
+    on the pool); lazily-loaded data whose file has since been closed is
+    transparently re-opened by xarray if it's accessed.
+
+    Parameters
+    ----------
+    max_open : int
+        Maximum number of datasets to hold open
+
+    """
+
+    def __init__(self, max_open=128):
+        self._cache = LRUCache(max_open, on_evict=self._evict)
+        self._lock = RLock()
+
+    @property
+    def max_open(self):
+        return self._cache.maxsize
+
+    @staticmethod
+    def _evict(key, ds):
+        _close(ds)
+
+    @staticmethod
+    def _key(loader, field, paths, options):
+        if isinstance(paths, (list, tuple)):
+            paths = tuple(paths)
+        else:
+            paths = (paths, )
+        files = []
+        for path in paths:
+            st = os.stat(path)
+            files.append((os.path.abspath(path), st.st_size, st.st_mtime))
+        return (getattr(loader, '__name__', repr(loader)), field,
+                tuple(files), repr(sorted(options.items())))
+
+    def open(self, loader, field, paths, **options):
+        """ Return a (copy of a) dataset loaded by calling `loader(field,
+        paths, **options)`, re-using one already in the pool if
+        possible. """
+        try:
+            key = self._key(loader, field, paths, options)
+        except OSError:
+            # Let the loader report the missing file(s)
+            return loader(field, paths, **options)
+
+        ds = self._cache.get(key)
+        if ds is None:
+            ds = loader(field, paths, **options)
+            with self._lock:
+                # Another thread may have beaten us to it
+                pooled = self._cache.get(key)
+                if pooled is None:
+                    self._cache.put(key, ds)
+                else:
+                    _close(ds)
+                    ds = pooled
+        return ds.copy()
+
+    def clear(self):
+        """ Close every dataset in the pool. """
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
@@ -0,0 +1,298 @@
+"""
+Persistent on-disk catalog of the files in an Experiment's archive.
+
+Discovering an archive's contents means formatting every expected path,
+touching the filesystem for each, and opening the files to see what's in
+them. A Catalog does that once and records the results in a small SQLite
+database, so later sessions can find files (and their basic metadata)
+without touching the archive at all. Refreshing a Catalog only re-reads
+the files whose size or modification time has changed.
+
+"""
+import json
+import os
+import sqlite3
+
+from collections import namedtuple
+
+from . import logger
+from . io import load_metadata
+from . parallel import get_executor
+
+#: Hack for Py2/3 basestring type compatibility
+if 'basestring' not in globals():
+    basestring = str
+
+#: A single file recorded in a Catalog
+FileRecord = namedtuple('FileRecord', [
+    'path', 'field', 'case', 'size', 'mtime', 'variables', 'dims',
+    'time_units', 'time_start', 'time_end', 'time_calendar'
+])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    field TEXT,
+    case_key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    variables TEXT NOT NULL,
+    dims TEXT NOT NULL,
+    time_units TEXT,
+    time_start REAL,
+    time_end REAL,
+    time_calendar TEXT
+);
+CREATE INDEX IF NOT EXISTS files_by_case ON files (field, case_key);
+"""
+
+
+def _case_key(case_bits):
+    return json.dumps(list(case_bits), default=str)
+
+
+def _stat(path):
+    """ Return the (size, mtime) of a file, or None if it doesn't exist. """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+
+def _file_metadata(path):
+    """ Read the variables, dimensions and time range recorded in a
+    file's header. """
+    schema = load_metadata(path)
+    time_start, time_end = schema.time_start, schema.time_end
+    if time_start is not None:
+        time_start, time_end = float(time_start), float(time_end)
+    return (sorted(schema.variables), dict(schema.dims), schema.time_units,
+            time_start, time_end, schema.time_calendar)
+
+
+def _scan_file(path, known):
+    """ Stat a file and, if it's new or changed since it was last
+    catalogued, read its metadata. """
+    stat = _stat(path)
+    if stat is None or stat == known:
+        return stat, None
+    return stat, _file_metadata(path)
+
+
+class Catalog(object):
+    """ An SQLite-backed index of the files in an Experiment's archive.
+
+    Parameters
+    ----------
+    path : str
+        Location of the index file; it's created if it doesn't exist
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._upgrade()
+
+    def _upgrade(self):
+        """ Bring an index written by an older version up to date; files
+        catalogued before the calendar was recorded are re-read on the next
+        refresh. """
+        columns = [row[1] for row in
+                   self._conn.execute("PRAGMA table_info(files)")]
+        if 'time_calendar' not in columns:
+            with self._conn:
+                self._conn.execute(
+                    "ALTER TABLE files ADD COLUMN time_calendar TEXT"
+                )
+                self._conn.execute("UPDATE files SET mtime = -1")
+
+    def refresh(self, exp, fields=None, max_workers=8):
+        """ Scan an Experiment's archive and bring the catalog up to date.
+
+        Only files which are new, or whose size or modification time has
+        changed, are opened to read their metadata; files which have
+        disappeared are removed from the catalog.
+
+        Parameters
+        ----------
+        exp : Experiment
+            The Experiment whose archive to scan
+        fields : str or list of str (optional)
+            The fields to catalog, for timeseries archives (with every file
+            of each case, if they're `segmented`). For timeslice archives
+            every file in each case's directory is catalogued.
+        max_workers : int
+            Maximum number of files to inspect concurrently
+
+        Returns
+        -------
+        The number of files which were (re-)read, and the number removed
+
+        """
+        if isinstance(fields, basestring):
+            fields = [fields, ]
+
+        # Gather the files we expect to find in the archive
+        expected = []
+        all_cases = list(exp.all_cases())
+        if exp.timeseries:
+            if not fields:
+                raise ValueError("Must specify which fields to catalog for "
+                                 "a timeseries archive")
+            for field in fields:
+                if exp.segmented:
+                    # Always look on disk, even if `exp` already uses a
+                    # catalog
+                    for case in all_cases:
+                        expected.extend(
+                            (path, field, case) for path in
+                            exp._glob_segment_files(field, case)
+                        )
+                    continue
+                paths = exp._render_files(field, all_cases)
+                expected.extend((path, field, case)
+                                for path, case in zip(paths, all_cases))
+        else:
+            for case in all_cases:
+                # Always look on disk, even if `exp` already uses a catalog
+                paths = exp._glob_timeslice_files(**exp.get_case_kws(*case))
+                expected.extend((path, None, case) for path in paths)
+
+        known = dict(
+            (path, (size, mtime)) for path, size, mtime in
+            self._conn.execute("SELECT path, size, mtime FROM files")
+        )
+
+        pool, owned = get_executor("threads", max_workers)
+        try:
+            results = list(pool.map(
+                lambda path: _scan_file(path, known.get(path, None)),
+                [path for path, _, _ in expected]
+            ))
+        finally:
+            if owned:
+                pool.shutdown()
+
+        # Anything previously catalogued which we didn't find this time has
+        # been removed from the archive
+        existing = set(path for (path, _, _), (stat, _) in
+                       zip(expected, results) if stat is not None)
+        scope = set()
+        for field in (fields if exp.timeseries else [None, ]):
+            scope.update(self.paths(field))
+        removed = sorted(scope - existing)
+
+        n_read = 0
+        with self._conn:
+            for (path, field, case), (stat, meta) in zip(expected, results):
+                if meta is None:
+                    continue
+                (variables, dims, time_units, time_start, time_end,
+                 time_calendar) = meta
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO files VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (path, field, _case_key(case), stat[0], stat[1],
+                     json.dumps(variables), json.dumps(dims),
+                     time_units, time_start, time_end, time_calendar)
+                )
+                n_read += 1
+            self._conn.executemany("DELETE FROM files WHERE path = ?",
+                                   [(path, ) for path in removed])
+
+        logger.info("Catalog {} - read {} file(s), removed {}".format(
+            self.path, n_read, len(removed)
+        ))
+        return n_read, len(removed)
+
+    def _records(self, query, args=()):
+        for row in self._conn.execute(query, args):
+            (path, field, case_key, size, mtime, variables, dims,
+             time_units, time_start, time_end, time_calendar) = row
+            yield FileRecord(path, field, tuple(json.loads(case_key)),
+                             size, mtime, json.loads(variables),
+                             json.loads(dims), time_units, time_start,
+                             time_end, time_calendar)
+
+    def lookup(self, path):
+        """ Return the FileRecord for a path, or None if it isn't
+        catalogued. """
+        for record in self._records("SELECT * FROM files WHERE path = ?",
+                                    (path, )):
+            return record
+        return None
+
+    def records(self, field=None):
+        """ Return the FileRecords for every file of a given field (or,
+        for timeslice archives, every file) in the catalog. """
+        if field is None:
+            return list(self._records(
+                "SELECT * FROM files WHERE field IS NULL ORDER BY path"
+            ))
+        return list(self._records(
+            "SELECT * FROM files WHERE field = ? ORDER BY path", (field, )
+        ))
+
+    def paths(self, field=None):
+        """ Return the set of catalogued paths for a field (or, for
+        timeslice archives, every file). """
+        if field is None:
+            rows = self._conn.execute(
+                "SELECT path FROM files WHERE field IS NULL"
+            )
+        else:
+            rows = self._conn.execute(
+                "SELECT path FROM files WHERE field = ?", (field, )
+            )
+        return set(path for path, in rows)
+
+    def covers(self, field=None):
+        """ Return True if any files of a given field (or, for timeslice
+        archives, any files at all) have been catalogued. """
+        if field is None:
+            row = self._conn.execute(
+                "SELECT 1 FROM files WHERE field IS NULL LIMIT 1"
+            ).fetchone()
+        else:
+            row = self._conn.execute(
+                "SELECT 1 FROM files WHERE field = ? LIMIT 1", (field, )
+            ).fetchone()
+        return row is not None
+
+    def case_files(self, case_bits, field=None):
+        """ Return the sorted paths catalogued for a single case. """
+        if field is None:
+            rows = self._conn.execute(
+                "SELECT path FROM files WHERE field IS NULL AND case_key = ? "
+                "ORDER BY path", (_case_key(case_bits), )
+            )
+        else:
+            rows = self._conn.execute(
+                "SELECT path FROM files WHERE field = ? AND case_key = ? "
+                "ORDER BY path", (field, _case_key(case_bits))
+            )
+        return [path for path, in rows]
+
+    def __contains__(self, path):
+        return self._conn.execute(
+            "SELECT 1 FROM files WHERE path = ?", (path, )
+        ).fetchone() is not None
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        """ Close the connection to the index file. """
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "Catalog({!r}, {} files)".format(self.path, len(self))
@@ -0,0 +1,161 @@
+"""
+Chunking policies for lazily-loaded data.
+
+Rather than guessing chunk sizes by hand, `load` and `create_master` accept
+a `chunks` policy which is resolved against the shape, dtype and on-disk
+(netCDF4/HDF5) chunking of each variable. Dask chunks are always whole
+multiples of the storage chunks, so each one maps onto a contiguous set of
+blocks in the file and no block is decompressed more than once.
+
+A policy may be
+
+- "auto", to aim for dask's configured `array.chunk-size` per chunk;
+- a target number of bytes per chunk, as a string like "64MB";
+- a dict mapping dimension names to a chunk size, -1 or None (the whole
+  dimension), or "auto" (fill out the remaining byte budget). Dimensions
+  which aren't named keep their current (or on-disk) chunking, or aren't
+  chunked at all if they have none.
+
+Anything else (e.g. a dict of integer sizes) is passed through to xarray
+untouched.
+
+"""
+from collections import OrderedDict
+
+import dask
+from dask.array.core import normalize_chunks
+from dask.utils import parse_bytes
+
+#: Hack for Py2/3 basestring type compatibility
+if 'basestring' not in globals():
+    basestring = str
+
+
+def _byte_limit(chunks):
+    """ Return the target bytes per chunk for a scalar policy. """
+    if chunks == 'auto':
+        chunks = dask.config.get('array.chunk-size')
+    return parse_bytes(chunks)
+
+
+def resolve_chunks(chunks, dims, shape, dtype, storage_chunks=None):
+    """ Resolve a chunking policy for a single variable.
+
+    Parameters
+    ----------
+    chunks : str or dict
+        The chunking policy; see the module documentation
+    dims : sequence of str
+        The variable's dimensions
+    shape : sequence of int
+        The variable's shape
+    dtype : numpy.dtype
+        The variable's data type
+    storage_chunks : sequence of int (optional)
+        The variable's chunk shape on disk, if it's chunked
+
+    Returns
+    -------
+    OrderedDict mapping each dimension to its (leading) chunk size, which
+    can be passed to `xarray.open_dataset` or `Dataset.chunk`
+
+    """
+    dims, shape = tuple(dims), tuple(shape)
+    if storage_chunks is not None:
+        storage_chunks = tuple(min(c, n) for c, n in
+                               zip(storage_chunks, shape))
+
+    if isinstance(chunks, dict):
+        unknown = set(chunks) - set(dims)
+        defaults = storage_chunks or (-1, ) * len(dims)
+        spec = tuple(chunks.get(dim, default) for dim, default in
+                     zip(dims, defaults))
+        spec = tuple(-1 if size is None else size for size in spec)
+        limit = _byte_limit('auto')
+    else:
+        unknown = set()
+        spec = 'auto'
+        limit = _byte_limit(chunks)
+    if unknown:
+        raise ValueError("Can't chunk unknown dimension(s) {}".format(
+            ", ".join(sorted(unknown))
+        ))
+
+    normalized = normalize_chunks(spec, shape, limit=limit, dtype=dtype,
+                                  previous_chunks=storage_chunks)
+    return OrderedDict((dim, c[0] if c else 0)
+                       for dim, c in zip(dims, normalized))
+
+
+def _combine(chunks, variables):
+    """ Resolve a policy for each of a sequence of (dims, shape, dtype,
+    storage_chunks) tuples, and combine the results by taking the smallest
+    size along each dimension, so no variable ends up with chunks larger
+    than the policy allows. """
+    resolved = OrderedDict()
+    for dims, shape, dtype, storage_chunks in variables:
+        policy = chunks
+        if isinstance(chunks, dict):
+            policy = dict((dim, size) for dim, size in chunks.items()
+                          if dim in dims)
+        for dim, size in resolve_chunks(policy, dims, shape, dtype,
+                                        storage_chunks).items():
+            resolved[dim] = min(size, resolved.get(dim, size))
+    return resolved
+
+
+def schema_chunks(chunks, schema, var_names, data=None):
+    """ Resolve a chunking policy for the fields in a file, given its
+    FileSchema. Dimensions not used by any of the fields are left to
+    xarray's defaults. If the file has been subset, pass the resulting
+    Dataset as `data` to resolve the policy for the subset's shape. """
+    if isinstance(var_names, basestring):
+        var_names = [var_names, ]
+    return _combine(chunks, [
+        (v.dims, v.shape if data is None else data.variables[v.name].shape,
+         v.dtype, v.chunks)
+        for v in (schema.variables[name] for name in var_names)
+    ])
+
+
+def rechunk(data, chunks, var_names=None):
+    """ Re-chunk a DataArray or Dataset according to a chunking policy,
+    keeping the new chunks aligned with its current ones.
+
+    Parameters
+    ----------
+    data : DataArray or Dataset
+        The data to re-chunk
+    chunks : str or dict
+        The chunking policy; anything which isn't a policy is passed
+        straight to `chunk`, and None leaves the data as-is
+    var_names : list of str (optional)
+        For Datasets, the variables to consider when resolving the policy;
+        by default, all the data variables
+
+    """
+    if chunks is None:
+        return data
+    if not is_policy(chunks):
+        return data.chunk(chunks)
+
+    if hasattr(data, 'data_vars'):
+        if var_names is None:
+            var_names = list(data.data_vars)
+        variables = [data.variables[name] for name in var_names]
+    else:
+        variables = [data.variable, ]
+    return data.chunk(_combine(chunks, [
+        (v.dims, v.shape, v.dtype,
+         None if v.chunks is None else tuple(c[0] for c in v.chunks))
+        for v in variables
+    ]))
+
+
+def is_policy(chunks):
+    """ True if `chunks` is a policy to be resolved, rather than something
+    to be handed straight to xarray. """
+    if isinstance(chunks, dict):
+        return any(isinstance(size, basestring)
+                   for size in chunks.values())
+    return isinstance(chunks, basestring)
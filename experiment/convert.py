@@ -1,17 +1,26 @@
+from collections import OrderedDict, namedtuple
 from itertools import product
+from operator import getitem
 import warnings
 
-from numpy import empty, nditer
-from xarray import DataArray, Dataset
+from numpy import array, empty, nan, ndindex, result_type
+from pandas import MultiIndex
+from xarray import Coordinates, DataArray, Dataset
 
 from . import logger
+from . chunking import rechunk
 
 #: Hack for Py2/3 basestring type compatibility
 if 'basestring' not in globals():
     basestring = str
 
 
-def create_master(exp, var, data=None, new_fields=[]):
+#: How the cases are arranged along the leading dimension(s) of a master
+CaseLayout = namedtuple('CaseLayout', ['dims', 'shape', 'cases', 'coords'])
+
+
+def create_master(exp, var, data=None, new_fields=[], missing='fill',
+                  layout='dense', chunks=None, **case_kws):
     """ Save a dictionary which holds variable data for all
     activation and aerosol case combinations to a dataset
     with those cases as auxiliary indices.
@@ -29,6 +38,29 @@ def create_master(exp, var, data=None, new_fields=[]):
     new_fields : list of strs (optional)
         A list of the keys in each DataSet to include in the
         final multi-keyed master
+    missing : {'fill', 'raise'}
+        How to handle cases which are absent from the data dictionary
+        (or mapped to None). With 'fill', they're represented by lazy,
+        NaN-filled dask arrays shaped like the cases which are present,
+        and a boolean `case_present` coordinate is added to the master
+        to flag them; with 'raise', a KeyError is raised.
+    layout : {'dense', 'stacked'}
+        With 'dense', the master has one dimension per case, spanning every
+        combination of the case values; for sparse experiments, any
+        combinations which don't exist are treated as missing. With
+        'stacked', the master has a single `case` dimension, indexed by a
+        MultiIndex over the case names, spanning only the valid cases.
+    chunks : str or dict (optional)
+        Re-chunk the master according to a policy - "auto", a target size
+        like "64MB", or a dict of per-dimension sizes (case dimensions
+        included) which may include "auto" - aligned with the chunks of
+        the individual cases, so that small cases are grouped together
+        rather than left one chunk apiece. See `experiment.chunking`.
+    case_kws : dict (optional)
+        Only cover the cases matching these values - a single value or a
+        list of values for any of the cases - rather than every case in
+        the Experiment; see `Experiment.subset`. Any other cases in the
+        data are ignored.
 
     Returns:
     --------
@@ -52,130 +84,191 @@ def create_master(exp, var, data=None, new_fields=[]):
         new_fields.append(var.varname)
         new_fields.extend(var.oldvar)
 
-    all_case_vals = exp.all_case_vals()
-
-    # Post-process the case inspection a bit:
-    # 1) Promote any single-value case to a list with one entry
-    for i, case_vals in enumerate(all_case_vals):
-        if isinstance(case_vals, str):
-            all_case_vals[i] = list(case_vals)
-
-    # 2) Make sure they're all still in the data dictionary. This is
-    #    circular but a necessary sanity check
-    for case_bits in product(*all_case_vals):
-        assert case_bits in data_dict
+    if missing not in ('fill', 'raise'):
+        raise ValueError("`missing` must be one of 'fill' or 'raise'")
+    if case_kws:
+        exp = exp.subset(**case_kws)
+    layout = _case_layout(exp, layout)
+
+    # Make sure all the cases are in the data dictionary, and make note of
+    # any that aren't
+    absent = set(case for case in layout.cases
+                 if data_dict.get(case) is None)
+    if absent and (missing == 'raise'):
+        raise KeyError("Missing data for {} case(s): {}".format(
+            len(absent), ", ".join(repr(tuple(c)) for c in layout.cases
+                                   if c in absent)
+        ))
+    present = [case for case in layout.cases if case not in absent]
+    if not present:
+        raise ValueError("Couldn't find data for any case")
 
     # Discover the type of the data passed into this method. If
     # it's an xarray type, we'll preserve that. If it's an iris type,
     # then we need to crash for now.
-    first_case = next(exp.all_cases())
-
-    proto = data_dict[first_case]
+    proto = data_dict[present[0]]
     if isinstance(proto, Dataset):
-        return _master_dataset(exp, data_dict, new_fields)
+        master = _master_dataset(layout, data_dict, new_fields, proto)
     elif isinstance(proto, DataArray):
-        return _master_dataarray(exp, data_dict)
+        master = _master_dataarray(layout, data_dict, proto)
     # elif isinstance(proto, Cube):
     #     raise NotImplementedError("Cube handling not yet implemented")
     else:
         raise ValueError("Data must be an xarray type")
 
+    if absent:
+        case_present = array([case not in absent for case in layout.cases],
+                             dtype=bool).reshape(layout.shape)
+        master.coords['case_present'] = (layout.dims, case_present)
+
+    return rechunk(master, chunks)
+
+
+def _case_layout(exp, layout):
+    """ Determine the cases spanned by a master array and how they're
+    laid out along its leading dimension(s). """
+    if layout == 'dense':
+        cases = [exp.case_tuple(*case)
+                 for case in product(*exp.all_case_vals())]
+        shape = tuple(len(vals) for vals in exp.all_case_vals())
+        return CaseLayout(list(exp.cases), shape, cases, _case_coords(exp))
+    elif layout == 'stacked':
+        cases = [exp.case_tuple(*case) for case in exp.all_cases()]
+        index = MultiIndex.from_tuples(cases, names=exp.cases)
+        coords = Coordinates.from_pandas_multiindex(index, 'case')
+        return CaseLayout(['case', ], (len(cases), ), cases, coords)
+    else:
+        raise ValueError("`layout` must be one of 'dense' or 'stacked'")
+
 
-def _master_dataarray(exp, data_dict):
-    case_list = [exp._case_data[case] for case in exp.cases]
-    stacked_data = _stack_dims(data_dict, case_list, {}, exp)
+def _master_dataarray(layout, data_dict, proto):
+    leaves = []
+    for case in layout.cases:
+        case_da = data_dict.get(case)
+        leaves.append(_missing_like(proto) if case_da is None
+                      else case_da.data)
+    stacked_data = _stack_dims(leaves, layout.shape)
 
-    test_case = next(exp.all_cases())
-    test_da = data_dict[test_case]
+    test_da = proto
     name = test_da.name
 
-    new_coords = test_da.to_dataset().coords
     logger.debug("Creating master dataarray")
-    for case in exp.cases:
-        logger.debug("   " + case)
-        new_coords[case] = exp._case_data[case].vals
-
-    new_dims = list(exp.cases) + list(test_da.dims)
+    new_dims = list(layout.dims) + list(test_da.dims)
 
-    new_da = DataArray(stacked_data, coords=new_coords,
+    new_da = DataArray(stacked_data, coords=test_da.coords,
                        dims=new_dims)
+    new_da = new_da.assign_coords(layout.coords)
     new_da = copy_attrs(test_da, new_da)
     new_da.name = name
 
     return new_da
 
 
-def _stack_dims(data, cases, set_cases, exp):
-    """Recursive function to stack multi-dimensional data
-    """
-    from dask.array import stack as dstack
-    from numpy import stack as nstack
-    # print(set_cases)
-    idx = len(set_cases)
-    if idx >= len(cases):
-        # print("   leaf")
-        tup = exp.case_tuple(**set_cases)
-        # print(tup)
-        return data[tup].data
-    else:
-        new_set_cases = set_cases.copy()
-        case = cases[idx]
-
-        to_stack = []
-        for val in case.vals:
-            new_set_cases[case.shortname] = val
-            x = _stack_dims(data, cases, new_set_cases, exp)
-            to_stack.append(x)
-
-        return dstack(to_stack)
-
-def _master_dataset(exp, data_dict, new_fields):
-
-    all_case_vals = exp.all_case_vals()
-    first_case = next(exp.all_cases())
-    proto = data_dict[first_case]
-
-    n_case_vals = [len(case_vals) for case_vals in all_case_vals]
-    n_cases = len(n_case_vals)
+def _stack_dims(leaves, case_shape):
+    """ Stack a flat sequence of equally-shaped arrays, in row-major order
+    over the case dimensions, into a single array with the case dimensions
+    leading.
 
-    # Create the new Dataset to populate
-    ds_new = Dataset()
-
-    # Add the case coordinates
-    for case, longname, vals in exp.itercases():
-        ds_new[case] = vals
-        ds_new[case].attrs['long_name'] = longname
+    Rather than nesting one stack per case dimension, every leaf is placed
+    directly at its position in the N-dimensional case block. If any leaf
+    is a dask array the result is a dask array built from a single graph
+    layer, with one task per leaf chunk; otherwise, the leaves are copied
+    into a single pre-allocated NumPy buffer.
 
+    """
+    from dask.array import Array
+
+    leaves = list(leaves)
+    leaf_shape = leaves[0].shape
+    for leaf in leaves:
+        if leaf.shape != leaf_shape:
+            raise ValueError("Couldn't stack data with shapes {} and "
+                             "{}".format(leaf_shape, leaf.shape))
+    new_shape = tuple(case_shape) + tuple(leaf_shape)
+    dtype = result_type(*set(leaf.dtype for leaf in leaves))
+
+    if any(isinstance(leaf, Array) for leaf in leaves):
+        return _stack_dask(leaves, tuple(case_shape), dtype)
+
+    stacked = empty((len(leaves), ) + tuple(leaf_shape), dtype=dtype)
+    for i, leaf in enumerate(leaves):
+        stacked[i] = leaf
+    return stacked.reshape(new_shape)
+
+
+def _stack_dask(leaves, case_shape, dtype):
+    """ Stack leaves into a dask array with a single new graph layer
+    mapping each leaf chunk to its block in the output. """
+    from dask.array import Array, asarray
+    from dask.base import tokenize
+    from dask.core import flatten
+    from dask.highlevelgraph import HighLevelGraph
+
+    leaves = [asarray(leaf).astype(dtype, copy=False) for leaf in leaves]
+    chunks = leaves[0].chunks
+    leaves = [leaf if leaf.chunks == chunks else leaf.rechunk(chunks)
+              for leaf in leaves]
+
+    name = 'stack-cases-' + tokenize(case_shape, *leaves)
+    expand = (None, ) * len(case_shape) + (slice(None), ) * len(chunks)
+    layer = {}
+    for leaf, idx in zip(leaves, ndindex(*case_shape)):
+        for key in flatten(leaf.__dask_keys__()):
+            layer[(name, ) + idx + key[1:]] = (getitem, key, expand)
+
+    graph = HighLevelGraph.from_collections(name, layer, dependencies=leaves)
+    new_chunks = tuple((1, ) * n for n in case_shape) + chunks
+    return Array(graph, name, new_chunks, meta=leaves[0]._meta)
+
+
+def _master_dataset(layout, data_dict, new_fields, proto):
+    """ Stack every data variable in a dictionary of Datasets into a master
+    Dataset, walking the cases only once. """
+
+    # Gather the leaves for every variable in a single pass over the cases;
+    # if a case is missing (or is missing a variable), fill in a lazy
+    # stand-in with the same shape as the prototype
     logger.debug("Creating master dataset")
-    for var in proto.data_vars:
-        logger.debug("   "+var)
-
-        # Ensure that all the data has the same dimensions
-        bad_keys = []
-        data_dict_as_da = {}
-        for key, ds in data_dict.items():
-            try:
-                data_dict_as_da[key] = ds[var]
-            except KeyError:
-                bad_keys.append(key)
-                continue
-        if len(data_dict) <= 1:
-            raise ValueError("Couldn't coerce data for master array "
-                             "concatenation.")
-        else:
-            ref_da = next(iter(data_dict_as_da.values()))
-            for key in bad_keys:
-                faux_da = DataArray(empty(ref_da.shape),
-                                    dims=ref_da.coords)
-                #for case, val in key.items():
-                #    faux_da[case] = val
-                data_dict_as_da[key] = faux_da
-        # data_dict_as_da = exp.apply_to_all(data_dict, lambda x: x[var])
-        new_da = _master_dataarray(exp, data_dict_as_da)
-        ds_new[var] = new_da
-
-    ds_new = copy_attrs(proto, ds_new)
-    return ds_new
+    leaves = OrderedDict((var, []) for var in proto.data_vars)
+    for case in layout.cases:
+        ds = data_dict.get(case)
+        case_vars = {} if ds is None else ds.variables
+        for var, var_leaves in leaves.items():
+            if var in case_vars:
+                var_leaves.append(case_vars[var].data)
+            else:
+                var_leaves.append(_missing_like(proto.variables[var]))
+
+    data_vars = OrderedDict()
+    for var, var_leaves in leaves.items():
+        logger.debug("   " + var)
+        proto_var = proto.variables[var]
+        data_vars[var] = (list(layout.dims) + list(proto_var.dims),
+                          _stack_dims(var_leaves, layout.shape),
+                          proto_var.attrs)
+
+    ds_new = Dataset(data_vars, coords=proto.coords, attrs=proto.attrs)
+    return ds_new.assign_coords(layout.coords)
+
+
+def _missing_like(ref):
+    """ Return a lazy, NaN-filled dask array with the same shape (and
+    chunking, if available) as a reference variable, to stand in for a
+    missing case. Nothing is allocated until it's computed. """
+    from dask.array import full
+
+    dtype = ref.dtype if ref.dtype.kind in 'fc' else 'f8'
+    chunks = ref.chunks if ref.chunks is not None else ref.shape
+    return full(ref.shape, nan, dtype=dtype, chunks=chunks)
+
+
+def _case_coords(exp):
+    """ Return the coordinates labeling each case dimension of a master
+    array. """
+    coords = OrderedDict()
+    for case, longname, vals in exp.itercases():
+        coords[case] = (case, list(vals), {'long_name': longname})
+    return coords
 
 
 def _get_dataset_attr(ds, attr_key):
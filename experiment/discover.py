@@ -0,0 +1,147 @@
+"""
+Discovering an Experiment's cases from the files in its archive.
+
+Normally an Experiment goes from case values to paths, and its case values
+have to be listed by hand and kept in sync with the archive. Here the
+naming scheme is run in reverse instead: the templates for the case path,
+output prefix and suffix are compiled into a single regular expression,
+the archive is walked once with `os.scandir` (only as deep as the template
+requires), and every file name is parsed into its case values and field in
+a single pass. The result is a fully specified Experiment, along with the
+combinations of cases which actually exist and the fields found for each.
+
+"""
+import os
+
+from collections import OrderedDict
+from string import Formatter
+
+from . import logger
+from . template import FIELD, PathTemplate
+
+#: Hack for Py2/3 basestring type compatibility
+if 'basestring' not in globals():
+    basestring = str
+
+
+def _depth(template):
+    """ Count the directories a path rendered from a template is nested
+    in, given that values never contain a path separator. """
+    return sum(literal.count(os.sep)
+               for literal, _, _, _ in Formatter().parse(template))
+
+
+def scan_archive(data_dir, regex, depth):
+    """ Walk an archive, yielding the match for every file at the given
+    depth whose path (relative to `data_dir`) matches `regex`. Each
+    directory is listed exactly once. """
+    stack = [(data_dir, "", 0)]
+    while stack:
+        path, rel_path, level = stack.pop()
+        try:
+            it = os.scandir(path)
+        except OSError as e:
+            logger.warning("Couldn't list {} ({})".format(path, e))
+            continue
+        with it:
+            for entry in it:
+                if level < depth:
+                    if entry.is_dir():
+                        stack.append((entry.path,
+                                      rel_path + entry.name + os.sep,
+                                      level + 1))
+                elif entry.is_file():
+                    match = regex.fullmatch(rel_path + entry.name)
+                    if match is not None:
+                        yield match
+
+
+def discover_experiment(cls, data_dir, cases, name=None, case_path=None,
+                        output_prefix="", output_suffix=".nc",
+                        timeseries=True, converters={}, **exp_kws):
+    """ Build an Experiment by parsing the names of the files in its
+    archive.
+
+    See `Experiment.discover` for a description of the arguments.
+
+    """
+    from . experiment import Case
+
+    cases = [Case(case, case, []) if isinstance(case, basestring) else case
+             for case in cases]
+    names = [case.shortname for case in cases]
+    if case_path is None:
+        case_path_str = os.path.join(*["{" + name + "}" for name in names])
+    else:
+        case_path_str = case_path
+    if any(callable(t) for t in (case_path_str, output_prefix,
+                                 output_suffix)):
+        raise ValueError("Can't discover cases for a naming scheme given "
+                         "by functions")
+    template = os.path.join(case_path_str,
+                            output_prefix + "{" + FIELD + "}" + output_suffix)
+    regex = PathTemplate(template, names + [FIELD, ]).to_regex()
+
+    # Parse every file, converting each distinct value only once
+    converted = dict((name, {}) for name in names)
+
+    def _convert(name, val):
+        try:
+            return converted[name][val]
+        except KeyError:
+            new_val = converters[name](val) if name in converters else val
+            converted[name][val] = new_val
+            return new_val
+
+    allowed = [set(case.vals) if case.vals else None for case in cases]
+    found = OrderedDict()
+    n_files = 0
+    for match in scan_archive(data_dir, regex, _depth(template)):
+        groups = match.groupdict()
+        bits = tuple(_convert(name, groups[name]) for name in names)
+        if not all((vals is None) or (bit in vals)
+                   for bit, vals in zip(bits, allowed)):
+            continue
+        found.setdefault(bits, set()).add(groups[FIELD])
+        n_files += 1
+    if not found:
+        raise ValueError("Couldn't find any files matching {!r} in "
+                         "{}".format(template, data_dir))
+
+    # Keep any values given up front in their order, and sort the rest
+    new_cases = []
+    for i, case in enumerate(cases):
+        vals = case.vals
+        if not vals:
+            vals = sorted(set(bits[i] for bits in found))
+        else:
+            present = set(bits[i] for bits in found)
+            vals = [val for val in vals if val in present]
+        new_cases.append(Case(case.shortname, case.longname, vals))
+
+    n_total = 1
+    for case in new_cases:
+        n_total *= len(case.vals)
+    valid_cases = None if len(found) == n_total else list(found)
+
+    if name is None:
+        name = os.path.basename(os.path.normpath(data_dir))
+    exp = cls(name, new_cases, timeseries=timeseries, data_dir=data_dir,
+              case_path=case_path, output_prefix=output_prefix,
+              output_suffix=output_suffix, validate_data=False,
+              valid_cases=valid_cases, **exp_kws)
+
+    if timeseries:
+        # Record which cases have files for each field
+        inventory = OrderedDict()
+        for bits in exp.all_cases():
+            for field in sorted(found[bits]):
+                inventory.setdefault(field, []).append(exp.case_tuple(*bits))
+        exp.inventory = OrderedDict(
+            (field, inventory[field]) for field in sorted(inventory)
+        )
+
+    logger.info("{} - discovered {} case(s) from {} file(s) in {}".format(
+        name, len(found), n_files, data_dir
+    ))
+    return exp
@@ -34,30 +34,46 @@ leaf factor.
 from __future__ import print_function
 
 # import logging
+import glob
 import os
 import warnings
 
 from collections import OrderedDict, namedtuple
+from copy import copy
+from inspect import Parameter, signature
 from itertools import product
 
-import numpy as np
-import xarray as xr
 import yaml
 
 from tqdm import tqdm
 
 from . import logger
-from . io import load_variable
+from . io import load_metadata
+from . cache import DatasetPool, LRUCache
+from . catalog import Catalog
 from . convert import create_master
+from . discover import discover_experiment
+from . memo import LoadCache
+from . parallel import get_executor
+from . segments import (DATE_PATTERN, END, START, WILDCARD, find_segments,
+                        markers, segment_tokens, sort_segments, time_window,
+                        to_glob)
+from . template import FIELD, PathTemplate, escape
+from . validate import validate_experiment
 
 # logger = logging.getLogger(__name__)
 
 Case = namedtuple('case', ['shortname', 'longname', 'vals'])
 
+#: Compiled naming scheme for an Experiment's archive
+_Templates = namedtuple('templates', ['case_path', 'prefix', 'suffix', 'files',
+                                       'segments'])
+
 #: Hack for Py2/3 basestring type compatibility
 if 'basestring' not in globals():
     basestring = str
 
+
 class Experiment(object):
     """ Experiment ...
 
@@ -92,7 +108,10 @@ class Experiment(object):
                  case_path=None,
                  output_prefix="",
                  output_suffix=".nc",
-                 validate_data=True):
+                 validate_data=True,
+                 valid_cases=None,
+                 path_cache_size=2**16,
+                 max_open_files=128):
 
         """
         Parameters
@@ -124,6 +143,19 @@ class Experiment(object):
         validate_data : bool, optional (default True)
             Validate that the specified case structure is reflected in the
             directory structure passed via `data_dir`
+        valid_cases : list or function (optional)
+            For experiments which don't cover every combination of the case
+            values, either an explicit list of the case combinations which
+            exist (as tuples of values in the order of `cases`, or as
+            dictionaries keyed by case name) or a function which accepts
+            the case values as named keyword arguments and returns True if
+            that combination exists. By default, every combination is
+            assumed to exist.
+        path_cache_size : int, optional (default 65536)
+            Maximum number of resolved file paths to memoize
+        max_open_files : int, optional (default 128)
+            Maximum number of datasets which `load` keeps open for re-use
+            by later calls; see `close`
         """
 
         self.name = name
@@ -140,6 +172,16 @@ class Experiment(object):
 
         # Mapping to private information on case data
         self._cases = list(self._case_data.keys())
+        shadowed = [case for case in self._cases if case in RESERVED_NAMES]
+        if shadowed:
+            warnings.warn(
+                "Case name(s) {} are also the names of options to `load` and "
+                "`aload`, so their values can't be passed to those as "
+                "keywords; select them with `subset` instead. Such case "
+                "names will be rejected in a future version.".format(
+                    ", ".join(shadowed)
+                ), FutureWarning, stacklevel=2
+            )
         self._case_vals = OrderedDict()
         for case in self._cases:
             self._case_vals[case] = self._case_data[case].vals
@@ -152,6 +194,32 @@ class Experiment(object):
             setattr(self.__class__, case, vals)
         self.case_tuple = namedtuple('case', field_names=self._cases)
 
+        # Record the subset of case combinations which actually exist
+        self._valid_cases = valid_cases
+        self._case_list = None
+        self._case_set = None
+        if valid_cases is not None:
+            self._case_list = self._process_valid_cases(valid_cases)
+            self._case_set = set(self._case_list)
+        self._case_val_sets = [set(vals) for vals in self.all_case_vals()]
+
+        # Memoized mapping of (field, case tuple) -> path to file
+        self._path_cache = LRUCache(path_cache_size)
+        self._templates_token = None
+
+        #: Optional on-disk index of the files in the archive
+        self.catalog = None
+
+        #: Fields found in the archive by `discover`, mapped to the cases
+        #: which have them
+        self.inventory = None
+
+        # Datasets opened by `load`, kept open for re-use
+        self._datasets = DatasetPool(max_open_files)
+
+        #: Optional cache of loaded cases; see `enable_load_cache`
+        self.load_cache = None
+
         self.timeseries = timeseries
         self.output_prefix = output_prefix
         self.output_suffix = output_suffix
@@ -164,6 +232,32 @@ class Experiment(object):
             assert os.path.exists(data_dir)
             self._validate_data()
 
+    def _process_valid_cases(self, valid_cases):
+        """ Convert a list of (or predicate for) valid case combinations
+        into a list of case tuples, in the same order they'd appear in
+        the full product of case values. """
+        if callable(valid_cases):
+            return [case for case in product(*self.all_case_vals())
+                    if valid_cases(**self.get_case_kws(*case))]
+
+        # Rank each case value so the combinations can be sorted into the
+        # same order as the product
+        ranks = [dict((val, i) for i, val in enumerate(vals))
+                 for vals in self.all_case_vals()]
+        case_list = set()
+        for bits in valid_cases:
+            if isinstance(bits, dict):
+                bits = self.get_case_bits(**bits)
+            bits = tuple(bits)
+            if len(bits) != len(self._cases) or \
+                    not all(bit in rank for bit, rank in zip(bits, ranks)):
+                raise ValueError("Couldn't interpret valid case "
+                                 "{!r}".format(bits))
+            case_list.add(bits)
+        return sorted(case_list, key=lambda bits: tuple(
+            rank[bit] for bit, rank in zip(bits, ranks)
+        ))
+
     # Validation methods
     def _validate_data(self):
         """ Validate that the specified data directory contains
@@ -172,24 +266,40 @@ class Experiment(object):
 
         """
         logger.debug("Validating directory")
-        root = self.data_dir
-        for path in self._walk_cases():
-            print(path)
-            full_path = os.path.join(root, path)
-            logger.debug("   " + full_path)
-            try:
-                assert os.path.exists(full_path)
-            except AssertionError:
-                raise AssertionError(
-                    "Couldn't find data on path {}".format(full_path)
+        report = self.validate()
+        if report.missing_cases:
+            raise AssertionError(
+                "Couldn't find data for some cases in {}\n{}".format(
+                    self.data_dir, report
                 )
+            )
+
+    def validate(self, fields=None, max_workers=8):
+        """ Check which of this experiment's cases are present in its
+        archive, and optionally which of their output files exist.
+
+        Every parent directory in the archive is listed only once, and
+        the listings are run concurrently.
+
+        Parameters
+        ----------
+        fields : str or list of str (optional)
+            Field names whose timeseries files should be checked for every
+            case, in addition to the case directories
+        max_workers : int
+            Maximum number of directories to list concurrently
+
+        Returns
+        -------
+        ValidationReport detailing any missing cases and files
+
+        """
+        return validate_experiment(self, fields, max_workers)
 
     def _walk_cases(self, with_kws=False):
         """ Walk the Experiment case structure and generate paths to
         every single case. """
 
-        root = self.data_dir
-
         path_bits = self.all_cases()
         path_kws = self.cases
 
@@ -212,21 +322,177 @@ class Experiment(object):
 
         Returns
         -------
-        kwargs dictionary and filename, as a generator
+        kwargs dictionary and filename, as a generator. If each case's output
+        is split across several files (see `segmented`), the sorted list of
+        its files is given instead of a single filename.
+
+        """
+        all_cases = list(self.all_cases())
+        for case_bits, path_to_file in zip(all_cases,
+                                           self._field_files(field, all_cases)):
+            yield self.get_case_kws(*case_bits), path_to_file
+
+    def get_files(self, fields):
+        """ Return the paths to the files for one or more fields across every
+        case in this experiment.
+
+        Parameters
+        ----------
+        fields : str or list of str
+            The name(s) of the fields to find files for.
+
+        Returns
+        -------
+        OrderedDict mapping each field to a list of paths, ordered like
+        `all_cases()`; for `segmented` archives, each case has a list of
+        paths
+
+        """
+        if isinstance(fields, basestring):
+            fields = [fields, ]
+        all_cases = list(self.all_cases())
+        return OrderedDict(
+            (field, self._field_files(field, all_cases)) for field in fields
+        )
+
+    def walk_timeslices(self):
+        """ Walk through all the cases in this experiment and discover the
+        timeslice files archived for each one.
+
+        Returns
+        -------
+        kwargs dictionary and sorted list of filenames, as a generator
 
         """
         for case_bits in self.all_cases():
             case_kws = self.get_case_kws(*case_bits)
+            yield case_kws, self.get_timeslice_files(**case_kws)
 
-            prefix = self.case_prefix(**case_kws)
-            suffix = self.case_suffix(**case_kws)
-            path_to_file = os.path.join(
-                self.data_dir,
-                self.case_path(**case_kws),
-                prefix + field + suffix,
-            )
+    def scan_metadata(self, field=None, max_workers=8):
+        """ Read the header of every file in this experiment's archive,
+        without reading any data, to learn the variables, dims, shapes,
+        dtypes, on-disk chunking and time bounds of each.
+
+        Headers are cached by file identity, so repeated scans of an
+        unchanged archive are free.
 
-            yield case_kws, path_to_file
+        Parameters
+        ----------
+        field : str (optional; required for timeseries archives)
+            The field whose files should be scanned
+        max_workers : int
+            Maximum number of files to inspect concurrently
+
+        Returns
+        -------
+        OrderedDict mapping case tuples to a FileSchema (for timeseries
+        archives) or a list of FileSchemas (for timeslice and `segmented`
+        archives). Cases whose files couldn't be read are left out.
+
+        """
+        single = self.timeseries and not self.segmented
+        if self.timeseries:
+            if field is None:
+                raise ValueError("Must specify which field to scan for a "
+                                 "timeseries archive")
+            case_files = [(self.case_tuple(**case_kws),
+                           [paths, ] if single else paths)
+                          for case_kws, paths in self.walk_files(field)]
+        else:
+            case_files = [(self.case_tuple(**case_kws), paths)
+                          for case_kws, paths in self.walk_timeslices()]
+
+        def _scan(paths):
+            return [load_metadata(path) for path in paths]
+
+        pool, owned = get_executor("threads", max_workers)
+        try:
+            futures = [(case, pool.submit(_scan, paths))
+                       for case, paths in case_files]
+            schemas = OrderedDict()
+            for case, future in futures:
+                try:
+                    case_schemas = future.result()
+                except Exception as e:
+                    logger.warning("Could not read metadata for case %r (%s)"
+                                   % (case, e))
+                    continue
+                schemas[case] = case_schemas[0] if single else case_schemas
+        finally:
+            if owned:
+                pool.shutdown()
+
+        return schemas
+
+    def build_catalog(self, path, fields=None, max_workers=8):
+        """ Create (or incrementally refresh) a persistent catalog of the
+        files in this experiment's archive, and use it for discovering
+        files from now on.
+
+        Parameters
+        ----------
+        path : str
+            Location of the catalog's index file
+        fields : str or list of str (optional)
+            The fields to catalog, for timeseries archives. For timeslice
+            archives every file in each case's directory is catalogued.
+        max_workers : int
+            Maximum number of files to inspect concurrently
+
+        Returns
+        -------
+        catalog : experiment.catalog.Catalog
+
+        """
+        if (self.catalog is None) or (self.catalog.path != path):
+            self.catalog = Catalog(path)
+        self.catalog.refresh(self, fields, max_workers)
+        return self.catalog
+
+    @classmethod
+    def discover(cls, data_dir, cases, name=None, case_path=None,
+                 output_prefix="", output_suffix=".nc", timeseries=True,
+                 converters={}, **kwargs):
+        """ Create an Experiment by discovering its cases from the files in
+        its archive, rather than listing their values by hand.
+
+        The naming scheme is compiled into a regular expression, and the
+        archive is walked once, parsing the case values and field name out
+        of every file which matches it. If only some combinations of the
+        case values are found, the Experiment is given those as its
+        `valid_cases`. For timeseries archives, the fields found for each
+        case are recorded in the Experiment's `inventory`, an OrderedDict
+        mapping each field to the list of case tuples which have it.
+
+        Parameters
+        ----------
+        data_dir : str
+            Path to the directory containing the experiment's output
+        cases : list of str or Case namedtuples
+            The cases, in order. For any Case given with values, only those
+            values (and in that order) are kept; otherwise, every value
+            found is used, sorted.
+        name : str (optional)
+            The name of the experiment; by default, the name of `data_dir`
+        case_path, output_prefix, output_suffix, timeseries
+            The archive's naming scheme, as when creating an Experiment.
+            These must be format strings rather than functions.
+        converters : dict (optional)
+            Functions to convert the text parsed for particular cases into
+            their values, e.g. {'param': int}
+        **kwargs
+            Any additional arguments for creating the Experiment
+
+        Returns
+        -------
+        exp : experiment.Experiment
+
+        """
+        return discover_experiment(
+            cls, data_dir, cases, name=name, case_path=case_path,
+            output_prefix=output_prefix, output_suffix=output_suffix,
+            timeseries=timeseries, converters=converters, **kwargs
+        )
 
     # Properties and accessors
     @property
@@ -251,7 +517,8 @@ class Experiment(object):
 
     def all_cases(self):
         """ Return an iterable of all the ordered combinations of the
-        cases comprising this experiment.
+        cases comprising this experiment. If only a subset of the
+        combinations are valid, only those are returned.
 
         >>> for case in Experiment.all_cases():
         ...     print(case)
@@ -261,8 +528,79 @@ class Experiment(object):
         ('F1850', 'arg_min_smax')
 
         """
+        if self._case_list is not None:
+            return iter(self._case_list)
         return product(*self.all_case_vals())
 
+    @property
+    def is_sparse(self):
+        """ True if only a subset of the combinations of case values
+        exist in this experiment. """
+        return self._case_list is not None
+
+    def subset(self, **case_kws):
+        """ Return a view of this Experiment restricted to some of its case
+        values.
+
+        The view shares this Experiment's archive, naming scheme, catalog
+        and caches, but only spans the selected cases, so loading from it
+        (or building a master over it) only touches those cases.
+
+        Parameters
+        ----------
+        case_kws : dict
+            For any of the cases, either a single value or a list of values
+            to keep; cases which aren't mentioned keep all their values.
+            Values keep the order in which they're defined here.
+
+        Examples
+        --------
+        >>> exp.subset(emis='policy', model_config=['no_sun', 'no_clouds'])
+
+        """
+        unknown = [name for name in case_kws if name not in self._cases]
+        if unknown:
+            raise ValueError("Unknown case(s): {}".format(", ".join(unknown)))
+
+        case_data = OrderedDict()
+        for case in self._cases:
+            data = self._case_data[case]
+            if case in case_kws:
+                wanted = case_kws[case]
+                if not isinstance(wanted, (list, tuple, set)):
+                    wanted = [wanted, ]
+                missing = [val for val in wanted if val not in data.vals]
+                if missing:
+                    raise ValueError("Unknown value(s) for {}: {}".format(
+                        case, ", ".join(repr(val) for val in missing)
+                    ))
+                data = data._replace(vals=[val for val in data.vals
+                                           if val in wanted])
+            case_data[case] = data
+
+        sub = copy(self)
+        sub._case_data = case_data
+        sub._case_vals = OrderedDict(
+            (case, data.vals) for case, data in case_data.items()
+        )
+        sub._case_val_sets = [set(vals) for vals in sub.all_case_vals()]
+        if self._case_list is not None:
+            sub._case_list = [case for case in self._case_list
+                              if all(bit in vals for bit, vals in
+                                     zip(case, sub._case_val_sets))]
+            sub._case_set = set(sub._case_list)
+            sub._valid_cases = sub._case_list
+            if not sub._case_list:
+                raise ValueError("None of the valid cases match "
+                                 "{!r}".format(case_kws))
+        return sub
+
+    def _is_single_case(self, case_kws):
+        """ True if case keywords pick out exactly one case. """
+        return (set(case_kws) == set(self._cases)) and not any(
+            isinstance(val, (list, tuple, set)) for val in case_kws.values()
+        )
+
     def all_case_vals(self):
         """ Return a list of lists which contain all the values for
         each case.
@@ -299,7 +637,224 @@ class Experiment(object):
             experiment.
 
         """
-        return [fn for case, fn in self.walk_files(field) if case_kws == case] 
+        if set(case_kws) != set(self._cases):
+            return []
+        case_bits = tuple(self.get_case_bits(**case_kws))
+        if not self.has_case(*case_bits):
+            return []
+        if self.segmented:
+            return self._segment_files(field, case_bits)
+        return [self._file_path(field, case_bits), ]
+
+    def get_file_path(self, field, **case_kws):
+        """ Return the path to the file holding a given field for a fully
+        specified case.
+
+        Parameters
+        ----------
+        field : str
+            The name of the field to find the file for.
+        case_kws: dict
+            The dictionary of a particular set of key values for cases from this
+            experiment.
+
+        """
+        if self.segmented:
+            raise ValueError("{} has several files per case; use "
+                             "get_segment_files() instead".format(self.name))
+        return self._file_path(field, tuple(self.get_case_bits(**case_kws)))
+
+    def _file_path(self, field, case_bits):
+        """ Resolve (and memoize) the path to the file for a field and a
+        tuple of case values. """
+        templates = self._templates()
+
+        key = (field, case_bits)
+        path_to_file = self._path_cache.get(key)
+        if path_to_file is None:
+            path_to_file = self._render_files(field, [case_bits, ],
+                                              templates)[0]
+            self._path_cache.put(key, path_to_file)
+        return path_to_file
+
+    def _field_files(self, field, cases):
+        """ Return the path to the file for a field for each of a sequence
+        of case tuples or, for `segmented` archives, the list of its
+        files. """
+        if self.segmented:
+            return [self._segment_files(field, case_bits)
+                    for case_bits in cases]
+        return self._render_files(field, cases)
+
+    def _render_files(self, field, cases, templates=None):
+        """ Render the paths to the files for a field over a sequence of
+        case tuples. """
+        if templates is None:
+            templates = self._templates()
+        if templates.files is not None:
+            return templates.files.render_many(cases, field)
+
+        # Fall back on rendering each part of the path separately
+        case_path, prefix, suffix = templates[:3]
+        return [
+            os.path.join(self.data_dir, case_path.render(case_bits),
+                         prefix.render(case_bits) + field +
+                         suffix.render(case_bits))
+            for case_bits in cases
+        ]
+
+    def _templates(self):
+        """ Return the compiled templates for this experiment's naming
+        scheme, re-compiling them (and forgetting any memoized paths) if
+        the scheme has been changed. """
+        token = (self.data_dir, self._case_path,
+                 self.output_prefix, self.output_suffix)
+        if token == self._templates_token:
+            return self._compiled_templates
+        self._path_cache.clear()
+
+        if type(self).case_path is not Experiment.case_path:
+            # Respect subclasses which override how case paths are built
+            case_path_str = None
+            case_path = PathTemplate(self.case_path, self._cases)
+        else:
+            if self._case_path is None:
+                # Combine in the order that the cases were provided
+                case_path_str = os.path.join(
+                    *["{" + case + "}" for case in self._cases]
+                )
+            else:
+                case_path_str = self._case_path
+            case_path = PathTemplate(case_path_str, self._cases)
+        # The reserved {start}/{end} tokens mark archives with several files
+        # per case, and render as wildcards
+        segmented = bool(segment_tokens(self.output_prefix, self._cases) |
+                         segment_tokens(self.output_suffix, self._cases))
+        fill = [(START, WILDCARD), (END, WILDCARD)] if segmented else []
+        prefix = PathTemplate(self.output_prefix, self._cases, fill)
+        suffix = PathTemplate(self.output_suffix, self._cases, fill)
+
+        # If every part is a plain format string, fuse them into a single
+        # template for the full path to each file
+        files = None
+        if all(t.compiled for t in (case_path, prefix, suffix)):
+            files = PathTemplate(
+                os.path.join(escape(self.data_dir), case_path_str,
+                             self.output_prefix + "{" + FIELD + "}" +
+                             self.output_suffix),
+                self._cases + [FIELD, ], fill
+            )
+        segments = None
+        if segmented:
+            if files is None:
+                raise ValueError("Archives with several files per case must "
+                                 "be described by format strings")
+            segments = files.to_regex({START: DATE_PATTERN,
+                                       END: DATE_PATTERN})
+
+        self._compiled_templates = _Templates(case_path, prefix, suffix, files,
+                                              segments)
+        self._templates_token = token
+        return self._compiled_templates
+
+    @property
+    def segmented(self):
+        """ True if each case's output for a field is split across several
+        files, each covering a range of time marked by the reserved
+        `{start}` and/or `{end}` tokens in the output prefix or suffix. The
+        files for each case are found with `get_segment_files`, and
+        `walk_files` gives a list of them for every case. """
+        return self._templates().segments is not None
+
+    def get_segment_files(self, field, time=None, **case_kws):
+        """ Return the paths to the files holding a field for a case, in an
+        archive with several files per case, sorted in time order.
+
+        Parameters
+        ----------
+        field : str
+            The name of the field to find files for
+        time : slice or (start, end) pair (optional)
+            Only return the files which overlap this window of time; see
+            `experiment.segments.time_window`
+        case_kws : dict
+            The values of the case to find files for
+
+        """
+        window = None if time is None else time_window(time)
+        return self._segment_files(field, tuple(self.get_case_bits(**case_kws)),
+                                   window)
+
+    def _segment_files(self, field, case_bits, window=None):
+        """ Return the files for a field and case in time order, looking
+        them up in the catalog if it covers the field. """
+        catalog = self._catalog_for(field)
+        if catalog is None:
+            return self._glob_segment_files(field, case_bits, window)
+        templates = self._templates()
+        return sort_segments(catalog.case_files(case_bits, field),
+                             templates.segments, window)
+
+    def _catalog_for(self, field=None):
+        """ Return the attached catalog if it holds any files for a field
+        (or, for timeslice archives, any files at all); otherwise None, so
+        that fields which were never catalogued are found on disk. """
+        if (self.catalog is not None) and self.catalog.covers(field):
+            return self.catalog
+        return None
+
+    def _glob_segment_files(self, field, case_bits, window=None):
+        """ Find the files for a field and case on disk, ignoring any
+        catalog. """
+        templates = self._templates()
+        if templates.segments is None:
+            raise ValueError("{} doesn't have several files per "
+                             "case".format(self.name))
+        pattern = to_glob(templates.files.render(
+            tuple(case_bits) + (field, ) + markers()
+        ))
+        return find_segments(pattern, templates.segments, window)
+
+    def has_case(self, *case_bits):
+        """ Return True if the given case values (in the order the cases
+        are defined) correspond to a valid case in this experiment. """
+        if len(case_bits) != len(self._cases):
+            return False
+        if self._case_set is not None:
+            return case_bits in self._case_set
+        return all(bit in vals
+                   for bit, vals in zip(case_bits, self._case_val_sets))
+
+    def get_timeslice_files(self, **case_kws):
+        """ Return a sorted list of the timeslice files archived for a
+        particular case; these are all the files in the case's directory
+        which begin with its output prefix and end with its output suffix.
+
+        If this experiment has a catalog holding any timeslice files, they
+        are looked up there rather than on disk.
+
+        Parameters
+        ----------
+        case_kws: dict
+            The dictionary of a particular set of key values for cases from this
+            experiment.
+
+        """
+        catalog = self._catalog_for()
+        if catalog is not None:
+            return catalog.case_files(self.get_case_bits(**case_kws))
+        return self._glob_timeslice_files(**case_kws)
+
+    def _glob_timeslice_files(self, **case_kws):
+        """ Find the timeslice files for a case on disk, ignoring any
+        catalog (which is how a catalog itself is filled). """
+        pattern = os.path.join(
+            glob.escape(os.path.join(self.data_dir,
+                                     self.case_path(**case_kws))),
+            glob.escape(self.case_prefix(**case_kws)) + "*" +
+            glob.escape(self.case_suffix(**case_kws))
+        )
+        return sorted(glob.glob(pattern))
 
     def get_case_bits(self, **case_kws):
         """ Return the given case keywords in the order they're defined in
@@ -315,33 +870,22 @@ class Experiment(object):
         experiment, relative to this Experiment's data_dir.
 
         """
-        if self._case_path is None:
-            # Combine in the order that the cases were provided
-            bits = [case_kws[case] for case in self._cases]
-            return os.path.join(*bits)
-        elif callable(self._case_path):
-            return self._case_path(**case_kws)
-        else:
-            # Must be a string
-            return self._case_path.format(**case_kws)
+        return self._templates().case_path.render(
+            self.get_case_bits(**case_kws)
+        )
 
     def case_prefix(self, **case_kws):
         """ Return the output prefix for a given case. """
-        if callable(self.output_prefix):
-            return self.output_prefix(**case_kws)
-        else:
-            return self.output_prefix.format(**case_kws)
+        return self._templates().prefix.render(self.get_case_bits(**case_kws))
 
     def case_suffix(self, **case_kws):
         """ Return the output suffix for a given case. """
-        if callable(self.output_suffix):
-            return self.output_suffix(**case_kws)
-        else:
-            return self.output_suffix.format(**case_kws)
+        return self._templates().suffix.render(self.get_case_bits(**case_kws))
 
     # Loading methods
     def load(self, var, fix_times=False, master=False, preprocess=None,
-             load_kws={}, **case_kws):
+             load_kws={}, executor=None, max_workers=None, errors='warn',
+             chunks=None, time=None, isel=None, sel=None, **case_kws):
         """ Load a given variable from this experiment's output archive.
 
         Parameters
@@ -350,7 +894,8 @@ class Experiment(object):
             Either the name of a variable to load, or a Var instanced
             defining a specific output variable
         fix_times : logical
-            Fix times if they fall outside an acceptable calendar
+            Move each timestamp to the middle of its time bounds, and
+            re-base time units referenced to years before 1650
         master : logical
             Return a master dataset, with each case defined as a unique
             identifying dimension
@@ -360,90 +905,141 @@ class Experiment(object):
         load_kws : dict (optional)
             Additional keywords which will be passed to the timeslice/timeseries
             loading function.
+        executor : str or concurrent.futures.Executor (optional)
+            Open and pre-process the cases concurrently; either "threads",
+            "processes", or an existing Executor. By default, cases are loaded
+            serially. When using processes, `preprocess` must be picklable.
+        max_workers : int (optional)
+            Number of workers to use when `executor` is "threads" or
+            "processes"
+        errors : {'warn', 'raise'}
+            How to handle cases which fail to load. With 'warn', a warning is
+            logged and the case is left out of the returned data (or filled
+            with NaNs in a master dataset); with 'raise', a CaseLoadError
+            summarizing all the failed cases is raised once every case has
+            been attempted.
+        chunks : str or dict (optional)
+            How to chunk each case with dask: "auto", a target size per
+            chunk like "64MB", or a dict of per-dimension chunk sizes (which
+            may include "auto"). Chunks are aligned with each file's on-disk
+            chunking, and when building a master the same policy is applied
+            again across the case dimensions; see `experiment.chunking`.
+        time : slice or (start, end) pair (optional)
+            Only load this window of time, e.g. `slice("1990", "1999")`.
+            The ends of the window may be date strings, years or datetimes
+            and are both inclusive. For archives with several files per
+            case (see `segmented`), and for timeslice archives unless
+            `fix_times` is set, only the files which overlap the window
+            are opened.
+        isel, sel : dict (optional)
+            Only load a subset of the data, selected by position and/or
+            label along particular dimensions as with `Dataset.isel` and
+            `Dataset.sel`, e.g. `sel=dict(lat=slice(-30, 30))`.
         case_kws : dict (optional)
-            Additional keywords, which will be interpreted as a specific
-            case to load from the experiment.
+            Additional keywords, which will be interpreted as the case(s) to
+            load from the experiment. If a value is given for every case,
+            just that case's dataset is returned. Otherwise, only the cases
+            matching the values given - a single value or a list of values
+            for any of the cases - are loaded, and any master covers just
+            those cases; see `subset`.
 
         """
-        if self.timeseries:
-            return self._load_timeseries(var, fix_times, master, preprocess,
-                                         load_kws, **case_kws)
-        else:
-            return self._load_timeslice(var, fix_times, master, preprocess,
-                                        load_kws, **case_kws)
-
-    def _load_timeslice(self, var, fix_times=False, master=False, preprocess=None,
-                        load_kws={}, **case_kws):
-        raise NotImplementedError
+        from . loading import load
+        return load(self, var, fix_times=fix_times, master=master,
+                    preprocess=preprocess, load_kws=load_kws,
+                    executor=executor, max_workers=max_workers, errors=errors,
+                    chunks=chunks, time=time, isel=isel, sel=sel, **case_kws)
+
+    def iter_load(self, var, fix_times=False, preprocess=None, load_kws={},
+                  prefetch=2, errors='warn', chunks=None, time=None,
+                  isel=None, sel=None):
+        """ Lazily load a variable one case at a time.
+
+        Unlike `load`, which returns every case at once (keeping all of them
+        open, and alive in memory), this yields each case in turn. The next
+        `prefetch` cases are opened and pre-processed in a background thread
+        while the current one is being used, and each case's files are
+        closed as soon as the following case is requested, so no more than
+        `prefetch` + 1 cases are ever held at once.
 
-    def _load_timeseries(self, var, fix_times=False, master=False, preprocess=None,
-                         load_kws={}, **case_kws):
-        """ Load a timeseries dataset directly from the experiment output
-        archive.
-
-        See Also
+        Parameters
+        ----------
+        var : str or Var
+            Either the name of a variable to load, or a Var instance
+            defining a specific output variable
+        fix_times, preprocess, load_kws, chunks, time, isel, sel
+            As in `load`
+        prefetch : int
+            Number of cases to open ahead of the one being consumed
+        errors : {'warn', 'raise'}
+            How to handle cases which fail to load. With 'warn', a warning is
+            logged and the case is skipped; with 'raise', a CaseLoadError is
+            raised when the failed case is reached.
+
+        Yields
+        ------
+        case_tuple, dataset
+
+        Examples
         --------
-        Experiment.load : sentinel for loading data
+        >>> means = {}
+        >>> for case, ds in exp.iter_load('TS'):
+        ...     means[case] = ds['TS'].mean().values
 
         """
+        from . loading import iter_load
+        return iter_load(self, var, fix_times=fix_times,
+                         preprocess=preprocess, load_kws=load_kws,
+                         prefetch=prefetch, errors=errors, chunks=chunks,
+                         time=time, isel=isel, sel=sel)
+
+    def aload(self, var, fix_times=False, master=False, preprocess=None,
+              load_kws={}, executor=None, max_workers=None, max_open=8,
+              errors='warn', chunks=None, time=None, isel=None, sel=None,
+              **case_kws):
+        """ Coroutine version of `load`, for use inside an asyncio event
+        loop.
+
+        Files are opened (and pre-processed) on `executor` - a thread pool
+        by default - with at most `max_open` cases being loaded at once, so
+        that the event loop is never blocked. The other arguments are the
+        same as for `load`.
+
+        Examples
+        --------
+        >>> data = await exp.aload('TS', max_open=16)
 
-        is_var = not isinstance(var, basestring)
-        if is_var:
-            field = var.varname
-            is_var = True
-        else:
-            field = var
-
-        if case_kws:
-            # Load/return a single case
-            prefix = self.case_prefix(**case_kws)
-            suffix = self.case_suffix(**case_kws)
-
-            path_to_file = os.path.join(
-                self.data_dir,
-                self.case_path(**case_kws),
-                prefix + field + suffix,
-            )
-            logger.debug("{} - loading {} timeseries from {}".format(
-                self.name, field, path_to_file
-            ))
-            ds = load_variable(field, path_to_file, fix_times=fix_times, **load_kws)
-
-            if preprocess is not None:
-                ds = preprocess(ds, **case_kws)
-
-            return ds
-        else:
-
-            data = dict()
-
-            for case_kws, filename in self.walk_files(field):
-
-                try:
-                    ds = load_variable(field, filename, fix_times=fix_times, **load_kws)
-
-                    if preprocess is not None:
-                        ds = preprocess(ds, **case_kws)
-
-                    data[self.case_tuple(**case_kws)] = ds
-                except:
-                    logger.warn("Could not load case %r" % case_kws)
-                    data[self.case_tuple(**case_kws)] = xr.Dataset({field: np.nan})
-
-            if is_var:
-                var._data = data
-                var._loaded = True
-
-            if master:
-                ds_master = create_master(self, field, data)
-
-                if is_var:
-                    var.master = ds_master
-
-                data = ds_master
-
-            return data
+        """
+        from . aio import aload
+        return aload(self, var, fix_times=fix_times, master=master,
+                     preprocess=preprocess, load_kws=load_kws,
+                     executor=executor, max_workers=max_workers,
+                     max_open=max_open, errors=errors, chunks=chunks,
+                     time=time, isel=isel, sel=sel, **case_kws)
+
+    def aiter_load(self, var, fix_times=False, preprocess=None, load_kws={},
+                   executor=None, max_workers=None, max_open=4,
+                   errors='warn', chunks=None, time=None, isel=None,
+                   sel=None):
+        """ Asynchronous version of `iter_load`, yielding (case, dataset)
+        pairs as soon as each case finishes loading.
+
+        At most `max_open` cases are open at once, including the one being
+        consumed, and each is closed when the next is requested. The other
+        arguments are the same as for `iter_load`.
+
+        Examples
+        --------
+        >>> async for case, ds in exp.aiter_load('TS'):
+        ...     means[case] = ds['TS'].mean().values
 
+        """
+        from . aio import aiter_load
+        return aiter_load(self, var, fix_times=fix_times,
+                          preprocess=preprocess, load_kws=load_kws,
+                          executor=executor, max_workers=max_workers,
+                          max_open=max_open, errors=errors, chunks=chunks,
+                          time=time, isel=isel, sel=sel)
 
     def create_master(self, var, data=None, **kwargs):
         """ Convenience function to create a master dataset for a
@@ -458,6 +1054,10 @@ class Experiment(object):
         data : dict (optional, unless var is a string)
             Dictionary of dictionaries/dataset containing the variable data
             to be collected into a master dataset
+        kwargs : dict (optional)
+            Options for `experiment.convert.create_master`, and/or case
+            keywords selecting a subset of the cases to cover (see
+            `subset`)
 
         Returns
         -------
@@ -468,6 +1068,126 @@ class Experiment(object):
         return create_master(self, var, data, **kwargs)
 
 
+    def write_master(self, var, store, layout='dense', resume=True,
+                     executor='threads', max_workers=None, errors='warn',
+                     fix_times=False, preprocess=None, load_kws={}):
+        """ Write the master dataset for a variable to a Zarr store, so that
+        it can be quickly re-opened (with `open_master`) in later sessions.
+
+        The store is laid out along the case dimensions with one chunk per
+        case, and each case is loaded and written into its own region
+        independently, so cases are written concurrently and never all
+        held in memory at once. Cases are flagged in the store as they're
+        finished, so if writing is interrupted, calling this again picks
+        up where it left off. Requires the zarr package.
+
+        Parameters
+        ----------
+        var : str or Var
+            The variable to write
+        store : str or MutableMapping
+            The Zarr store (or path to it) to write to
+        layout : {'dense', 'stacked'}
+            How to lay out the cases; see `create_master`
+        resume : bool
+            If the store already exists, only write the cases which haven't
+            been written yet. Otherwise, the store is overwritten.
+        executor : str or concurrent.futures.Executor (optional)
+            Where to load and write the cases; "threads" by default
+        max_workers : int (optional)
+            Number of workers to use when `executor` is "threads"
+        errors : {'warn', 'raise'}
+            How to handle cases which fail to load or write; see `load`.
+            Failed cases are left unwritten, to be retried later.
+        fix_times, preprocess, load_kws
+            As in `load`
+
+        Returns
+        -------
+        The master dataset, lazily opened from the store
+
+        """
+        from . store import write_master
+        return write_master(self, var, store, layout=layout, resume=resume,
+                            executor=executor, max_workers=max_workers,
+                            errors=errors, fix_times=fix_times,
+                            preprocess=preprocess, load_kws=load_kws)
+
+    @staticmethod
+    def open_master(store, **kwargs):
+        """ Lazily open a master dataset saved with `write_master`.
+
+        Only the store's metadata is read. Any cases which haven't been
+        written are filled with NaNs and flagged by a `case_written`
+        coordinate. Additional keyword arguments are passed to
+        `xarray.open_zarr`.
+
+        """
+        from . store import open_master
+        return open_master(store, **kwargs)
+
+    def reduce(self, var, over, how='mean', q=None, ddof=0, skipna=True,
+               executor='threads', max_workers=None, errors='warn',
+               fix_times=False, preprocess=None, load_kws={}, time=None,
+               isel=None, sel=None, **case_kws):
+        """ Compute a statistic of a variable across some of the case
+        dimensions, without building a master dataset.
+
+        Each case is loaded, folded into a running summary for its group
+        (the cases sharing the values of every case dimension which isn't
+        being reduced over) and closed again, so only one case per worker
+        is ever held in memory alongside the summaries. Cases are reduced
+        concurrently, and their partial summaries merged as they finish.
+
+        Parameters
+        ----------
+        var : str or Var
+            The variable to reduce
+        over : str or list of str
+            The case dimension(s) to reduce over
+        how : {'mean', 'std', 'var', 'min', 'max', 'sum', 'count',
+               'quantile'}
+            The statistic to compute
+        q : float or list of floats (optional)
+            The quantile(s) to compute, with `how='quantile'`. Quantiles
+            come from a bounded sketch of each group, so they're exact for
+            groups of up to `experiment.reduce.SKETCH_SIZE` cases and close
+            approximations for larger ones; see `experiment.reduce.Sketch`.
+        ddof : int
+            Delta degrees of freedom for the variance and standard deviation
+        skipna : bool
+            Ignore NaNs, rather than letting them propagate
+        executor : str or concurrent.futures.Executor (optional)
+            Where to load and reduce the cases; "threads" by default
+        max_workers : int (optional)
+            Number of workers to use when `executor` is "threads" or
+            "processes"
+        errors : {'warn', 'raise'}
+            How to handle cases which fail to load; see `load`
+        fix_times, preprocess, load_kws, time, isel, sel
+            As in `load`
+        case_kws : dict (optional)
+            Only reduce the matching cases; see `subset`
+
+        Returns
+        -------
+        A Dataset of the statistic for each numeric variable, with a
+        dimension for each of the remaining cases (and for `quantile`, if
+        more than one was requested)
+
+        Examples
+        --------
+        >>> spread = exp.reduce('TS', over=['emis', 'param'], how='std')
+
+        """
+        from . reduce import reduce_cases
+        return reduce_cases(self, var, over, how=how, q=q, ddof=ddof,
+                            skipna=skipna, executor=executor,
+                            max_workers=max_workers, errors=errors,
+                            fix_times=fix_times, preprocess=preprocess,
+                            load_kws=load_kws, time=time, isel=isel, sel=sel,
+                            **case_kws)
+
     def master_to_datadict(self, data):
         """ Convert a master Dataset to a data dictionary containing separate
         Datasets for each case. """
@@ -514,12 +1234,16 @@ class Experiment(object):
         for case, data in self._case_data.items():
             case_dict[case] = dict(longname=data.longname, vals=data.vals)
 
-        return dict(
+        d = dict(
             name=self.name, cases=case_dict, timeseries=self.timeseries,
             case_path=self._case_path, output_prefix=self.output_prefix,
             output_suffix=self.output_suffix,
             data_dir=self.data_dir, validate_data=False
         )
+        if self.is_sparse:
+            d['valid_cases'] = [list(case) for case in self._case_list]
+
+        return d
 
 
     def to_yaml(self, path):
@@ -535,6 +1259,9 @@ class Experiment(object):
         if (callable(self.output_suffix) or callable(self.output_prefix)):
             raise ValueError("Cannot serialize function-based suffix/prefix "
                              "naming schemes as yaml")
+        if callable(self._valid_cases):
+            logger.info("Serializing the valid cases selected by function "
+                        "as an explicit list")
 
         d = self.to_dict()
 
@@ -543,7 +1270,7 @@ class Experiment(object):
 
 
     @classmethod
-    def from_yaml(cls, yaml_filename):
+    def from_yaml(cls, yaml_filename, catalog=None):
         """
         Create an Experiment from a YAML file.
 
@@ -579,6 +1306,10 @@ class Experiment(object):
         ----------
         yaml_filename: str
             The path to the YAML file encoding the Experiment to be created
+        catalog: str (optional)
+            The path to a catalog previously built with
+            `Experiment.build_catalog`. If given, the archive won't be
+            validated on disk; files will be discovered from the catalog.
 
         Returns
         -------
@@ -605,14 +1336,64 @@ class Experiment(object):
             logger.debug("      {}: {}".format(case_short, case_kws))
             cases.append(Case(case_short, **case_kws))
         exp_kwargs['cases'] = cases
+        if catalog is not None:
+            exp_kwargs['validate_data'] = False
 
         # Create and return the Experiment
         exp = cls(**exp_kwargs)
+        if catalog is not None:
+            exp.catalog = Catalog(catalog)
         logger.debug(exp)
 
         return exp
 
 
+    def enable_load_cache(self, max_bytes="1GB", cache_dir=None,
+                          format='netcdf'):
+        """ Memoize the cases returned by `load` (and its variants), so that
+        loading the same field with the same options and `preprocess`
+        function again is nearly instant.
+
+        Entries are keyed on the identity (path, size and modification time)
+        of each case's files, the loading options and a stable hash of the
+        `preprocess` function, so changing any of those invalidates them.
+        Cached cases are held in memory - so they're no longer lazy - up to
+        a total of `max_bytes`. Cases aren't cached when loading with
+        worker processes.
+
+        Parameters
+        ----------
+        max_bytes : int or str
+            Maximum total size of the cases to hold in memory, e.g. "2GB"
+        cache_dir : str (optional)
+            Directory in which to also save every cached case, so that the
+            cache persists between sessions
+        format : {'netcdf', 'zarr'}
+            How to save cases in `cache_dir`
+
+        Returns
+        -------
+        The new LoadCache; set `load_cache` to None to stop caching
+
+        """
+        self.load_cache = LoadCache(max_bytes, cache_dir, format)
+        return self.load_cache
+
+    def close(self):
+        """ Close every dataset which `load` has kept open for re-use.
+
+        Any data loaded from them lazily can still be used afterwards; the
+        files are simply re-opened as needed.
+
+        """
+        self._datasets.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def __repr__(self):
         base_str = "{} -".format(self.name)
         for case in self._cases:
@@ -623,6 +1404,23 @@ class Experiment(object):
         return base_str
 
 
+def _keyword_names(*funcs):
+    """ Return the names of all the arguments which can be passed to a set
+    of functions by keyword. """
+    names = set()
+    for func in funcs:
+        for param in signature(func).parameters.values():
+            if param.kind in (Parameter.POSITIONAL_OR_KEYWORD,
+                              Parameter.KEYWORD_ONLY):
+                names.add(param.name)
+    return frozenset(names)
+
+
+#: Options of `load` and `aload`, which would shadow any case of the same
+#: name passed to them as a keyword
+RESERVED_NAMES = _keyword_names(Experiment.load, Experiment.aload)
+
+
 class SingleCaseExperiment(Experiment):
     """ Special case of Experiment where only a single model run
     is to be analyzed.
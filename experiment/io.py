@@ -1,11 +1,53 @@
 
+import os
+
+from collections import OrderedDict, namedtuple
+
 import xarray as xr
 
 import logging
 logger = logging.getLogger()
 
+from . cache import LRUCache
+from . chunking import is_policy, rechunk, schema_chunks
+from . segments import time_slice
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+# The netCDF4/HDF5 libraries aren't thread-safe, so share xarray's lock
+# for them when reading headers directly
+try:
+    from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
+except ImportError:
+    from threading import Lock
+    NETCDF4_PYTHON_LOCK = Lock()
+
+#: Hack for Py2/3 basestring type compatibility
+if 'basestring' not in globals():
+    basestring = str
+
+#: Header information for a single variable in a file
+VariableSchema = namedtuple('VariableSchema', [
+    'name', 'dims', 'shape', 'dtype', 'chunks', 'attrs'
+])
+
+#: Header information for a file, as returned by `load_metadata`
+FileSchema = namedtuple('FileSchema', [
+    'path', 'dims', 'variables', 'time_units', 'time_calendar',
+    'time_start', 'time_end'
+])
+
+#: Schemas which have already been read, keyed by file identity
+_METADATA_CACHE = LRUCache(4096)
+
+
 def load_variable(var_name, path_to_file, squeeze=False,
-                  fix_times=True, **extr_kwargs):
+                  fix_times=False, variables=None, decode_cf=False,
+                  chunks=None, time=None, isel=None, sel=None,
+                  **extr_kwargs):
     """ Interface for loading an extracted variable into memory, using
     either iris or xarray. If `path_to_file` is instead a raw dataset,
     then the entire contents of the file will be loaded!
@@ -22,46 +64,444 @@ def load_variable(var_name, path_to_file, squeeze=False,
     fix_times : bool
         Correct the timestamps to the middle of the bounds
         in the variable metadata (CESM puts them at the right
-        boundary which sucks!)
+        boundary which sucks!). Off by default, as in `Experiment.load`.
+    variables : list of strings (optional)
+        Additional fields to load alongside `var_name`; implies `squeeze`.
+        Any other variables in the file (save for the coordinates and
+        bounds which these fields reference) are dropped before they're
+        ever decoded or chunked.
+    decode_cf : bool or dict
+        Decode the dataset according to CF conventions - applying any
+        scale/offset, masking fill values and converting times - after
+        it's been opened. Decoding is lazy, so no data is read until it's
+        computed and dask-backed variables (e.g. when passing `chunks`)
+        stay that way, decoded chunk-by-chunk. Pass a dict to forward
+        options (e.g. `use_cftime`) to `xarray.decode_cf`.
+    chunks : str or dict (optional)
+        How to chunk the data with dask. Either a policy - "auto", a target
+        size like "64MB", or a dict of per-dimension sizes which may include
+        "auto" - which is resolved into chunks aligned with the file's
+        on-disk chunking (see `experiment.chunking`), or anything else
+        accepted by `xarray.open_dataset`.
+    time : slice or (start, end) pair (optional)
+        Only load this window of time, e.g. `slice("1990", "1999")`; the
+        ends of the window may be date strings, years or datetimes.
+    isel, sel : dict (optional)
+        Only load a subset of the data, selected by position and/or label
+        along particular dimensions as with `Dataset.isel` and
+        `Dataset.sel`
     extr_kwargs : dict
         Additional keyword arguments to pass to the extractor
 
+    Any subset (`time`, `isel` or `sel`) is selected before the data is
+    chunked, so the dask chunks - and everything read from disk - only
+    cover the selected data.
+
     """
 
     logger.info("Loading %s from %s" % (var_name, path_to_file))
 
+    keep = [var_name, ] + list(variables or [])
+    if squeeze or (variables is not None):
+        schema = load_metadata(path_to_file)
+        drop = _unneeded_variables(schema.variables, keep)
+        drop.extend(extr_kwargs.pop('drop_variables', None) or [])
+        extr_kwargs['drop_variables'] = drop
+
+    if _has_subset(time, isel, sel):
+        # Open lazily but without dask, subset, and only then chunk
+        ds = xr.open_dataset(path_to_file, decode_cf=False, **extr_kwargs)
+        ds = _select(_postprocess(ds, fix_times, decode_cf), time, isel, sel)
+        if is_policy(chunks):
+            chunks = schema_chunks(chunks, load_metadata(path_to_file), keep,
+                                   ds)
+        return _chunk(ds, chunks)
+
+    if is_policy(chunks):
+        chunks = schema_chunks(chunks, load_metadata(path_to_file), keep)
+    if chunks is not None:
+        extr_kwargs['chunks'] = chunks
+
     ds = xr.open_dataset(path_to_file, decode_cf=False, **extr_kwargs)
 
-    # TODO: Revise this logic as part of generalizing time post-processing.
-    # Fix time unit, if necessary
-    # interval, timestamp = ds.time.units.split(" since ")
-    # timestamp = timestamp.split(" ")
-    # yr, mm, dy = timestamp[0].split("-")
-    #
-    # if int(yr) < 1650:
-    #     yr = 2001
-    # yr = str(yr)
-    #
-    # # Re-construct at Jan 01, 2001 and re-set
-    # timestamp[0] = "-".join([yr, mm, dy])
-    # new_units = " ".join([interval, "since"] + timestamp)
-    # ds.time.attrs['units'] = new_units
-
-    # TODO: Generalize time post-processing.
-    # if fix_times:
-    #     assert hasattr(ds, 'time_bnds')
-    #     bnds = ds.time_bnds.values
-    #     mean_times = np.mean(bnds, axis=1)
-    #
-    #     ds.time.values = mean_times
-
-    # Be pedantic and check that we don't have a "missing_value" attr
+    return _postprocess(ds, fix_times, decode_cf)
+
+
+def load_timeslice(var_names, paths, fix_times=False, concat_dim='time',
+                   decode_cf=False, chunks=None, time=None, isel=None,
+                   sel=None, **extr_kwargs):
+    """ Interface for lazily loading one or more fields from a sequence of
+    timeslice files, where each file holds a snapshot of every field in
+    the model output at one (or a few) times.
+
+    All the files are opened together as a single multi-file dataset,
+    concatenated along `concat_dim`. Only the requested fields and the
+    coordinates they depend on are kept from each file, so the data
+    belonging to the other fields is never read. The number of files
+    simultaneously held open is bounded by xarray's file cache (see the
+    `file_cache_maxsize` option of `xarray.set_options`).
+
+    Parameters
+    ----------
+    var_names : string or list of strings
+        The name(s) of the variable(s) to load
+    paths : list of strings
+        Locations of the timeslice files, in time order
+    fix_times : bool
+        Correct the timestamps to the middle of the bounds
+        in the variable metadata. Off by default.
+    concat_dim : string
+        Name of the record (time) dimension to concatenate along
+    decode_cf : bool or dict
+        Lazily decode the dataset according to CF conventions; see
+        `load_variable`
+    chunks : str or dict (optional)
+        How to chunk the data with dask; see `load_variable`. A policy is
+        applied to each file, and then again to the concatenated dataset,
+        so that neighbouring snapshots are merged into larger chunks.
+    time, isel, sel : optional
+        Only load a subset of the data; see `load_variable`. The subset is
+        selected before the concatenated dataset is re-chunked.
+    extr_kwargs : dict
+        Additional keyword arguments to pass to `xarray.open_mfdataset`
+
+    """
+    if isinstance(var_names, basestring):
+        var_names = [var_names, ]
+    paths = list(paths)
+    if not paths:
+        raise IOError("No files found for %r" % (var_names, ))
+
+    logger.info("Loading %s from %d timeslice files" %
+                (", ".join(var_names), len(paths)))
+
+    # Inspect the first file's header to figure out which variables can be
+    # skipped entirely when opening the rest
+    schema = load_metadata(paths[0])
+    drop = _unneeded_variables(schema.variables, var_names)
+
+    open_kws = dict(
+        combine='nested', concat_dim=concat_dim,
+        data_vars='minimal', coords='minimal', compat='override',
+        decode_cf=False, drop_variables=drop,
+    )
+    if is_policy(chunks):
+        open_kws['chunks'] = schema_chunks(chunks, schema, var_names)
+    elif chunks is not None:
+        open_kws['chunks'] = chunks
+    if schema.time_units is not None:
+        # Files may count time from different reference dates
+        open_kws['preprocess'] = _common_time_units(
+            schema.time_units, schema.time_calendar, concat_dim
+        )
+    if 'preprocess' in extr_kwargs:
+        open_kws['preprocess'] = _chain(open_kws.get('preprocess', None),
+                                        extr_kwargs.pop('preprocess'))
+    open_kws.update(extr_kwargs)
+    ds = xr.open_mfdataset(paths, **open_kws)
+    ds = _select(_postprocess(ds, fix_times, decode_cf), time, isel, sel)
+    if is_policy(chunks):
+        rechunked = rechunk(ds, chunks, var_names)
+        rechunked.set_close(ds.close)
+        ds = rechunked
+
+    return ds
+
+
+def _common_time_units(units, calendar, time_name='time'):
+    """ Return a function which re-expresses the raw (undecoded) times in a
+    Dataset - and their bounds - in the given units, if they differ, so
+    that files can be concatenated without decoding them. """
+    from xarray.coding.times import decode_cf_datetime, encode_cf_datetime
+
+    calendar = calendar or 'standard'
+
+    def _convert(ds):
+        if time_name not in ds.variables:
+            return ds
+        time = ds.variables[time_name]
+        old_units = time.attrs.get('units', None)
+        bounds = time.attrs.get('bounds', None)
+        if (old_units is None) or (old_units == units):
+            return ds
+        new_coords, new_vars = {}, {}
+        for name in [time_name, bounds]:
+            if name not in ds.variables:
+                continue
+            var = ds.variables[name]
+            var_units = var.attrs.get('units', old_units)
+            dates = decode_cf_datetime(var.values, var_units, calendar)
+            values, _, _ = encode_cf_datetime(dates, units, calendar)
+            attrs = dict(var.attrs)
+            if 'units' in attrs:
+                attrs['units'] = units
+            new = new_coords if name in ds.coords else new_vars
+            new[name] = xr.Variable(var.dims, values, attrs, var.encoding)
+        converted = ds.assign_coords(new_coords).assign(new_vars)
+        converted.set_close(ds.close)
+        return converted
+
+    return _convert
+
+
+def _chain(first, second):
+    """ Compose two Dataset pre-processing functions, either of which may
+    be None. """
+    if first is None:
+        return second
+    return lambda ds: second(first(ds))
+
+
+def _has_subset(time, isel, sel):
+    return (time is not None) or bool(isel) or bool(sel)
+
+
+def _select(ds, time=None, isel=None, sel=None, time_name='time'):
+    """ Select a subset of a freshly-opened Dataset: a window of `time`,
+    and then any positional (`isel`) or label-based (`sel`) selections.
+
+    If the times haven't been decoded, only the time coordinate itself is
+    decoded to find the window, which is then selected by position. """
+    if (time is not None) and (time_name in ds.dims):
+        window = time_slice(time)
+        index = ds.indexes[time_name]
+        units = ds.variables[time_name].attrs.get('units', '')
+        if (index.dtype.kind in 'iuf') and (' since ' in units):
+            index = xr.decode_cf(xr.Dataset(
+                coords={time_name: ds.variables[time_name]}
+            )).indexes[time_name]
+        ds = ds.isel({time_name: index.slice_indexer(window.start,
+                                                      window.stop)})
+    if isel:
+        ds = ds.isel(isel)
+    if sel:
+        ds = ds.sel(sel)
+    return ds
+
+
+def _chunk(ds, chunks):
+    """ Chunk a Dataset with dask, if asked to, so that closing the result
+    still closes the file(s) it came from. """
+    if chunks is None:
+        return ds
+    chunked = ds.chunk(chunks)
+    chunked.set_close(ds.close)
+    return chunked
+
+
+def _unneeded_variables(variables, var_names):
+    """ Given a mapping of a file's variables (to anything with `dims` and
+    `attrs`), return those which aren't needed to describe the requested
+    fields: anything other than the fields themselves, their dimension
+    coordinates, and any auxiliary coordinates or cell bounds they
+    reference. """
+    keep = set()
+    for name in var_names:
+        if name not in variables:
+            raise KeyError("Couldn't find field %r" % name)
+        field = variables[name]
+        keep.add(name)
+        keep.update(field.dims)
+        keep.update(field.attrs.get('coordinates', '').split())
+    for name in list(keep):
+        if name in variables:
+            bounds = variables[name].attrs.get('bounds', None)
+            if bounds is not None:
+                keep.add(bounds)
+    return [v for v in variables if v not in keep]
+
+
+def _postprocess(ds, fix_times, decode_cf=False):
+    """ Clean-up steps common to every freshly-opened (raw) Dataset. """
+
+    if fix_times:
+        ds = _fix_times(ds)
+
+    # Be pedantic and check that we don't have a "missing_value" attr; when
+    # decoding, it still marks the values to mask if there's no _FillValue
     for field in ds:
         if hasattr(ds[field], 'missing_value'):
-            del ds[field].attrs['missing_value']
+            missing_value = ds[field].attrs.pop('missing_value')
+            if decode_cf and ('_FillValue' not in ds[field].attrs):
+                ds[field].attrs['_FillValue'] = missing_value
 
-    # Lazy decode CF
-    # TODO: There's potentially a bug where decode_cf eagerly loads dask arrays
-    # ds = xr.decode_cf(ds)
+    if decode_cf:
+        ds = _decode_lazily(ds, {} if decode_cf is True else decode_cf)
 
     return ds
+
+
+def _fix_times(ds, time_name='time'):
+    """ Move the timestamps in a raw (undecoded) Dataset to the middle of
+    their bounds, and re-base any time units referenced to a year before
+    1650 to 2001.
+
+    CESM stamps each averaged record with the right-hand edge of its
+    interval, so e.g. a January mean is labeled as February 1st. Working
+    on the raw numeric offsets keeps this independent of the calendar, and
+    the midpoints are computed in a single vectorized operation over the
+    bounds. Since they become the new time index, the midpoints have to be
+    in memory, so the bounds themselves are read eagerly (with one compute,
+    if they're dask-backed and span several files); every other variable
+    is left untouched and stays lazy.
+
+    """
+    if time_name not in ds.variables:
+        return ds
+    time = ds.variables[time_name]
+    units = time.attrs.get('units', None)
+
+    bounds = time.attrs.get('bounds', None)
+    if bounds is None:
+        for name in ['time_bnds', 'time_bounds']:
+            if name in ds.variables:
+                bounds = name
+                break
+    if (bounds is not None) and (bounds in ds.variables):
+        bnds = ds.variables[bounds]
+        bnds_units = bnds.attrs.get('units', units)
+        if bnds_units != units:
+            logger.warning("Not fixing times - %s has units %r but %s has "
+                           "%r" % (bounds, bnds_units, time_name, units))
+        else:
+            bnds_dim = [d for d in bnds.dims if d != time_name][0]
+            # Index coordinates can't be lazy, so this reads the bounds
+            mid = bnds.mean(bnds_dim).values
+            fixed = ds.assign_coords({time_name: xr.Variable(
+                time.dims, mid, time.attrs, time.encoding
+            )})
+            # Closing the new Dataset should still close the file(s)
+            fixed.set_close(ds.close)
+            ds = fixed
+    else:
+        logger.debug("No time bounds found; leaving timestamps as-is")
+
+    # Re-base old time units, which many tools choke on
+    for name in [time_name, bounds]:
+        if (name in ds.variables) and ('units' in ds.variables[name].attrs):
+            attrs = ds.variables[name].attrs
+            attrs['units'] = _rebase_time_units(attrs['units'])
+    return ds
+
+
+def _rebase_time_units(units, min_year=1650, new_year=2001):
+    """ Replace the reference year of CF time units such as "days since
+    0001-01-01 00:00:00" with `new_year`, if it's before `min_year`. """
+    try:
+        interval, timestamp = units.split(" since ")
+    except ValueError:
+        return units
+    timestamp = timestamp.strip().split(" ")
+    date = timestamp[0].split("-")
+    try:
+        yr = int(date[0])
+    except ValueError:
+        return units
+    if (len(date) != 3) or (yr >= min_year):
+        return units
+
+    timestamp[0] = "-".join([str(new_year), ] + date[1:])
+    return " ".join([interval, "since"] + timestamp)
+
+
+def _decode_lazily(ds, decode_kws):
+    """ Decode a raw Dataset according to CF conventions without reading
+    its data.
+
+    `xarray.decode_cf` wraps each variable's (lazily-indexed or dask) data
+    in element-wise decoding functions rather than applying them, so the
+    scale/offset, masking and time conversion only happen as each chunk is
+    computed. The one exception is that inferring the type of decoded
+    times requires reading the first and last values of each time
+    variable, which are tiny compared to the fields themselves. """
+    return xr.decode_cf(ds, **decode_kws)
+
+
+def load_metadata(path_to_file, time_name='time'):
+    """ Read the structure of a file - its dimensions, and the dims,
+    shapes, dtypes, on-disk chunking and attributes of each variable -
+    without reading any of its data, save for the first and last
+    timestamps.
+
+    Results are cached by the file's path, size and modification time, so
+    repeated calls for unchanged files are free.
+
+    Parameters
+    ----------
+    path_to_file : string
+        Location of the file to inspect
+    time_name : string
+        Name of the time coordinate whose bounds should be recorded
+
+    Returns
+    -------
+    schema : FileSchema
+
+    """
+    st = os.stat(path_to_file)
+    key = (os.path.abspath(path_to_file), st.st_size, st.st_mtime)
+    schema = _METADATA_CACHE.get(key)
+    if schema is None:
+        logger.debug("Reading metadata from %s" % path_to_file)
+        if netCDF4 is not None:
+            schema = _netcdf4_metadata(path_to_file, time_name)
+        else:
+            schema = _xarray_metadata(path_to_file, time_name)
+        _METADATA_CACHE.put(key, schema)
+    return schema
+
+
+def _netcdf4_metadata(path_to_file, time_name):
+    """ Read a file's header directly with the netCDF4 library. """
+    with NETCDF4_PYTHON_LOCK, netCDF4.Dataset(path_to_file, 'r') as nc:
+        nc.set_auto_maskandscale(False)
+        dims = OrderedDict((name, len(dim))
+                           for name, dim in nc.dimensions.items())
+        variables = OrderedDict()
+        for name, v in nc.variables.items():
+            chunking = v.chunking()
+            chunks = None if chunking == 'contiguous' else tuple(chunking)
+            attrs = OrderedDict((attr, v.getncattr(attr))
+                                for attr in v.ncattrs())
+            variables[name] = VariableSchema(name, tuple(v.dimensions),
+                                             tuple(v.shape), v.dtype,
+                                             chunks, attrs)
+
+        time_bounds = (None, None)
+        if (time_name in nc.variables) and nc.variables[time_name].size:
+            time = nc.variables[time_name]
+            time_bounds = (time[0].item(), time[-1].item())
+    return _make_schema(path_to_file, dims, variables, time_name,
+                        time_bounds)
+
+
+def _xarray_metadata(path_to_file, time_name):
+    """ Read a file's header by lazily opening it with xarray. """
+    with xr.open_dataset(path_to_file, decode_cf=False) as ds:
+        dims = OrderedDict((name, int(size))
+                           for name, size in ds.sizes.items())
+        variables = OrderedDict()
+        for name, v in ds.variables.items():
+            chunks = v.encoding.get('chunksizes', None)
+            variables[name] = VariableSchema(
+                name, tuple(v.dims), tuple(v.shape), v.dtype,
+                None if chunks is None else tuple(chunks),
+                OrderedDict(v.attrs)
+            )
+
+        time_bounds = (None, None)
+        if (time_name in ds.variables) and ds[time_name].size:
+            time = ds.variables[time_name]
+            time_bounds = (time[0].values.item(), time[-1].values.item())
+    return _make_schema(path_to_file, dims, variables, time_name,
+                        time_bounds)
+
+
+def _make_schema(path_to_file, dims, variables, time_name, time_bounds):
+    time_attrs = {}
+    if time_name in variables:
+        time_attrs = variables[time_name].attrs
+    return FileSchema(path_to_file, dims, variables,
+                      time_attrs.get('units', None),
+                      time_attrs.get('calendar', None),
+                      time_bounds[0], time_bounds[1])
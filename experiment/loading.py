@@ -0,0 +1,332 @@
+"""
+Loading the cases of an Experiment.
+
+An Experiment knows where each case's files are; this is the machinery
+which opens them - one case at a time, all together on an executor, or
+lazily, one after another - pre-processes them, reports the cases which
+fail and, optionally, stacks the results into a master dataset.
+
+These are usually accessed through `Experiment.load` and
+`Experiment.iter_load`; the asyncio versions live in `experiment.aio`.
+
+"""
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from . import logger
+from . cache import _close
+from . convert import create_master
+from . io import load_metadata, load_timeslice, load_variable
+from . parallel import get_executor
+from . segments import time_window, times_overlap
+
+#: Hack for Py2/3 basestring type compatibility
+if 'basestring' not in globals():
+    basestring = str
+
+
+class CaseLoadError(Exception):
+    """ Raised when one or more cases in an Experiment couldn't be loaded.
+
+    Attributes
+    ----------
+    failures : OrderedDict
+        Mapping of case tuples to the exception raised while loading them
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        msg = "Couldn't load {} case(s): {}".format(
+            len(failures), ", ".join(repr(tuple(c)) for c in failures)
+        )
+        super(CaseLoadError, self).__init__(msg)
+
+
+def _load_case(loader, field, path_to_file, fix_times, preprocess, load_kws,
+               case_kws, datasets=None, cache=None):
+    """ Load and pre-process a single case; module-level so that it can be
+    shipped to a process pool. If a DatasetPool is given, the case's files
+    are opened through it, and if a LoadCache is given the result is
+    memoized in it. """
+    key = None
+    if cache is not None:
+        key = cache.key(loader, field, path_to_file, preprocess,
+                        fix_times=fix_times, **load_kws)
+        if key is not None:
+            ds = cache.get(key)
+            if ds is not None:
+                return ds
+
+    if datasets is None:
+        ds = loader(field, path_to_file, fix_times=fix_times, **load_kws)
+    else:
+        ds = datasets.open(loader, field, path_to_file, fix_times=fix_times,
+                           **load_kws)
+
+    if preprocess is not None:
+        ds = preprocess(ds, **case_kws)
+
+    if key is not None:
+        ds = cache.put(key, ds)
+
+    return ds
+
+
+def _loader_kws(load_kws, chunks=None, time=None, isel=None, sel=None):
+    """ Fold the chunking and subsetting options of a load into the
+    keywords passed to the loader; subsets are selected as each file is
+    opened, before it's chunked. """
+    subset = dict((key, value) for key, value in
+                  [('chunks', chunks), ('time', time), ('isel', isel),
+                   ('sel', sel)]
+                  if value is not None)
+    if subset:
+        load_kws = dict(load_kws, **subset)
+    return load_kws
+
+
+def _check_errors(errors):
+    if errors not in ('warn', 'raise'):
+        raise ValueError("`errors` must be one of 'warn' or 'raise'")
+
+
+def load(exp, var, fix_times=False, master=False, preprocess=None,
+         load_kws={}, executor=None, max_workers=None, errors='warn',
+         chunks=None, time=None, isel=None, sel=None, **case_kws):
+    """ Load a variable from an Experiment's output archive; the arguments
+    are as in `Experiment.load`. """
+    if case_kws and not exp._is_single_case(case_kws):
+        # Load just the matching cases
+        exp = exp.subset(**case_kws)
+        case_kws = {}
+    _check_errors(errors)
+    load_kws = _loader_kws(load_kws, chunks, time, isel, sel)
+    field = var if isinstance(var, basestring) else var.varname
+
+    if case_kws:
+        # Load/return a single case
+        loader, paths = case_files(exp, field, time, fix_times, case_kws)
+        return _load_case(loader, field, paths, fix_times, preprocess,
+                          load_kws, case_kws, exp._datasets, exp.load_cache)
+
+    loader, sources, exists = case_sources(exp, field, time, fix_times)
+    return load_all(exp, var, field, loader, sources, fix_times, master,
+                    preprocess, load_kws, executor, max_workers, errors,
+                    exists)
+
+
+def case_files(exp, field, time=None, fix_times=False, case_kws={}):
+    """ Return the loader to use for a field, and the file(s) to pass it
+    for a single case; see `case_sources`. """
+    if exp.timeseries and exp.segmented:
+        paths = exp.get_segment_files(field, time, **case_kws)
+        logger.debug("{} - loading {} timeseries from {} files".format(
+            exp.name, field, len(paths)
+        ))
+        return load_timeslice, paths
+    elif exp.timeseries:
+        path_to_file = exp.get_file_path(field, **case_kws)
+        logger.debug("{} - loading {} timeseries from {}".format(
+            exp.name, field, path_to_file
+        ))
+        return load_variable, path_to_file
+    else:
+        paths = exp.get_timeslice_files(**case_kws)
+        if (time is not None) and not fix_times:
+            paths = _timeslices_within(exp, paths, time_window(time))
+        logger.debug("{} - loading {} from {} timeslices".format(
+            exp.name, field, len(paths)
+        ))
+        return load_timeslice, paths
+
+
+def case_sources(exp, field, time=None, fix_times=False):
+    """ Return the loader to use for a field, the (case_kws, files) to
+    pass it for every case, and - if the attached catalog covers the
+    field - a predicate telling whether a case's files are known to
+    exist.
+
+    With several files per case, only those overlapping the window of
+    `time` are used: for segmented archives this is judged from their
+    names, and for timeslice archives from the times recorded in the
+    catalog or, failing that, in each file's header. Timeslices aren't
+    skipped if `fix_times` is set, since it moves their timestamps. """
+    exists = None
+    if exp.timeseries and exp.segmented:
+        window = None if time is None else time_window(time)
+        sources = ((exp.get_case_kws(*case_bits),
+                    exp._segment_files(field, case_bits, window))
+                   for case_bits in exp.all_cases())
+        return load_timeslice, sources, exists
+    elif exp.timeseries:
+        catalog = exp._catalog_for(field)
+        if catalog is not None:
+            exists = catalog.paths(field).__contains__
+        return load_variable, exp.walk_files(field), exists
+    else:
+        if exp._catalog_for() is not None:
+            exists = bool
+        sources = exp.walk_timeslices()
+        if (time is not None) and not fix_times:
+            window = time_window(time)
+            sources = ((case_kws, _timeslices_within(exp, paths, window))
+                       for case_kws, paths in sources)
+        return load_timeslice, sources, exists
+
+
+def _timeslices_within(exp, paths, window):
+    """ Return just those timeslice files with any times in a window from
+    `time_window`, judging each by the times recorded in the catalog, if
+    it's there, or else by its header. """
+    catalog = exp._catalog_for()
+    kept = []
+    for path in paths:
+        record = None if catalog is None else catalog.lookup(path)
+        if record is None:
+            record = load_metadata(path)
+        if times_overlap(record.time_start, record.time_end,
+                         record.time_units, record.time_calendar, window):
+            kept.append(path)
+    return kept
+
+
+def shared_state(exp, pool):
+    """ Return the DatasetPool and LoadCache to use when loading on a given
+    executor; worker processes can't share them. """
+    if isinstance(pool, ProcessPoolExecutor):
+        return None, None
+    return exp._datasets, exp.load_cache
+
+
+def load_all(exp, var, field, loader, sources, fix_times, master,
+             preprocess, load_kws, executor, max_workers, errors,
+             exists=None):
+    """ Load every case of a variable, given the files to read for each,
+    and optionally combine them into a master dataset. If provided,
+    `exists` is used to skip cases whose files are known to be missing
+    without touching the filesystem. """
+
+    data = OrderedDict()
+    failures = OrderedDict()
+
+    pool, owned = get_executor(executor, max_workers)
+    datasets, cache = shared_state(exp, pool)
+    try:
+        futures = OrderedDict()
+        for case_kws, filename in sources:
+            case = exp.case_tuple(**case_kws)
+            if (exists is not None) and not exists(filename):
+                logger.warning("Could not load case %r (not in catalog)"
+                               % (case, ))
+                failures[case] = IOError("No files catalogued for %r" %
+                                         (case, ))
+                continue
+            futures[case] = pool.submit(
+                _load_case, loader, field, filename, fix_times,
+                preprocess, load_kws, case_kws, datasets, cache
+            )
+
+        # Collect in case order, regardless of completion order
+        for case, future in futures.items():
+            try:
+                data[case] = future.result()
+            except Exception as e:
+                logger.warning("Could not load case %r (%s)" % (case, e))
+                failures[case] = e
+    finally:
+        if owned:
+            pool.shutdown()
+
+    return finish_load(exp, var, field, data, failures, master, errors,
+                       load_kws)
+
+
+def finish_load(exp, var, field, data, failures, master, errors, load_kws):
+    """ Report any failed cases, attach the loaded data to `var` (if it's a
+    Var) and optionally build the master dataset. """
+
+    is_var = not isinstance(var, basestring)
+
+    if failures and (errors == 'raise'):
+        raise CaseLoadError(failures)
+
+    if is_var:
+        var._data = data
+        var._loaded = True
+
+    if master:
+        ds_master = create_master(exp, field, data,
+                                  chunks=load_kws.get('chunks', None))
+
+        if is_var:
+            var.master = ds_master
+
+        data = ds_master
+
+    return data
+
+
+def iter_load(exp, var, fix_times=False, preprocess=None, load_kws={},
+              prefetch=2, errors='warn', chunks=None, time=None, isel=None,
+              sel=None):
+    """ Lazily load a variable one case at a time, yielding (case_tuple,
+    dataset) pairs; the arguments are as in `Experiment.iter_load`. """
+    _check_errors(errors)
+    if prefetch < 1:
+        raise ValueError("`prefetch` must be at least 1")
+    load_kws = _loader_kws(load_kws, chunks, time, isel, sel)
+
+    field = var if isinstance(var, basestring) else var.varname
+    loader, sources, exists = case_sources(exp, field, time, fix_times)
+    return _iter_cases(exp, field, loader, iter(sources), exists, fix_times,
+                       preprocess, load_kws, prefetch, errors)
+
+
+def _iter_cases(exp, field, loader, sources, exists, fix_times, preprocess,
+                load_kws, prefetch, errors):
+    pool, _ = get_executor("threads", 1)
+    pending = deque()
+
+    def _submit_next():
+        for case_kws, filename in sources:
+            case = exp.case_tuple(**case_kws)
+            if (exists is not None) and not exists(filename):
+                future = Future()
+                future.set_exception(
+                    IOError("No files catalogued for %r" % (case, ))
+                )
+            else:
+                future = pool.submit(_load_case, loader, field, filename,
+                                     fix_times, preprocess, load_kws,
+                                     case_kws, None, exp.load_cache)
+            pending.append((case, future))
+            return True
+        return False
+
+    ds = None
+    try:
+        while (len(pending) < prefetch) and _submit_next():
+            pass
+        while pending:
+            case, future = pending.popleft()
+            _submit_next()
+            try:
+                ds = future.result()
+            except Exception as e:
+                if errors == 'raise':
+                    raise CaseLoadError(OrderedDict([(case, e)]))
+                logger.warning("Could not load case %r (%s)" % (case, e))
+                continue
+
+            yield case, ds
+            _close(ds)
+            ds = None
+    finally:
+        # Clean up anything still open if we stopped early
+        _close(ds)
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown()
+        for _, future in pending:
+            if not future.cancelled() and (future.exception() is None):
+                _close(future.result())
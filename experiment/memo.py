@@ -0,0 +1,294 @@
+"""
+Memoization of loaded (and pre-processed) cases.
+
+Re-running an analysis usually means loading the same fields, from the
+same files, with the same pre-processing, over and over again. A LoadCache
+remembers the result for each case, keyed on
+
+- the identity of the case's files (their paths, sizes and modification
+  times), so editing or replacing a file invalidates its entries;
+- the loader, field and loading options; and
+- a stable hash of the `preprocess` function, derived from its code,
+  constants, default arguments, closure and, for bound methods, instance -
+  and, recursively, those of any global helper functions it calls - rather than its address in
+  memory, so it's the same from one session to the next.
+
+Results are held in memory up to a total size in bytes, evicting the least
+recently used, and can optionally be written through to a cache directory
+(as netCDF, or Zarr if it's installed and requested) so they survive
+between sessions.
+
+"""
+import os
+import shutil
+import tempfile
+
+from functools import partial
+from inspect import ismethod
+from types import CodeType, FunctionType, ModuleType
+
+import xarray as xr
+
+from dask.base import tokenize
+from dask.utils import parse_bytes
+
+from . import logger
+from . cache import LRUCache
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+#: Hack for Py2/3 basestring type compatibility
+if 'basestring' not in globals():
+    basestring = str
+
+
+def _code_token(code):
+    """ Summarize a code object by its bytecode, names and constants,
+    recursing into any nested functions. """
+    consts = tuple(_code_token(c) if isinstance(c, CodeType) else repr(c)
+                   for c in code.co_consts)
+    return (code.co_code, code.co_names, code.co_varnames, consts)
+
+
+def _code_names(code):
+    """ Return every global (or attribute) name referenced by a code
+    object, including from any nested functions. """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names.update(_code_names(const))
+    return names
+
+
+def _value_token(value, seen):
+    """ Summarize a global or closed-over value, following functions into
+    their own code and globals. """
+    if isinstance(value, (FunctionType, partial)):
+        return function_token(value, seen)
+    if isinstance(value, ModuleType):
+        # Changes inside other modules aren't tracked
+        return 'module', value.__name__
+    if isinstance(value, type):
+        return 'type', value.__module__, value.__qualname__
+    return tokenize(value)
+
+
+def function_token(func, _seen=None):
+    """ Return a hash of a function which is stable across sessions, and
+    changes whenever its code, constants, default arguments, the values it
+    closes over or the module globals it refers to do. Global functions
+    are followed into their own code, so editing a helper which
+    `func` calls also changes its token; modules it uses are only
+    identified by name. For bound methods, the instance (or class) they're
+    bound to is part of the token too.
+
+    """
+    if func is None:
+        return None
+    if _seen is None:
+        _seen = set()
+    if isinstance(func, partial):
+        return tokenize('partial', function_token(func.func, _seen),
+                        func.args, sorted(func.keywords.items()))
+
+    code = getattr(func, '__code__', None)
+    if code is None:
+        # Builtins, callable objects and the like
+        return tokenize(getattr(func, '__module__', None),
+                        getattr(func, '__qualname__', None), func)
+
+    name = getattr(func, '__qualname__', func.__name__)
+    if id(func) in _seen:
+        # Recursive functions
+        return tokenize(func.__module__, name)
+    _seen.add(id(func))
+
+    closure = [_value_token(cell.cell_contents, _seen)
+               for cell in (func.__closure__ or ())]
+    func_globals = getattr(func, '__globals__', {})
+    referenced = [(ref, _value_token(func_globals[ref], _seen))
+                  for ref in sorted(_code_names(code))
+                  if ref in func_globals]
+    bound = _value_token(func.__self__, _seen) if ismethod(func) else None
+    return tokenize(func.__module__, name, _code_token(code),
+                    func.__defaults__, getattr(func, '__kwdefaults__', None),
+                    closure, referenced, bound)
+
+
+#: Attribute recording which variables were saved still CF-encoded
+_RAW_ATTR = '_experiment_raw_variables'
+
+#: Attributes which CF decoding would act upon
+_CF_ATTRS = ('scale_factor', 'add_offset', '_FillValue', 'missing_value',
+             'coordinates')
+
+
+def _is_raw(var):
+    """ True if a variable still carries CF encoding in its attributes (i.e.
+    it was loaded without decoding), so that decoding it when reading it
+    back from the cache would change it. """
+    if any(attr in var.attrs for attr in _CF_ATTRS):
+        return True
+    return ' since ' in str(var.attrs.get('units', ''))
+
+
+def _to_disk(ds, path, format):
+    raw = [name for name, var in ds.variables.items() if _is_raw(var)]
+    ds = ds.copy()
+    ds.attrs[_RAW_ATTR] = " ".join(raw)
+    for name in raw:
+        # Don't let xarray add a default fill value to raw variables
+        if '_FillValue' not in ds.variables[name].attrs:
+            ds.variables[name].encoding['_FillValue'] = None
+    if format == 'zarr':
+        ds.to_zarr(path)
+    else:
+        ds.to_netcdf(path)
+
+
+def _from_disk(path, format):
+    """ Re-open a cached dataset, decoding only those variables which were
+    decoded when it was saved. """
+    if format == 'zarr':
+        ds = xr.open_zarr(path, decode_cf=False)
+    else:
+        ds = xr.open_dataset(path, decode_cf=False)
+    raw = ds.attrs.pop(_RAW_ATTR, "").split()
+    decoded = xr.decode_cf(ds.drop_vars(raw))
+    decoded.set_close(ds.close)
+    return decoded.assign_coords(
+        dict((name, ds.variables[name]) for name in raw if name in ds.coords)
+    ).assign(
+        dict((name, ds.variables[name]) for name in raw
+             if name not in ds.coords)
+    )
+
+
+def _file_identity(paths):
+    if isinstance(paths, basestring):
+        paths = [paths, ]
+    identity = []
+    for path in paths:
+        st = os.stat(path)
+        identity.append((os.path.abspath(path), st.st_size, st.st_mtime))
+    return identity
+
+
+class LoadCache(object):
+    """ A cache of loaded cases, in memory and optionally on disk.
+
+    Parameters
+    ----------
+    max_bytes : int or str
+        Maximum total size of the datasets held in memory, e.g. "2GB".
+        Datasets larger than this are never held in memory.
+    cache_dir : str (optional)
+        Directory in which to also save every cached dataset
+    format : {'netcdf', 'zarr'}
+        How to save datasets in `cache_dir`
+
+    """
+
+    def __init__(self, max_bytes="1GB", cache_dir=None, format='netcdf'):
+        if isinstance(max_bytes, basestring):
+            max_bytes = parse_bytes(max_bytes)
+        if format not in ('netcdf', 'zarr'):
+            raise ValueError("`format` must be one of 'netcdf' or 'zarr'")
+        if (format == 'zarr') and (zarr is None):
+            raise ImportError("Caching to Zarr requires the zarr package")
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.format = format
+        self._memory = LRUCache(max_bytes, sizeof=lambda ds: ds.nbytes)
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, loader, field, paths, preprocess=None, **options):
+        """ Compute the key for a case, or None if its files can't be
+        found. """
+        try:
+            identity = _file_identity(paths)
+        except OSError:
+            return None
+        return tokenize(getattr(loader, '__name__', repr(loader)), field,
+                        identity, sorted(options.items()),
+                        function_token(preprocess))
+
+    def _path(self, key):
+        ext = '.zarr' if self.format == 'zarr' else '.nc'
+        return os.path.join(self.cache_dir, key + ext)
+
+    def get(self, key):
+        """ Return a copy of the dataset cached under `key`, or None. """
+        ds = self._memory.get(key)
+        if ds is not None:
+            return ds.copy()
+        if self.cache_dir is None:
+            return None
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        logger.debug("Reading cached case from %s" % path)
+        ds = _from_disk(path, self.format)
+        if ds.nbytes <= self.max_bytes:
+            with ds:
+                ds = ds.load()
+            self._memory.put(key, ds)
+            ds = ds.copy()
+        return ds
+
+    def put(self, key, ds):
+        """ Cache a dataset under `key`, returning the copy to use in its
+        place (which is in memory, if it fits). """
+        if ds.nbytes <= self.max_bytes:
+            ds = ds.load()
+            self._memory.put(key, ds)
+        if self.cache_dir is not None:
+            self._save(key, ds)
+        return ds.copy()
+
+    def _save(self, key, ds):
+        """ Save a dataset to the cache directory, atomically. """
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        tmp = tempfile.mkdtemp(dir=self.cache_dir)
+        tmp_path = os.path.join(tmp, os.path.basename(path))
+        try:
+            _to_disk(ds, tmp_path, self.format)
+            os.rename(tmp_path, path)
+        except Exception as e:
+            logger.warning("Couldn't save case to cache (%s)" % e)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def clear(self, disk=False):
+        """ Empty the in-memory cache and, optionally, the cache
+        directory. """
+        self._memory.clear()
+        if disk and (self.cache_dir is not None):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.nc') or name.endswith('.zarr'):
+                    path = os.path.join(self.cache_dir, name)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+
+    @property
+    def nbytes(self):
+        """ Total size of the datasets held in memory. """
+        return self._memory.total
+
+    def __len__(self):
+        return len(self._memory)
+
+    def __repr__(self):
+        return "LoadCache({} in memory, {} bytes{})".format(
+            len(self), self.nbytes,
+            "" if self.cache_dir is None else ", " + self.cache_dir
+        )
@@ -0,0 +1,58 @@
+"""
+Helpers for running per-case work concurrently.
+
+Most of the expensive operations on an Experiment (opening files,
+pre-processing datasets) are independent from one case to the next, so
+they can be farmed out to a `concurrent.futures` executor. These helpers
+normalize the different ways a user can ask for that.
+
+"""
+from concurrent.futures import (Executor, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+
+
+class SerialExecutor(Executor):
+    """ Trivial Executor which runs every submitted call immediately in
+    the calling thread. Used so that serial and concurrent code paths can
+    share the same submit/result logic. """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        return future
+
+
+def get_executor(executor=None, max_workers=None):
+    """ Resolve a user-supplied executor specification.
+
+    Parameters
+    ----------
+    executor : str or concurrent.futures.Executor (optional)
+        Either None (run serially), "threads", "processes", or an
+        already-constructed Executor instance.
+    max_workers : int (optional)
+        Number of workers to use when creating a new pool
+
+    Returns
+    -------
+    A tuple of the Executor to use and a flag indicating whether or not
+    the caller owns it (and should shut it down when finished).
+
+    """
+    if executor is None:
+        return SerialExecutor(), False
+    elif isinstance(executor, Executor):
+        return executor, False
+    elif executor == "threads":
+        return ThreadPoolExecutor(max_workers=max_workers), True
+    elif executor == "processes":
+        return ProcessPoolExecutor(max_workers=max_workers), True
+    else:
+        raise ValueError("Couldn't interpret executor {!r}; expected None, "
+                         "'threads', 'processes' or an Executor "
+                         "instance".format(executor))
@@ -0,0 +1,441 @@
+"""
+Out-of-core reductions across the cases of an Experiment.
+
+Ensemble statistics - the mean, spread or extremes of a field across some
+of the case dimensions - would normally mean building a master dataset and
+reducing over its case dimensions, which needs every case at once. Here,
+each case is instead loaded on its own and folded into a running
+accumulator for its group (the cases which share the values of every case
+dimension *not* being reduced over), then closed.
+
+Cases are reduced in parallel: each is turned into a small partial result
+on a worker, and the partial results are merged as they finish. Means and
+variances are accumulated with Welford's algorithm and merged with Chan et
+al.'s pairwise update, so the results don't depend on the order in which
+cases finish and don't suffer from the cancellation of the naive
+sum-of-squares formula. Minima, maxima, sums and counts merge trivially.
+
+Quantiles use a sketch of each element's distribution instead: up to
+`SKETCH_SIZE` members of a group are kept exactly, and beyond that
+neighbouring values are merged into weighted centroids (keeping the exact
+minimum and maximum). So quantiles are exact for small groups and close
+approximations for large ones, and memory stays bounded however many
+cases there are.
+
+"""
+from collections import OrderedDict
+from concurrent.futures import as_completed
+
+import numpy as np
+import xarray as xr
+
+from . import logger
+from . cache import _close
+from . loading import (CaseLoadError, _load_case, _loader_kws, case_sources,
+                       shared_state)
+from . parallel import get_executor
+
+#: Hack for Py2/3 basestring type compatibility
+if 'basestring' not in globals():
+    basestring = str
+
+#: Number of values kept for each element by a quantile Sketch
+SKETCH_SIZE = 100
+
+
+class Accumulator(object):
+    """ Running, mergeable summary of the values of an array across a
+    sequence of cases.
+
+    Parameters
+    ----------
+    how : str
+        The statistic to compute
+    skipna : bool
+        Ignore NaNs, rather than letting them propagate
+
+    """
+
+    def __init__(self, how, skipna=True):
+        self.how = how
+        self.skipna = skipna
+
+    def add(self, values):
+        """ Fold the values from a single case into the summary. """
+        raise NotImplementedError
+
+    def merge(self, other):
+        """ Fold another summary (of different cases) into this one. """
+        raise NotImplementedError
+
+    def result(self, **kwargs):
+        """ Compute the statistic for the cases seen so far. """
+        raise NotImplementedError
+
+
+class Moments(Accumulator):
+    """ Count, mean and sum of squared deviations, for the mean, variance,
+    standard deviation and count. """
+
+    def __init__(self, how, skipna=True):
+        super(Moments, self).__init__(how, skipna)
+        self.count = self.mean = self.m2 = None
+
+    def add(self, values):
+        values = np.asarray(values, dtype='f8')
+        if self.skipna:
+            valid = ~np.isnan(values)
+        else:
+            valid = np.ones(values.shape, dtype=bool)
+        if self.count is None:
+            self.count = np.zeros(values.shape, dtype='i8')
+            self.mean = np.zeros(values.shape)
+            self.m2 = np.zeros(values.shape)
+
+        self.count += valid
+        with np.errstate(invalid='ignore'):
+            delta = np.where(valid, values - self.mean, 0.)
+            self.mean += delta / np.maximum(self.count, 1)
+            self.m2 += delta * np.where(valid, values - self.mean, 0.)
+
+    def merge(self, other):
+        if other.count is None:
+            return
+        if self.count is None:
+            self.count, self.mean, self.m2 = \
+                other.count.copy(), other.mean.copy(), other.m2.copy()
+            return
+
+        count = self.count + other.count
+        n = np.maximum(count, 1)
+        with np.errstate(invalid='ignore'):
+            delta = other.mean - self.mean
+            self.mean = self.mean + delta * (other.count / n)
+            self.m2 = self.m2 + other.m2 + \
+                delta ** 2 * (self.count * other.count / n)
+        self.count = count
+
+    def result(self, ddof=0, **kwargs):
+        if self.how == 'count':
+            return self.count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.how == 'mean':
+                return np.where(self.count > 0, self.mean, np.nan)
+            var = np.where(self.count > ddof,
+                           self.m2 / (self.count - ddof), np.nan)
+        return np.sqrt(var) if self.how == 'std' else var
+
+
+class Extreme(Accumulator):
+    """ Running minimum or maximum. """
+
+    def __init__(self, how, skipna=True):
+        super(Extreme, self).__init__(how, skipna)
+        if how == 'min':
+            self._op = np.fmin if skipna else np.minimum
+        else:
+            self._op = np.fmax if skipna else np.maximum
+        self.value = None
+
+    def add(self, values):
+        values = np.asarray(values)
+        if values.dtype.kind in 'iub':
+            values = values.astype('f8')
+        if self.value is None:
+            self.value = values.copy()
+        else:
+            self.value = self._op(self.value, values)
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+
+    def result(self, **kwargs):
+        return self.value
+
+
+class Total(Accumulator):
+    """ Running sum. """
+
+    def __init__(self, how, skipna=True):
+        super(Total, self).__init__(how, skipna)
+        self.value = None
+
+    def add(self, values):
+        values = np.asarray(values, dtype='f8')
+        if self.skipna:
+            values = np.where(np.isnan(values), 0., values)
+        if self.value is None:
+            self.value = values.copy()
+        else:
+            self.value = self.value + values
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+
+    def result(self, **kwargs):
+        return self.value
+
+
+class Sketch(Accumulator):
+    """ Bounded summary of the distribution of each element, for
+    quantiles.
+
+    Values are held as weighted centroids. Up to `size` of them are kept
+    as-is, so quantiles of up to `size` members are exact; past that, the
+    centroids are merged into `size // 2` bins by rank, which are narrowest
+    in the tails as in a t-digest. Quantiles are interpolated between the
+    centroids' mean ranks, anchored by the exact minimum and maximum, and
+    are then typically within a percent or so (in rank) of the truth.
+
+    """
+
+    def __init__(self, how, skipna=True, size=SKETCH_SIZE):
+        super(Sketch, self).__init__(how, skipna)
+        self.size = size
+        self.means = self.weights = None
+        self.lo = self.hi = self.nan = None
+
+    def add(self, values):
+        values = np.asarray(values, dtype='f8')
+        member = Sketch(self.how, self.skipna, self.size)
+        member.nan = np.isnan(values)
+        member.means = values[np.newaxis]
+        member.weights = (~member.nan).astype('f8')[np.newaxis]
+        member.lo = member.hi = values
+        self.merge(member)
+
+    def merge(self, other):
+        if other.means is None:
+            return
+        if self.means is None:
+            self.means, self.weights = other.means, other.weights
+            self.lo, self.hi, self.nan = other.lo, other.hi, other.nan
+        else:
+            self.means = np.concatenate([self.means, other.means])
+            self.weights = np.concatenate([self.weights, other.weights])
+            self.lo = np.fmin(self.lo, other.lo)
+            self.hi = np.fmax(self.hi, other.hi)
+            self.nan = self.nan | other.nan
+        while len(self.means) > self.size:
+            self._compress()
+
+    def _sorted(self):
+        """ The centroids sorted by value, with empty ones (from NaNs)
+        last. """
+        order = np.argsort(np.where(self.weights > 0, self.means, np.inf),
+                           axis=0)
+        return (np.take_along_axis(self.means, order, axis=0),
+                np.take_along_axis(self.weights, order, axis=0))
+
+    def _compress(self):
+        # Bin the centroids by their mean rank, scaled like a t-digest so
+        # that the bins are finest in the tails, and merge each bin
+        means, weights = self._sorted()
+        n_bins = max(self.size // 2, 1)
+        total = weights.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mid = (np.cumsum(weights, axis=0) - weights / 2.) / total
+        scaled = np.arcsin(2 * np.clip(np.nan_to_num(mid), 0, 1) - 1) / np.pi
+        bins = np.clip(np.floor((scaled + 0.5) * n_bins), 0, n_bins - 1)
+
+        valid = weights > 0
+        elems = np.broadcast_to(np.arange(total.size).reshape(total.shape),
+                                means.shape)
+        at = (bins[valid].astype(int), elems[valid])
+        shape = (n_bins, ) + total.shape
+        self.weights = np.zeros(shape)
+        sums = np.zeros(shape)
+        np.add.at(self.weights, at, weights[valid])
+        np.add.at(sums, at, (means * weights)[valid])
+        with np.errstate(invalid='ignore'):
+            self.means = sums / self.weights
+
+    def result(self, q=0.5, **kwargs):
+        means, weights = self._sorted()
+        total = weights.sum(axis=0)
+        last = total - 1
+        # Each centroid sits at the mean rank of the values it stands for
+        valid = weights > 0
+        ranks = np.where(valid, np.cumsum(weights, axis=0) -
+                         (weights + 1) / 2., last)
+        x = np.concatenate([np.zeros_like(last)[np.newaxis], ranks,
+                            last[np.newaxis]])
+        y = np.concatenate([self.lo[np.newaxis],
+                            np.where(valid, means, self.hi),
+                            self.hi[np.newaxis]])
+
+        results = []
+        for q_i in np.atleast_1d(q):
+            target = q_i * last
+            # The last point strictly below the target, so that ties go to
+            # the lowest (e.g. the minimum itself, for q=0)
+            idx = np.clip((x < target).sum(axis=0) - 1, 0, len(x) - 2)
+            idx = idx[np.newaxis]
+            x0, x1 = [np.take_along_axis(x, i, axis=0)[0]
+                      for i in (idx, idx + 1)]
+            y0, y1 = [np.take_along_axis(y, i, axis=0)[0]
+                      for i in (idx, idx + 1)]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                frac = np.where(x1 > x0, (target - x0) / (x1 - x0), 0.)
+            result = y0 + frac * (y1 - y0)
+            empty = (total == 0) if self.skipna else (total == 0) | self.nan
+            results.append(np.where(empty, np.nan, result))
+        return np.stack(results) if np.ndim(q) else results[0]
+
+
+#: The accumulator used for each statistic
+ACCUMULATORS = OrderedDict([
+    ('mean', Moments), ('std', Moments), ('var', Moments),
+    ('count', Moments), ('min', Extreme), ('max', Extreme), ('sum', Total),
+    ('quantile', Sketch),
+])
+
+
+def _reduce_case(loader, field, path_to_file, fix_times, preprocess,
+                 load_kws, case_kws, cache, how, skipna):
+    """ Load a single case and summarize each of its numeric variables;
+    module-level so that it can be shipped to a process pool. Returns the
+    accumulators, the dimensions of each variable, and a skeleton Dataset
+    holding just their coordinates. """
+    ds = _load_case(loader, field, path_to_file, fix_times, preprocess,
+                    load_kws, case_kws, None, cache)
+    try:
+        if isinstance(ds, xr.DataArray):
+            ds = ds.to_dataset(name=ds.name or field)
+        names = [name for name, var in ds.data_vars.items()
+                 if var.dtype.kind in 'biufc']
+        accs = OrderedDict()
+        dims = OrderedDict()
+        for name in names:
+            accs[name] = ACCUMULATORS[how](how, skipna)
+            accs[name].add(ds[name].values)
+            dims[name] = ds[name].dims
+        skeleton = xr.Dataset(coords=ds.coords).load()
+    finally:
+        _close(ds)
+    return accs, dims, skeleton
+
+
+def reduce_cases(exp, var, over, how='mean', q=None, ddof=0, skipna=True,
+                 executor='threads', max_workers=None, errors='warn',
+                 fix_times=False, preprocess=None, load_kws={}, time=None,
+                 isel=None, sel=None, **case_kws):
+    """ Reduce a variable across some of an Experiment's case dimensions,
+    one case at a time.
+
+    See `Experiment.reduce` for a description of the arguments.
+
+    """
+    if how not in ACCUMULATORS:
+        raise ValueError("`how` must be one of {}".format(
+            ", ".join(repr(h) for h in ACCUMULATORS)
+        ))
+    if (how == 'quantile') and (q is None):
+        raise ValueError("Must specify `q` to compute quantiles")
+    if errors not in ('warn', 'raise'):
+        raise ValueError("`errors` must be one of 'warn' or 'raise'")
+    if isinstance(over, basestring):
+        over = [over, ]
+    unknown = [name for name in over if name not in exp.cases]
+    if unknown:
+        raise ValueError("Unknown case(s): {}".format(", ".join(unknown)))
+    if case_kws:
+        exp = exp.subset(**case_kws)
+
+    field = var if isinstance(var, basestring) else var.varname
+    load_kws = _loader_kws(load_kws, time=time, isel=isel, sel=sel)
+    kept = [name for name in exp.cases if name not in over]
+    kept_pos = [exp.cases.index(name) for name in kept]
+
+    loader, case_files, exists = case_sources(exp, field, time, fix_times)
+    groups = OrderedDict()
+    failures = OrderedDict()
+    dims = skeleton = None
+
+    pool, owned = get_executor(executor, max_workers)
+    _, cache = shared_state(exp, pool)
+    try:
+        pending = {}
+        for kws, filename in case_files:
+            case = exp.case_tuple(**kws)
+            if (exists is not None) and not exists(filename):
+                failures[case] = IOError("No files catalogued for %r" %
+                                         (case, ))
+                continue
+            future = pool.submit(_reduce_case, loader, field, filename,
+                                 fix_times, preprocess, load_kws, kws,
+                                 cache, how, skipna)
+            pending[future] = case
+
+        # Merge partial results as they finish, so each can be released
+        for future in as_completed(list(pending)):
+            case = pending.pop(future)
+            try:
+                accs, case_dims, case_skeleton = future.result()
+            except Exception as e:
+                logger.warning("Could not load case %r (%s)" % (case, e))
+                failures[case] = e
+                continue
+            if dims is None:
+                dims, skeleton = case_dims, case_skeleton
+
+            group = tuple(case[i] for i in kept_pos)
+            if group not in groups:
+                groups[group] = accs
+            else:
+                for name, acc in groups[group].items():
+                    acc.merge(accs[name])
+    finally:
+        if owned:
+            pool.shutdown()
+
+    if failures and (errors == 'raise'):
+        raise CaseLoadError(failures)
+    if not groups:
+        raise ValueError("Couldn't find data for any case")
+    logger.info("{} - reduced {} over {} in {} group(s)".format(
+        exp.name, field, ", ".join(over), len(groups)
+    ))
+
+    return _assemble(exp, kept, groups, dims, skeleton, how,
+                     dict(q=q, ddof=ddof))
+
+
+def _assemble(exp, kept, groups, dims, skeleton, how, opts):
+    """ Arrange the result for each group along the remaining case
+    dimensions. Groups with no cases are filled with NaNs (or zero
+    counts). """
+    kept_vals = [exp.get_case_vals(name) for name in kept]
+    index = [dict((val, i) for i, val in enumerate(vals))
+             for vals in kept_vals]
+    shape = tuple(len(vals) for vals in kept_vals)
+    lead_dims = list(kept)
+    if (how == 'quantile') and np.ndim(opts['q']):
+        lead_dims = ['quantile', ] + lead_dims
+
+    data_vars = OrderedDict()
+    for name, var_dims in dims.items():
+        results = OrderedDict(
+            (group, accs[name].result(**opts))
+            for group, accs in groups.items()
+        )
+        proto = next(iter(results.values()))
+        lead = ()
+        if len(lead_dims) > len(kept):
+            lead, proto = proto.shape[:1], proto[0]
+        if how == 'count':
+            out = np.zeros(lead + shape + proto.shape, dtype=proto.dtype)
+        else:
+            out = np.full(lead + shape + proto.shape, np.nan)
+        for group, result in results.items():
+            idx = tuple(i[val] for i, val in zip(index, group))
+            out[(slice(None), ) * len(lead) + idx] = result
+        data_vars[name] = (lead_dims + list(var_dims), out)
+
+    coords = OrderedDict((name, vals) for name, vals in zip(kept, kept_vals))
+    if how == 'quantile':
+        coords['quantile'] = opts['q']
+    reduced = xr.Dataset(data_vars, coords=skeleton.coords)
+    return reduced.assign_coords(coords)
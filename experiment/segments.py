@@ -0,0 +1,194 @@
+"""
+Timeseries archives which split each case's output into several files.
+
+Long simulations are often archived with each field split across a series
+of files, each covering a range of time - one per year, say, named like
+"tas_..._1986_1986.nc". Such archives mark where the time range appears in
+their file names with the reserved `{start}` and `{end}` tokens in the
+output prefix or suffix. When rendering paths those tokens become a glob
+wildcard, and the files found for each case are parsed back into
+(year, month, day) tuples, so that they can be put in time order and, if
+only a window of time is wanted, so that only the files which overlap it
+are ever opened.
+
+Dates in file names are read from their digits, as YYYY, YYYYMM or
+YYYYMMDD (with or without separators); the parts which aren't given are
+taken to span the whole year or month. Timeslice files, whose names don't
+carry their dates, are instead judged by the first and last timestamps in
+their headers (see `times_overlap`).
+
+"""
+import glob
+import re
+
+from string import Formatter
+
+#: Reserved template tokens marking the time range covered by each file
+START, END = 'start', 'end'
+
+#: What the reserved tokens are rendered as in paths
+WILDCARD = "*"
+
+#: Regular expression for the dates which the reserved tokens stand for
+DATE_PATTERN = r"\d{4}[\d\-]*?"
+
+#: Stand-ins for the reserved tokens, swapped for wildcards after escaping
+_MARKERS = {START: "\0" + START + "\0", END: "\0" + END + "\0"}
+
+#: Hack for Py2/3 basestring type compatibility
+if 'basestring' not in globals():
+    basestring = str
+
+
+def segment_tokens(template, names=()):
+    """ Return the set of reserved tokens used in a format string, besides
+    any which are actually case names. """
+    if (template is None) or callable(template):
+        return set()
+    return set(field for _, field, _, _ in Formatter().parse(template)
+               if field in (START, END) and field not in names)
+
+
+def parse_date(text, end=False):
+    """ Parse the digits of a date into a (year, month, day) tuple. Any
+    missing month or day is filled in to give the start (or with `end`, the
+    end) of the period. """
+    digits = re.sub(r"\D", "", text)
+    if len(digits) < 4:
+        raise ValueError("Couldn't interpret date {!r}".format(text))
+    year = int(digits[:4])
+    month = int(digits[4:6]) if len(digits) >= 6 else (12 if end else 1)
+    day = int(digits[6:8]) if len(digits) >= 8 else (31 if end else 1)
+    return year, month, day
+
+
+def _as_date(value, end=False):
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        return parse_date(value, end)
+    if isinstance(value, int):
+        return (value, 12, 31) if end else (value, 1, 1)
+    if not hasattr(value, 'year'):
+        # e.g. numpy.datetime64
+        import pandas as pd
+        value = pd.Timestamp(value)
+    return value.year, value.month, value.day
+
+
+def time_window(time):
+    """ Convert a window of time - a slice or (start, end) pair of dates,
+    either of which may be None - into a pair of (year, month, day)
+    tuples. Dates may be strings (e.g. "1990" or "1990-06"), years, or
+    datetime-like objects, and both ends of the window are inclusive. """
+    if isinstance(time, slice):
+        if time.step is not None:
+            raise ValueError("Time windows can't have a step")
+        start, stop = time.start, time.stop
+    else:
+        try:
+            start, stop = time
+        except (TypeError, ValueError):
+            raise ValueError("A time window must be a slice or a (start, "
+                             "end) pair, not {!r}".format(time))
+    return _as_date(start), _as_date(stop, end=True)
+
+
+def time_slice(time):
+    """ Convert a window of time - a slice or (start, end) pair - into a
+    slice for label-based selection along a time index, turning any years
+    given as integers into strings. """
+    if not isinstance(time, slice):
+        time_window(time)  # Just to validate it
+        time = slice(*time)
+    elif time.step is not None:
+        raise ValueError("Time windows can't have a step")
+    return slice(*[str(t) if isinstance(t, int) else t
+                   for t in (time.start, time.stop)])
+
+
+def to_glob(path):
+    """ Escape a path rendered with the reserved tokens' markers, then
+    replace the markers with wildcards. """
+    pattern = glob.escape(path)
+    for marker in _MARKERS.values():
+        pattern = pattern.replace(marker, WILDCARD)
+    return pattern
+
+
+def markers():
+    """ Values to render the reserved tokens with, ahead of `to_glob`. """
+    return _MARKERS[START], _MARKERS[END]
+
+
+def find_segments(pattern, regex, window=None):
+    """ Find the files matching a glob pattern, and return them in time
+    order.
+
+    Parameters
+    ----------
+    pattern : str
+        Glob pattern for a case's files
+    regex : compiled regular expression
+        Parses a path into (at least) the `start` and/or `end` of the time
+        range it covers
+    window : pair of (year, month, day) tuples (optional)
+        If given, only return the files which overlap this window (see
+        `time_window`)
+
+    """
+    return sort_segments(glob.glob(pattern), regex, window)
+
+
+def sort_segments(paths, regex, window=None):
+    """ Put a case's files - however they were found - in time order,
+    skipping any which `regex` doesn't match; the arguments are as in
+    `find_segments`. """
+    segments = []
+    for path in paths:
+        match = regex.fullmatch(path)
+        if match is None:
+            continue
+        groups = match.groupdict()
+        start, end = groups.get(START), groups.get(END)
+        segments.append([None if start is None else parse_date(start),
+                         None if end is None else parse_date(end, True),
+                         path])
+    segments.sort(key=lambda seg: (seg[0] or seg[1], seg[2]))
+
+    # If only one end of each range is marked, the other runs up to the
+    # neighbouring file
+    for prev, seg in zip(segments[:-1], segments[1:]):
+        if prev[1] is None:
+            prev[1] = seg[0]
+        if seg[0] is None:
+            seg[0] = prev[1]
+
+    if window is not None:
+        segments = [seg for seg in segments
+                    if _overlaps(seg[0], seg[1], window)]
+    return [path for _, _, path in segments]
+
+
+def _overlaps(start, end, window):
+    """ True if a range of (year, month, day) dates, either end of which
+    may be None (unbounded), overlaps a window from `time_window`. """
+    lo, hi = window
+    return (((hi is None) or (start is None) or (start <= hi)) and
+            ((lo is None) or (end is None) or (end >= lo)))
+
+
+def times_overlap(start, end, units, calendar, window):
+    """ True if a file whose raw (undecoded) timestamps run from `start` to
+    `end`, counted in CF `units` on the given `calendar`, has any times in
+    a window from `time_window`. Files whose times can't be interpreted
+    are assumed to overlap it. """
+    if (start is None) or (end is None) or (' since ' not in (units or "")):
+        return True
+    from xarray.coding.times import decode_cf_datetime
+    try:
+        first, last = decode_cf_datetime([start, end], units,
+                                         calendar or 'standard')
+    except Exception:
+        return True
+    return _overlaps(_as_date(first), _as_date(last), window)
@@ -0,0 +1,212 @@
+"""
+Persisting master datasets to Zarr.
+
+Building a master dataset means opening every case in an Experiment, which
+gets old fast when it has to happen in every session. Instead, the master
+can be written once to a chunked Zarr store, laid out along the case
+dimensions with one chunk per case, and then re-opened lazily (which only
+reads the store's metadata) whenever it's needed.
+
+The store is created up front from the structure of a single case, so
+each case can then be written into its own region independently: cases
+are written concurrently, and a `case_written` flag in the store records
+which ones have finished, so an interrupted write can be resumed without
+redoing any of the work.
+
+Zarr is an optional dependency, and is only needed to use this module.
+
+"""
+from collections import OrderedDict
+
+from numpy import nan, ndindex, ones, zeros
+from xarray import Dataset, open_zarr
+
+from . import logger
+from . convert import _case_layout
+from . loading import CaseLoadError
+from . parallel import get_executor
+
+#: Hack for Py2/3 basestring type compatibility
+if 'basestring' not in globals():
+    basestring = str
+
+#: Store attributes recording how the cases are laid out
+_LAYOUT_ATTR = 'experiment_case_layout'
+_DIMS_ATTR = 'experiment_case_dims'
+_NAMES_ATTR = 'experiment_case_names'
+
+#: Name of the variable flagging which cases have been written
+WRITTEN = 'case_written'
+
+
+def _check_zarr():
+    try:
+        import zarr  # noqa: F401
+    except ImportError:
+        raise ImportError("Writing master datasets requires the zarr package")
+
+
+def _clean(ds):
+    """ Strip the on-disk encoding from a freshly-loaded dataset, which
+    won't apply to a Zarr store. """
+    ds = ds.copy()
+    for var in ds.variables.values():
+        var.encoding = {}
+    return ds
+
+
+def _template(exp, layout, proto):
+    """ Build a lazy, NaN-filled master Dataset with the structure of a
+    single case, chunked one case at a time, plus the `case_written`
+    flags. Nothing here is ever computed. """
+    from dask.array import full
+
+    n_case_dims = len(layout.dims)
+    data_vars = OrderedDict()
+    for name, var in proto.data_vars.items():
+        dtype = var.dtype if var.dtype.kind in 'fc' else 'f8'
+        leaf_chunks = var.chunks if var.chunks is not None else var.shape
+        data = full(tuple(layout.shape) + var.shape, nan, dtype=dtype,
+                    chunks=(1, ) * n_case_dims + tuple(leaf_chunks))
+        data_vars[name] = (list(layout.dims) + list(var.dims), data,
+                           var.attrs)
+    data_vars[WRITTEN] = (layout.dims, zeros(layout.shape, dtype=bool))
+
+    template = Dataset(data_vars, coords=proto.coords, attrs=proto.attrs)
+    template = template.assign_coords(layout.coords)
+    if layout.dims == ['case', ]:
+        # MultiIndexes can't be stored directly
+        template = template.reset_index('case')
+    template.attrs[_LAYOUT_ATTR] = 'stacked' if layout.dims == ['case', ] \
+        else 'dense'
+    template.attrs[_DIMS_ATTR] = " ".join(layout.dims)
+    template.attrs[_NAMES_ATTR] = " ".join(exp.cases)
+    # One flag per chunk, so concurrent writes never touch the same chunk
+    template[WRITTEN].encoding['chunks'] = (1, ) * n_case_dims
+    return template
+
+
+def _case_positions(exp, layout):
+    """ Map each of the Experiment's cases to its index along the case
+    dimension(s) of the master. """
+    index = dict((case, idx) for case, idx in
+                 zip(layout.cases, ndindex(*layout.shape)))
+    return OrderedDict((case, index[case]) for case in
+                       (exp.case_tuple(*c) for c in exp.all_cases()))
+
+
+def _write_case(exp, field, case, idx, store, template_vars, layout_dims,
+                load_opts):
+    """ Load a single case and write it into its region of the store. """
+    ds = exp.load(field, **dict(load_opts, **case._asdict()))
+    try:
+        region = OrderedDict((dim, slice(i, i + 1))
+                             for dim, i in zip(layout_dims, idx))
+        ds = _clean(ds)
+        ds = ds[[name for name in ds.data_vars if name in template_vars]]
+        ds = ds.drop_vars(list(ds.coords)).expand_dims(layout_dims)
+        ds.to_zarr(store, region=region)
+        # Only flag the case once its data is safely written
+        flag = ones((1, ) * len(layout_dims), dtype=bool)
+        Dataset({WRITTEN: (layout_dims, flag)}).to_zarr(store, region=region)
+    finally:
+        close = getattr(ds, 'close', None)
+        if close is not None:
+            close()
+
+
+def write_master(exp, var, store, layout='dense', resume=True,
+                 executor='threads', max_workers=None, errors='warn',
+                 fix_times=False, preprocess=None, load_kws={}):
+    """ Write the master dataset for a variable to a Zarr store, one case
+    at a time.
+
+    See `Experiment.write_master` for a description of the arguments.
+
+    """
+    _check_zarr()
+    if errors not in ('warn', 'raise'):
+        raise ValueError("`errors` must be one of 'warn' or 'raise'")
+    field = var if isinstance(var, basestring) else var.varname
+    layout = _case_layout(exp, layout)
+    positions = _case_positions(exp, layout)
+    load_opts = dict(fix_times=fix_times, preprocess=preprocess,
+                     load_kws=load_kws)
+
+    done = None
+    if resume:
+        try:
+            existing = open_zarr(store)
+        except (IOError, OSError, KeyError, ValueError):
+            existing = None
+        if existing is not None:
+            if (existing.attrs.get(_DIMS_ATTR, "").split() != layout.dims)\
+                    or (existing[WRITTEN].shape != tuple(layout.shape)):
+                raise ValueError("Existing store {} doesn't match the "
+                                 "case layout".format(store))
+            done = existing[WRITTEN].values
+            template_vars = [name for name in existing.data_vars
+                             if name != WRITTEN]
+
+    todo = [(case, idx) for case, idx in positions.items()
+            if (done is None) or not done[idx]]
+    if done is None:
+        # Create the store from the first case which can be loaded
+        for case, idx in todo:
+            try:
+                proto = exp.load(field, **dict(load_opts, **case._asdict()))
+                break
+            except Exception as e:
+                logger.warning("Could not load case %r (%s)" % (case, e))
+        else:
+            raise ValueError("Couldn't find data for any case")
+        template = _template(exp, layout, _clean(proto))
+        template.to_zarr(store, mode='w', compute=False)
+        template_vars = [name for name in template.data_vars
+                         if name != WRITTEN]
+    logger.info("{} - writing {} of {} case(s) to {}".format(
+        exp.name, len(todo), len(positions), store
+    ))
+
+    failures = OrderedDict()
+    pool, owned = get_executor(executor, max_workers)
+    try:
+        futures = OrderedDict(
+            (case, pool.submit(_write_case, exp, field, case, idx, store,
+                               template_vars, layout.dims, load_opts))
+            for case, idx in todo
+        )
+        for case, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning("Could not write case %r (%s)" % (case, e))
+                failures[case] = e
+    finally:
+        if owned:
+            pool.shutdown()
+
+    if failures and (errors == 'raise'):
+        raise CaseLoadError(failures)
+    return open_master(store)
+
+
+def open_master(store, **kwargs):
+    """ Lazily open a master dataset written by `write_master`.
+
+    Cases which haven't been written (yet) are filled with NaNs, and if
+    there are any, the `case_written` flags are attached as a coordinate.
+
+    """
+    _check_zarr()
+    ds = open_zarr(store, **kwargs)
+    dims = ds.attrs.pop(_DIMS_ATTR, "").split()
+    names = ds.attrs.pop(_NAMES_ATTR, "").split()
+    if ds.attrs.pop(_LAYOUT_ATTR, None) == 'stacked':
+        ds = ds.set_index(case=names)
+
+    written = ds[WRITTEN].values
+    ds = ds.drop_vars(WRITTEN)
+    if not written.all():
+        ds.coords[WRITTEN] = (dims, written)
+    return ds
@@ -0,0 +1,181 @@
+"""
+Compiled path templates for Experiment archives.
+
+An Experiment describes its archive layout with format strings such as
+"{emis}/{param}" which are filled in with named case values. Formatting
+those by keyword for every case and field is surprisingly expensive on
+large experiments, so here the templates are parsed once and rewritten
+in terms of positional arguments matching the order of the cases; a
+path can then be rendered straight from a case tuple.
+
+Templates can also be run in reverse, compiled to a regular expression
+which parses a rendered path back into its case values.
+
+"""
+import os
+import re
+
+from string import Formatter
+
+#: Placeholder used for the field name in whole-file templates
+FIELD = "__field__"
+
+
+def escape(text):
+    """ Escape literal text so it can be embedded in a format string. """
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+def compile_format(template, names):
+    """ Rewrite a format string with named fields into one with positional
+    fields, indexed by position in `names`.
+
+    Parameters
+    ----------
+    template : str
+        Format string with named directives, e.g. "{emis}/{param}"
+    names : list of str
+        The names which may appear in the template, in the order their
+        values will be passed when rendering
+
+    Returns
+    -------
+    The positional format string (e.g. "{0}/{1}"), or None if the template
+    refers to a name which isn't in `names` (or uses automatic numbering).
+
+    """
+    index = dict((name, i) for i, name in enumerate(names))
+    bits = []
+    for literal, field, spec, conversion in Formatter().parse(template):
+        bits.append(escape(literal))
+        if field is None:
+            continue
+
+        # Split off any attribute/item access, e.g. "emis[0]"
+        for i, char in enumerate(field):
+            if char in ".[":
+                name, accessor = field[:i], field[i:]
+                break
+        else:
+            name, accessor = field, ""
+        if name not in index:
+            return None
+
+        bits.append("{" + str(index[name]) + accessor)
+        if conversion:
+            bits.append("!" + conversion)
+        if spec:
+            bits.append(":" + spec)
+        bits.append("}")
+    return "".join(bits)
+
+
+class PathTemplate(object):
+    """ A path template, compiled against an ordered list of case names.
+
+    Parameters
+    ----------
+    template : str or function
+        Either a format string with named directives for each case, or a
+        function accepting the case values as named keyword arguments and
+        returning the rendered string
+    names : list of str
+        The case names, in the order their values appear in case tuples
+    fill : list of (name, value) pairs (optional)
+        Further names which may appear in the template, and the values to
+        render them with when they're left off the end of a case tuple
+
+    """
+
+    def __init__(self, template, names, fill=()):
+        self.template = template
+        self.names = list(names) + [name for name, _ in fill]
+        self._fill = tuple(value for _, value in fill)
+        self._n_required = len(self.names) - len(self._fill)
+        if callable(template):
+            self._format = None
+        else:
+            fmt = compile_format(template, self.names)
+            self._format = None if fmt is None else fmt.format
+
+    @property
+    def compiled(self):
+        """ True if the template could be compiled to a positional
+        format. """
+        return self._format is not None
+
+    def _complete(self, case_bits):
+        """ Append the fill values for any trailing names not given. """
+        missing = len(self.names) - len(case_bits)
+        if missing > 0:
+            return tuple(case_bits) + self._fill[len(self._fill) - missing:]
+        return case_bits
+
+    def render(self, case_bits):
+        """ Render the template for a single tuple of case values. """
+        if self._fill:
+            case_bits = self._complete(case_bits)
+        if self._format is not None:
+            return self._format(*case_bits)
+        case_kws = dict(zip(self.names, case_bits))
+        if callable(self.template):
+            return self.template(**dict(
+                (name, case_kws[name]) for name in
+                self.names[:self._n_required]
+            ))
+        return self.template.format(**case_kws)
+
+    def render_many(self, cases, *extra):
+        """ Render the template for a sequence of case tuples, with any
+        `extra` values appended to each. """
+        if self._format is not None and not self._fill:
+            fmt = self._format
+            return [fmt(*(tuple(case_bits) + extra)) for case_bits in cases]
+        return [self.render(tuple(case_bits) + extra) for case_bits in cases]
+
+    def to_regex(self, patterns={}):
+        """ Compile the inverse of this template: a regular expression with
+        a named group for each name in the template, which parses a
+        rendered string back into its values.
+
+        A name which appears more than once in the template must take the
+        same value everywhere, so only its first appearance is captured and
+        the rest are matched as backreferences.
+
+        Parameters
+        ----------
+        patterns : dict (optional)
+            Regular expressions for the values of particular names. By
+            default, a value can be any (non-empty) text which doesn't
+            cross a path separator.
+
+        Returns
+        -------
+        The compiled regular expression, to be used with `fullmatch`
+
+        """
+        if callable(self.template):
+            raise ValueError("Can't invert a template given by a function")
+
+        default = "[^{}]+?".format(re.escape(os.sep))
+        seen = set()
+        bits = []
+        for literal, field, spec, conversion in \
+                Formatter().parse(self.template):
+            bits.append(re.escape(literal))
+            if field is None:
+                continue
+            if (field not in self.names) or (conversion not in (None, 's')):
+                raise ValueError("Can't invert the directive {{{}}} in "
+                                 "{!r}".format(field, self.template))
+            if field in seen:
+                bits.append("(?P={})".format(field))
+            else:
+                seen.add(field)
+                bits.append("(?P<{}>{})".format(
+                    field, patterns.get(field, default)
+                ))
+        return re.compile("".join(bits))
+
+    def __repr__(self):
+        return "PathTemplate({!r})".format(self.template)
@@ -0,0 +1,140 @@
+import unittest
+
+import dask.array as da
+import numpy as np
+import xarray as xr
+
+from experiment import Experiment, Case
+from experiment.convert import create_master
+
+
+cases = [
+    Case('emis', 'Emissions Scenario', ['low', 'high']),
+    Case('param', 'Tuning Parameter', ['x', 'y', 'z']),
+]
+exp = Experiment('convert', cases, case_path='', validate_data=False)
+
+
+def _make_data(chunked=False):
+    """ Build a data dictionary where each case holds a field filled with
+    its own (row-major) case index. """
+    data = {}
+    for i, case in enumerate(exp.all_cases()):
+        values = np.full((4, 2), i, dtype='f8')
+        if chunked:
+            values = da.from_array(values, chunks=(2, 2))
+        ds = xr.Dataset({'TS': (('time', 'x'), values)},
+                        coords={'time': np.arange(4), 'x': [0., 1.]})
+        ds['TS'].attrs['units'] = 'K'
+        ds['PS'] = ('time', np.full(4, -i, dtype='f8'))
+        data[exp.case_tuple(*case)] = ds
+    return data
+
+
+class TestMaster(unittest.TestCase):
+
+    def _check_master(self, master):
+        self.assertEqual(master['TS'].dims, ('emis', 'param', 'time', 'x'))
+        self.assertEqual(list(master['emis'].values), ['low', 'high'])
+        self.assertEqual(list(master['param'].values), ['x', 'y', 'z'])
+        self.assertEqual(master['TS'].attrs['units'], 'K')
+
+        expected = np.arange(6).reshape(2, 3)
+        np.testing.assert_array_equal(
+            master['TS'].values[:, :, 0, 0], expected
+        )
+        for i, case in enumerate(exp.all_cases()):
+            case_kws = exp.get_case_kws(*case)
+            self.assertTrue(
+                (master['TS'].sel(**case_kws).values == i).all()
+            )
+
+    def test_master_in_memory(self):
+        master = create_master(exp, 'TS', _make_data(), new_fields=[])
+        self.assertIsInstance(master['TS'].data, np.ndarray)
+        self._check_master(master)
+
+    def test_master_dask(self):
+        master = create_master(exp, 'TS', _make_data(chunked=True),
+                               new_fields=[])
+        self.assertIsInstance(master['TS'].data, da.Array)
+        # Leaf chunking is preserved, one chunk per case
+        self.assertEqual(master['TS'].data.chunks,
+                         ((1, 1), (1, 1, 1), (2, 2), (2, )))
+        self._check_master(master)
+
+    def test_master_dataset_all_vars(self):
+        """ Every data variable is stacked over the same case layout. """
+        master = create_master(exp, 'TS', _make_data(chunked=True),
+                               new_fields=[])
+        self.assertEqual(set(master.data_vars), {'TS', 'PS'})
+        self.assertEqual(master['PS'].dims, ('emis', 'param', 'time'))
+        np.testing.assert_array_equal(
+            master['PS'].values[:, :, 0], -np.arange(6).reshape(2, 3)
+        )
+        self.assertEqual(master['emis'].attrs['long_name'],
+                         'Emissions Scenario')
+
+    def test_master_missing_cases(self):
+        """ Absent cases become lazy NaN blocks flagged by `case_present`. """
+        data = _make_data()
+        missing_case = exp.case_tuple('high', 'y')
+        del data[missing_case]
+        data[exp.case_tuple('low', 'z')] = None
+
+        with self.assertRaises(KeyError):
+            create_master(exp, 'TS', data, new_fields=[], missing='raise')
+
+        master = create_master(exp, 'TS', data, new_fields=[])
+        self.assertIsInstance(master['TS'].data, da.Array)
+        np.testing.assert_array_equal(
+            master['case_present'].values,
+            [[True, True, False], [True, False, True]]
+        )
+        self.assertTrue(
+            np.isnan(master['TS'].sel(emis='high', param='y').values).all()
+        )
+        self.assertTrue(
+            (master['TS'].sel(emis='high', param='z').values == 5).all()
+        )
+
+    def test_master_sparse_layouts(self):
+        """ Sparse experiments can be mastered densely (with the invalid
+        combinations missing) or stacked along a single `case` dimension. """
+        valid = [('low', 'x'), ('low', 'z'), ('high', 'y')]
+        sparse_exp = Experiment('convert', cases, case_path='',
+                                validate_data=False, valid_cases=valid)
+        full_data = _make_data()
+        data = dict((case, full_data[case]) for case in valid)
+
+        dense = create_master(sparse_exp, 'TS', data, new_fields=[])
+        self.assertEqual(dense['TS'].shape, (2, 3, 4, 2))
+        np.testing.assert_array_equal(
+            dense['case_present'].values,
+            [[True, False, True], [False, True, False]]
+        )
+
+        stacked = create_master(sparse_exp, 'TS', data, new_fields=[],
+                                layout='stacked')
+        self.assertEqual(stacked['TS'].dims, ('case', 'time', 'x'))
+        self.assertNotIn('case_present', stacked.coords)
+        self.assertEqual(list(stacked.indexes['case']), valid)
+        self.assertTrue(
+            (stacked['TS'].sel(emis='high', param='y').values == 4).all()
+        )
+
+    def test_master_chunks(self):
+        """ Small cases are grouped into larger, aligned chunks. """
+        master = create_master(exp, 'TS', _make_data(chunked=True),
+                               new_fields=[], chunks='auto')
+        self.assertEqual(master['TS'].data.chunks,
+                         ((2, ), (3, ), (4, ), (2, )))
+        self._check_master(master)
+
+        master = create_master(exp, 'TS', _make_data(chunked=True),
+                               new_fields=[],
+                               chunks={'emis': 1, 'param': 'auto'})
+        self.assertEqual(master['TS'].data.chunks,
+                         ((1, 1), (3, ), (2, 2), (2, )))
+        # Dimensions shared between variables are chunked consistently
+        self.assertEqual(master['PS'].data.chunks, ((1, 1), (3, ), (2, 2)))
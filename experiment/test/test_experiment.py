@@ -7,12 +7,37 @@ try:
 except ImportError:
     import pickle
 
+import asyncio
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+import warnings
 import yaml
 
+import numpy as np
+import pandas as pd
+import xarray as xr
+
 from itertools import product
-from experiment import Experiment, Case
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import experiment.loading
+import experiment.store
+from experiment import Experiment, Case, CaseLoadError
+from experiment.catalog import Catalog
+from experiment.var import Var
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
 
 
 case_emis = \
@@ -36,6 +61,25 @@ def make_exp(**kwargs):
     kws.update(**kwargs)
     return Experiment(**kws)
 
+#: On-disk sample archive generated by data/make_sample.py
+SAMPLE_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data', 'sample')
+sample_cases = [
+    Case("param1", "Parameter 1", ["a", "b", "c"]),
+    Case("param2", "Parameter 2", [1, 2, 3]),
+    Case("param3", "Parameter 3", ["alpha", "beta"]),
+]
+sample_exp_kws = dict(
+    name='sample', cases=sample_cases, timeseries=True,
+    data_dir=SAMPLE_DATA_DIR,
+    case_path="{param1}_{param2}",
+    output_prefix="{param1}.{param2}.{param3}.",
+    output_suffix=".tape.nc", validate_data=False
+)
+def make_sample_exp(**kwargs):
+    kws = dict(sample_exp_kws)
+    kws.update(**kwargs)
+    return Experiment(**kws)
+
 class TestExperiment(unittest.TestCase):
 
     def test_repr(self):
@@ -67,6 +111,33 @@ class TestExperiment(unittest.TestCase):
         for expected, actual in zip(exp_case_gen, actual_case_gen):
             self.assertEqual(expected, actual)
 
+    def test_valid_cases(self):
+        """ Sparse experiments only walk the valid case combinations, in
+        the same order as the full product. """
+        valid = [('weak_policy', 'no_sun'), ('policy', 'no_sun_no_clouds'),
+                 dict(emis='policy', model_config='no_clouds')]
+        exp = make_exp(valid_cases=valid)
+        expected = [('policy', 'no_clouds'), ('policy', 'no_sun_no_clouds'),
+                    ('weak_policy', 'no_sun')]
+        self.assertTrue(exp.is_sparse)
+        self.assertFalse(my_experiment.is_sparse)
+        self.assertEqual(list(exp.all_cases()), expected)
+        self.assertEqual(len(list(exp.walk_files('TS'))), 3)
+        self.assertEqual(list(exp._walk_cases()), [
+            'policy/no_clouds', 'policy/no_sun_no_clouds',
+            'weak_policy/no_sun'
+        ])
+
+        def _is_valid(emis, model_config):
+            return (emis, model_config) in expected
+        exp = make_exp(valid_cases=_is_valid)
+        self.assertEqual(list(exp.all_cases()), expected)
+        self.assertEqual(exp.to_dict()['valid_cases'],
+                         [list(case) for case in expected])
+
+        with self.assertRaises(ValueError):
+            make_exp(valid_cases=[('policy', 'not_a_config')])
+
     def test_walk_cases_default(self):
         """ Walk cases when no case_path is provided - so bits are
         ordered in the order passed as cases """
@@ -106,7 +177,42 @@ class TestExperiment(unittest.TestCase):
     def test_validate(self):
         """ Test ability for Experiment to infer whether or not data corresponding
         to this experiment actual exist at the given path. """
-        pass
+        exp = make_sample_exp(validate_data=True)
+        report = exp.validate(fields=['temp', 'not_a_field'])
+        self.assertEqual(report.n_cases, 18)
+        self.assertEqual(report.missing_cases, [])
+        self.assertEqual(report.missing_files['temp'], [])
+        self.assertEqual(report.missing_files['not_a_field'],
+                         list(exp.all_cases()))
+        self.assertFalse(report.ok)
+
+        cases = sample_cases[:1] + [
+            Case("param2", "Parameter 2", [1, 2, 3, 4]),
+        ] + sample_cases[2:]
+        exp = make_sample_exp(cases=cases)
+        report = exp.validate()
+        self.assertEqual(len(report.missing_cases), 6)
+        self.assertTrue(all(case.param2 == 4
+                            for case in report.missing_cases))
+        with self.assertRaises(AssertionError):
+            make_sample_exp(cases=cases, validate_data=True)
+
+    def test_reserved_case_names(self):
+        for name in ['time', 'chunks', 'errors', 'max_open']:
+            with self.assertWarns(FutureWarning):
+                exp = make_exp(cases=[case_emis, Case(name, name, [1, 2])],
+                               case_path=None, output_prefix='',
+                               output_suffix='.nc')
+            # The case can still be selected
+            self.assertEqual(list(exp.subset(**{name: 2}).all_case_vals()),
+                             [case_emis.vals, [2, ]])
+
+        # Names which `load` doesn't take are fine
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            for name in ['layout', 'missing', 'q', 'field', 'data']:
+                make_exp(cases=[case_emis, Case(name, name, [1, 2])],
+                         case_path=None, output_prefix='', output_suffix='.nc')
 
     def test_exp_bits(self):
         """ Test if Experiment correctly provides the bits/kwargs corresponding
@@ -201,3 +307,1052 @@ class TestExperiment(unittest.TestCase):
 
         self.assertEqual(["/path/to/my/data/policy/no_clouds/experiment_policy_no_clouds.data.test.tape.nc"],
                          exp_all_str.get_file_fieldcases('test', **case_kws))
+
+    def test_file_lookup(self):
+        """ Single-file lookups resolve directly, respect sparse case
+        spaces, and follow changes to the naming scheme. """
+        exp = make_exp()
+        case_kws = dict(emis='policy', model_config='no_clouds')
+        path = "/path/to/my/data/policy/no_clouds/" \
+               "experiment_policy_no_clouds.data.TS.tape.nc"
+        self.assertEqual(exp.get_file_path('TS', **case_kws), path)
+        self.assertEqual(exp.get_file_fieldcases('TS', **case_kws), [path])
+        self.assertEqual(
+            exp.get_file_fieldcases('TS', emis='policy',
+                                    model_config='not_a_config'), []
+        )
+        self.assertEqual(exp.get_file_fieldcases('TS', emis='policy'), [])
+
+        exp.data_dir = '/new/path'
+        self.assertTrue(exp.get_file_path('TS', **case_kws).startswith(
+            '/new/path/policy/no_clouds/'
+        ))
+
+        sparse_exp = make_exp(valid_cases=[('policy', 'no_sun')])
+        self.assertEqual(sparse_exp.get_file_fieldcases('TS', **case_kws),
+                         [])
+
+    def test_compiled_templates(self):
+        """ Compiled templates render the same paths as formatting each
+        part by keyword. """
+        from experiment.template import compile_format
+        self.assertEqual(
+            compile_format("{b}_{a!s}/{{x}}{a:>4}{b[0]}", ['a', 'b']),
+            "{1}_{0!s}/{{x}}{0:>4}{1[0]}"
+        )
+        self.assertIsNone(compile_format("{c}", ['a', 'b']))
+
+        exp = make_exp(data_dir='/path/{with}/braces')
+        files = exp.get_files(['TS', 'PS'])
+        self.assertEqual(list(files.keys()), ['TS', 'PS'])
+        for field in files:
+            expected = []
+            for case_bits in exp.all_cases():
+                case_kws = exp.get_case_kws(*case_bits)
+                expected.append(os.path.join(
+                    '/path/{with}/braces', '{emis}/{model_config}'.format(**case_kws),
+                    'experiment_{emis}_{model_config}.data.'.format(**case_kws) +
+                    field + '.tape.nc'
+                ))
+            self.assertEqual(files[field], expected)
+            self.assertEqual([fn for _, fn in exp.walk_files(field)], expected)
+
+    def test_template_regex(self):
+        """ Templates compile to regexes which parse rendered paths back
+        into their values. """
+        from experiment.template import PathTemplate
+        template = PathTemplate("{a}_{b}/{a}.{b}.{c}.tape.nc",
+                                ['a', 'b', 'c'])
+        regex = template.to_regex()
+        path = template.render(('no_policy', 'x', 'alpha'))
+        self.assertEqual(regex.fullmatch(path).groupdict(),
+                         dict(a='no_policy', b='x', c='alpha'))
+        # Repeated names must match the same value
+        self.assertIsNone(regex.fullmatch("a_b/a.c.alpha.tape.nc"))
+
+        regex = template.to_regex({'b': r'\d+'})
+        self.assertIsNone(regex.fullmatch(path))
+        self.assertEqual(regex.fullmatch("a_1/a.1.c.tape.nc").group('b'), '1')
+
+        with self.assertRaises(ValueError):
+            PathTemplate("{a[0]}", ['a', ]).to_regex()
+        with self.assertRaises(ValueError):
+            PathTemplate(lambda a: a, ['a', ]).to_regex()
+
+    def test_discover(self):
+        discover_kws = dict(
+            case_path=sample_exp_kws['case_path'],
+            output_prefix=sample_exp_kws['output_prefix'],
+            output_suffix=sample_exp_kws['output_suffix'],
+        )
+        exp = Experiment.discover(SAMPLE_DATA_DIR,
+                                  ['param1', 'param2', 'param3'],
+                                  converters={'param2': int}, **discover_kws)
+        sample_exp = make_sample_exp()
+        self.assertEqual(exp.name, 'sample')
+        self.assertEqual(exp.all_case_vals(), sample_exp.all_case_vals())
+        self.assertFalse(exp.is_sparse)
+        self.assertEqual(list(exp.inventory), ['precip', 'pres', 'temp'])
+        self.assertEqual(exp.inventory['temp'],
+                         [exp.case_tuple(*c) for c in exp.all_cases()])
+        self.assertEqual(exp.get_files('temp'), sample_exp.get_files('temp'))
+
+        # Values given up front are kept in order, and others are dropped
+        exp = Experiment.discover(
+            SAMPLE_DATA_DIR, [Case('param1', 'Parameter 1', ['c', 'a']),
+                              'param2', 'param3'], **discover_kws
+        )
+        self.assertEqual(exp.all_case_vals()[:2],
+                         [['c', 'a'], ['1', '2', '3']])
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            data_dir = os.path.join(tmp_dir, 'sample')
+            shutil.copytree(SAMPLE_DATA_DIR, data_dir)
+            shutil.rmtree(os.path.join(data_dir, 'b_2'))
+            os.remove(os.path.join(data_dir, 'a_1', 'a.1.beta.pres.tape.nc'))
+            with open(os.path.join(data_dir, 'a_1', 'notes.txt'), 'w'):
+                pass
+            exp = Experiment.discover(data_dir, sample_exp.cases,
+                                      name='sparse',
+                                      converters={'param2': int},
+                                      **discover_kws)
+            self.assertTrue(exp.is_sparse)
+            self.assertEqual(len(list(exp.all_cases())), 16)
+            self.assertFalse(exp.has_case('b', 2, 'alpha'))
+            self.assertEqual(len(exp.inventory['temp']), 16)
+            self.assertNotIn(exp.case_tuple('a', 1, 'beta'),
+                             exp.inventory['pres'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        with self.assertRaises(ValueError):
+            Experiment.discover(SAMPLE_DATA_DIR, ['param1'],
+                                output_suffix='.grib')
+
+
+class TestLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.exp = make_sample_exp()
+
+    def test_load_single_case(self):
+        ds = self.exp.load('temp', param1='a', param2=1, param3='alpha')
+        self.assertIn('temp', ds)
+        self.assertEqual(ds['temp'].shape, (10, 5, 5))
+
+    def test_load_executor(self):
+        """ Loading concurrently should produce the same cases, in the same
+        order, as loading serially. """
+        serial = self.exp.load('temp')
+        for executor in ['threads', 'processes']:
+            concurrent = self.exp.load('temp', executor=executor,
+                                       max_workers=4)
+            self.assertEqual(list(serial.keys()), list(concurrent.keys()))
+            self.assertEqual(list(concurrent.keys()),
+                             list(self.exp.all_cases()))
+            for case in serial:
+                self.assertTrue(serial[case].identical(concurrent[case]))
+
+    def test_scan_metadata(self):
+        schemas = self.exp.scan_metadata('temp', max_workers=4)
+        self.assertEqual(list(schemas.keys()), list(self.exp.all_cases()))
+
+        schema = schemas[('a', 1, 'alpha')]
+        self.assertEqual(dict(schema.dims), {'time': 10, 'x': 5, 'y': 5})
+        temp = schema.variables['temp']
+        self.assertEqual(temp.dims, ('time', 'x', 'y'))
+        self.assertEqual(temp.shape, (10, 5, 5))
+        self.assertEqual(temp.dtype, np.dtype('f8'))
+        self.assertEqual((schema.time_start, schema.time_end), (0, 9))
+        self.assertTrue(schema.time_units.startswith('days since'))
+
+        # Headers are cached for unchanged files
+        self.assertIs(self.exp.scan_metadata('temp')[('a', 1, 'alpha')],
+                      schema)
+
+    def test_load_errors(self):
+        """ Every failed case should be reported together. """
+        data = self.exp.load('not_a_field', executor='threads')
+        self.assertEqual(len(data), 0)
+
+        with self.assertRaises(CaseLoadError) as cm:
+            self.exp.load('not_a_field', executor='threads', errors='raise')
+        self.assertEqual(len(cm.exception.failures), 18)
+
+    def test_partial_cases(self):
+        """ Partial case keywords load just the matching sub-grid. """
+        data = self.exp.load('temp', param1='a')
+        self.assertEqual(list(data.keys()),
+                         [c for c in self.exp.all_cases() if c[0] == 'a'])
+
+        with mock.patch.object(self.exp._datasets, 'open',
+                               wraps=self.exp._datasets.open) as opened:
+            master = self.exp.load('temp', master=True, param2=[3, 1],
+                                   param3='beta')
+        self.assertEqual(opened.call_count, 6)
+        self.assertEqual(master['temp'].shape, (3, 2, 1, 10, 5, 5))
+        self.assertEqual(list(master['param2'].values), [1, 3])
+        self.assertEqual(list(master['param3'].values), ['beta'])
+        full = self.exp.load('temp', master=True)
+        np.testing.assert_array_equal(
+            master['temp'].values,
+            full['temp'].sel(param2=[1, 3], param3=['beta']).values
+        )
+
+        # Building a master from data for every case
+        data = self.exp.load('temp')
+        master = self.exp.create_master('temp', data, param1=['b', 'c'])
+        self.assertEqual(master['temp'].shape[:3], (2, 3, 2))
+        self.assertNotIn('case_present', master.coords)
+
+        # A master covering just one case
+        master = self.exp.load('temp', master=True, param1='a', param2=1,
+                               param3=['alpha'])
+        self.assertEqual(master['temp'].shape, (1, 1, 1, 10, 5, 5))
+        np.testing.assert_array_equal(
+            master['temp'].values[0, 0, 0],
+            self.exp.load('temp', param1='a', param2=1,
+                          param3='alpha')['temp'].values
+        )
+
+        with self.assertRaises(ValueError):
+            self.exp.load('temp', param4='x')
+        with self.assertRaises(ValueError):
+            self.exp.load('temp', param1=['a', 'd'])
+
+    def test_subset(self):
+        sub = self.exp.subset(param1=['c', 'a'], param3='alpha')
+        self.assertEqual(sub.all_case_vals(),
+                         [['a', 'c'], [1, 2, 3], ['alpha']])
+        self.assertFalse(sub.has_case('b', 1, 'alpha'))
+        self.assertEqual(self.exp.all_case_vals()[0], ['a', 'b', 'c'])
+        self.assertEqual(sub.get_file_path('temp', param1='a', param2=1,
+                                           param3='alpha'),
+                         self.exp.get_file_path('temp', param1='a',
+                                                param2=1, param3='alpha'))
+
+        sparse = make_sample_exp(valid_cases=[('a', 1, 'alpha'),
+                                              ('b', 2, 'beta'),
+                                              ('a', 3, 'beta')])
+        sub = sparse.subset(param1='a')
+        self.assertEqual(list(sub.all_cases()),
+                         [('a', 1, 'alpha'), ('a', 3, 'beta')])
+        self.assertEqual(list(sparse.load('temp', param3='beta').keys()),
+                         [('a', 3, 'beta'), ('b', 2, 'beta')])
+        with self.assertRaises(ValueError):
+            sparse.subset(param1='c', param2=1)
+
+    def test_load_subset(self):
+        full = self.exp.load('temp', master=True)
+        master = self.exp.load('temp', master=True, chunks='auto',
+                               time=slice('2000-01-03', '2000-01-05'),
+                               sel=dict(x=slice(0, 5)), isel=dict(y=[0]))
+        self.assertEqual(master['temp'].shape, (3, 3, 2, 3, 3, 1))
+        self.assertEqual(master['temp'].data.chunksize[-3:], (3, 3, 1))
+        np.testing.assert_array_equal(
+            master['temp'].values,
+            full['temp'].isel(time=slice(2, 5), x=slice(0, 3),
+                              y=[0]).values
+        )
+
+        ds = self.exp.load('temp', time=slice('2000-01-09', None),
+                           param1='a', param2=1, param3='alpha')
+        self.assertEqual(ds['temp'].shape, (2, 5, 5))
+
+
+
+class TestReduce(unittest.TestCase):
+
+    def setUp(self):
+        self.exp = make_sample_exp()
+        self.master = self.exp.load('temp', master=True)
+
+    def _check(self, reduced, expected):
+        expected = expected.transpose(*reduced.dims)
+        np.testing.assert_allclose(reduced.values, expected.values)
+
+    def test_accumulators(self):
+        """ Merging partial summaries matches summarizing everything in
+        one go, NaNs included. """
+        from experiment.reduce import ACCUMULATORS
+        rs = np.random.RandomState(0)
+        values = rs.normal(size=(20, 4)) * 1e3 + 1e6
+        values[[1, 7], 0] = np.nan
+        values[:, 3] = np.nan
+        for how, acc_cls in ACCUMULATORS.items():
+            whole, part_a, part_b = [acc_cls(how) for _ in range(3)]
+            for i, row in enumerate(values):
+                whole.add(row)
+                (part_a if i % 3 else part_b).add(row)
+            part_a.merge(part_b)
+            np.testing.assert_allclose(whole.result(q=0.25),
+                                       part_a.result(q=0.25))
+
+        moments = ACCUMULATORS['var']('var')
+        for row in values:
+            moments.add(row)
+        np.testing.assert_allclose(moments.result(ddof=1)[:3],
+                                   np.nanvar(values[:, :3], axis=0, ddof=1))
+        self.assertTrue(np.isnan(moments.result()[3]))
+
+        # Small groups give exact quantiles
+        sketch = ACCUMULATORS['quantile']('quantile')
+        for row in values:
+            sketch.add(row)
+        np.testing.assert_allclose(
+            sketch.result(q=[0., 0.3, 1.])[:, :3],
+            np.nanquantile(values[:, :3], [0., 0.3, 1.], axis=0)
+        )
+        self.assertTrue(np.isnan(sketch.result()[3]))
+
+    def test_sketch(self):
+        """ Large groups stay within the sketch's size, with accurate
+        quantiles. """
+        from experiment.reduce import Sketch
+        rs = np.random.RandomState(1)
+        values = rs.normal(size=(2000, 3))
+        whole, part_a, part_b = [Sketch('quantile', size=50)
+                                 for _ in range(3)]
+        for i, row in enumerate(values):
+            whole.add(row)
+            (part_a if i % 2 else part_b).add(row)
+            self.assertLessEqual(len(whole.means), 50)
+        part_a.merge(part_b)
+
+        q = np.array([0., 0.01, 0.05, 0.5, 0.95, 0.99, 1.])
+        expected = np.quantile(values, q, axis=0)
+        for sketch in [whole, part_a]:
+            result = sketch.result(q=q)
+            np.testing.assert_allclose(result[[0, -1]], expected[[0, -1]])
+            # Compare the ranks of the estimates with the true ones
+            ranks = (values[:, np.newaxis] < result).mean(axis=0)
+            np.testing.assert_array_less(np.abs(ranks - q[:, np.newaxis]),
+                                         0.02)
+
+    def test_reduce(self):
+        over = ['param1', 'param3']
+        for how in ['mean', 'var', 'min', 'max', 'sum', 'count']:
+            reduced = self.exp.reduce('temp', over=over, how=how,
+                                      max_workers=4)
+            self.assertEqual(reduced['temp'].dims,
+                             ('param2', 'time', 'x', 'y'))
+            self._check(reduced['temp'], getattr(self.master, how)(over).temp)
+
+        reduced = self.exp.reduce('temp', over='param2', how='std', ddof=1,
+                                  executor='processes', max_workers=2)
+        self._check(reduced['temp'],
+                    self.master['temp'].std('param2', ddof=1))
+
+        reduced = self.exp.reduce('temp', over=['param2', 'param3'],
+                                  how='quantile', q=[0.1, 0.5])
+        self.assertEqual(reduced['temp'].dims[:2], ('quantile', 'param1'))
+        self._check(reduced['temp'], self.master['temp'].quantile(
+            [0.1, 0.5], dim=['param2', 'param3']
+        ))
+
+    def test_reduce_subset(self):
+        reduced = self.exp.reduce('temp', over='param1', param2=[1, 3],
+                                  time=slice('2000-01-01', '2000-01-02'))
+        self.assertEqual(reduced['temp'].shape, (2, 2, 2, 5, 5))
+        self._check(reduced['temp'], self.master['temp'].isel(
+            time=slice(0, 2)
+        ).sel(param2=[1, 3]).mean('param1'))
+
+        # Groups without any cases are left empty
+        sparse = make_sample_exp(valid_cases=[('a', 1, 'alpha'),
+                                              ('b', 1, 'alpha'),
+                                              ('a', 2, 'beta')])
+        reduced = sparse.reduce('temp', over='param1', how='count')
+        self.assertEqual(reduced['temp'].shape[:2], (3, 2))
+        self.assertEqual(
+            reduced['temp'].isel(time=0, x=0, y=0).values.tolist(),
+            [[2, 0], [0, 1], [0, 0]]
+        )
+
+    def test_reduce_errors(self):
+        with self.assertRaises(ValueError):
+            self.exp.reduce('temp', over='param4')
+        with self.assertRaises(ValueError):
+            self.exp.reduce('temp', over='param1', how='median')
+        with self.assertRaises(ValueError):
+            self.exp.reduce('temp', over='param1', how='quantile')
+        with self.assertRaises(CaseLoadError):
+            self.exp.reduce('not_a_field', over='param1', errors='raise')
+
+
+class TestDatasetPool(unittest.TestCase):
+
+    def _count_opens(self):
+        return mock.patch('experiment.loading.load_variable',
+                          wraps=experiment.loading.load_variable)
+
+    def test_reuse(self):
+        """ Repeated loads re-use the datasets which are already open. """
+        exp = make_sample_exp(max_open_files=32)
+        with self._count_opens() as loader:
+            first = exp.load('temp')
+            second = exp.load('temp')
+            self.assertEqual(loader.call_count, 18)
+            # Changing the options opens the files again
+            exp.load('temp', fix_times=True)
+            self.assertEqual(loader.call_count, 36)
+        for case in first:
+            self.assertIsNot(first[case], second[case])
+            self.assertTrue(first[case].identical(second[case]))
+
+        exp.close()
+        self.assertEqual(len(exp._datasets), 0)
+        # Data loaded before closing is still usable
+        self.assertEqual(second[('a', 1, 'alpha')]['temp'].values.shape,
+                         (10, 5, 5))
+
+    def test_max_open(self):
+        with make_sample_exp(max_open_files=4) as exp:
+            with self._count_opens() as loader:
+                exp.load('temp')
+                exp.load('temp')
+                self.assertEqual(loader.call_count, 36)
+            self.assertEqual(len(exp._datasets), 4)
+        self.assertEqual(len(exp._datasets), 0)
+
+    def test_var_context(self):
+        exp = make_sample_exp()
+        with Var('temp') as var:
+            exp.load(var, master=True)
+            self.assertEqual(len(var.data), 18)
+        self.assertFalse(var._loaded)
+        self.assertIsNone(var.master)
+
+
+def _anomaly(ds, **case_kws):
+    return ds - ds.mean('time')
+
+
+def _make_scaler(factor):
+    def _scale(ds, **case_kws):
+        return ds * factor
+    return _scale
+
+
+class _Scaler(object):
+    def __init__(self, factor):
+        self.factor = factor
+
+    def scale(self, ds, **case_kws):
+        return ds * self.factor
+
+
+class TestLoadCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.tmp_dir, 'sample')
+        shutil.copytree(SAMPLE_DATA_DIR, self.data_dir)
+        self.exp = make_sample_exp(data_dir=self.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _count_loads(self, exp):
+        return mock.patch.object(exp._datasets, 'open',
+                                 wraps=exp._datasets.open)
+
+    def test_function_token(self):
+        from experiment.memo import function_token
+
+        def _anomaly(ds, **case_kws):
+            return ds - ds.mean('time')
+        self.assertNotEqual(function_token(_anomaly),
+                            function_token(_make_scaler(2.)))
+        self.assertEqual(function_token(_make_scaler(2.)),
+                         function_token(_make_scaler(2.)))
+        self.assertNotEqual(function_token(_make_scaler(2.)),
+                            function_token(_make_scaler(3.)))
+
+        # Bound methods depend on the instance they're bound to
+        self.assertEqual(function_token(_Scaler(1).scale),
+                         function_token(_Scaler(1).scale))
+        self.assertNotEqual(function_token(_Scaler(1).scale),
+                            function_token(_Scaler(1000).scale))
+
+        # Editing a helper changes the token of anything which calls it
+        namespace = {}
+        exec(dedent("""
+            def _helper(ds):
+                return ds + 1
+
+            def _preprocess(ds, **case_kws):
+                return _helper(ds)
+        """), namespace)
+        token = function_token(namespace['_preprocess'])
+        exec("def _helper(ds): return ds + 2", namespace)
+        self.assertNotEqual(function_token(namespace['_preprocess']), token)
+        exec("def _helper(ds): return ds + 1", namespace)
+        self.assertEqual(function_token(namespace['_preprocess']), token)
+
+    def test_memory_cache(self):
+        cache = self.exp.enable_load_cache("1MB")
+        with self._count_loads(self.exp) as loader:
+            first = self.exp.load('temp', preprocess=_anomaly)
+            second = self.exp.load('temp', preprocess=_anomaly)
+            self.assertEqual(loader.call_count, 18)
+            self.assertEqual(len(cache), 18)
+            for case in first:
+                self.assertTrue(first[case].identical(second[case]))
+
+            # A different preprocess function misses
+            self.exp.load('temp', preprocess=_make_scaler(2.))
+            self.assertEqual(loader.call_count, 36)
+
+            # As does a modified file
+            path = self.exp.get_file_path('temp', param1='a', param2=1,
+                                          param3='alpha')
+            os.utime(path, (0, 0))
+            self.exp.load('temp', preprocess=_anomaly)
+            self.assertEqual(loader.call_count, 37)
+
+        # Least-recently used cases are evicted to stay under the limit
+        self.exp.enable_load_cache(first[('a', 1, 'alpha')].nbytes * 4)
+        self.exp.load('temp')
+        self.assertEqual(len(self.exp.load_cache), 4)
+
+    def test_disk_cache(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.exp.enable_load_cache(cache_dir=cache_dir)
+        first = self.exp.load('temp', preprocess=_anomaly)
+        self.assertEqual(len(os.listdir(cache_dir)), 18)
+
+        # A new session picks the cached cases up from disk
+        exp = make_sample_exp(data_dir=self.data_dir)
+        exp.enable_load_cache(cache_dir=cache_dir)
+        with self._count_loads(exp) as loader:
+            second = exp.load('temp', preprocess=_anomaly)
+            self.assertEqual(loader.call_count, 0)
+        for case in first:
+            self.assertTrue(first[case].identical(second[case]))
+
+
+class TestIterLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.exp = make_sample_exp()
+        self.loaded = []
+
+    def _preprocess(self, ds, **case_kws):
+        self.loaded.append(self.exp.case_tuple(**case_kws))
+        return ds
+
+    def test_iter_load(self):
+        data = self.exp.load('temp')
+        cases = []
+        for case, ds in self.exp.iter_load('temp'):
+            self.assertTrue(ds.identical(data[case]))
+            cases.append(case)
+        self.assertEqual(cases, list(self.exp.all_cases()))
+
+    def test_bounded_prefetch(self):
+        """ Only a few cases are opened ahead of the one being consumed,
+        and each is closed once the next is requested. """
+        closed = []
+        close = experiment.loading._close
+        with mock.patch('experiment.loading._close',
+                        side_effect=lambda ds: closed.append(ds) or close(ds)):
+            it = self.exp.iter_load('temp', preprocess=self._preprocess,
+                                    prefetch=2)
+            for i, (case, ds) in enumerate(it):
+                self.assertLessEqual(len(self.loaded), i + 3)
+                self.assertEqual(len(closed), i)
+                if i == 4:
+                    break
+            it.close()
+        # Everything that was opened, including what was prefetched, has
+        # been closed again
+        self.assertEqual(len(closed), len(self.loaded))
+
+    def test_iter_load_errors(self):
+        self.assertEqual(list(self.exp.iter_load('not_a_field')), [])
+        with self.assertRaises(CaseLoadError):
+            next(self.exp.iter_load('not_a_field', errors='raise'))
+
+
+class TestAsyncLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.exp = make_sample_exp()
+        self.lock = threading.Lock()
+        self.n_open = self.max_open = self.n_loaded = 0
+
+    def _preprocess(self, ds, **case_kws):
+        """ Slow pre-processing, which keeps track of how many cases are
+        open at once. """
+        time.sleep(0.01)
+        with self.lock:
+            self.n_loaded += 1
+            self.n_open += 1
+            self.max_open = max(self.n_open, self.max_open)
+        return ds
+
+    def _close(self, ds):
+        with self.lock:
+            self.n_open -= 1
+        ds.close()
+
+    def test_aload(self):
+        async def _load():
+            ticks = []
+
+            async def _tick():
+                while True:
+                    ticks.append(None)
+                    await asyncio.sleep(0)
+            ticker = asyncio.ensure_future(_tick())
+            data = await self.exp.aload('temp', preprocess=self._preprocess,
+                                        max_open=4)
+            ticker.cancel()
+            return data, ticks
+
+        data, ticks = asyncio.run(_load())
+        # The event loop kept running while the cases were loading
+        self.assertGreater(len(ticks), 18)
+        expected = self.exp.load('temp')
+        self.assertEqual(list(data.keys()), list(expected.keys()))
+        for case in data:
+            self.assertTrue(data[case].identical(expected[case]))
+
+        single = asyncio.run(self.exp.aload('temp', param1='a', param2=1,
+                                            param3='alpha'))
+        self.assertTrue(single.identical(expected[('a', 1, 'alpha')]))
+
+        # Partial selections go through the same concurrent path
+        master = asyncio.run(self.exp.aload('temp', master=True,
+                                            param1='a', param2=[1, 3]))
+        self.assertTrue(master.identical(
+            self.exp.load('temp', master=True, param1='a', param2=[1, 3])
+        ))
+        self.assertEqual(dict(master['temp'].sizes),
+                         {'param1': 1, 'param2': 2, 'param3': 2,
+                          'time': 10, 'x': 5, 'y': 5})
+        with self.assertRaises(CaseLoadError):
+            asyncio.run(self.exp.aload('not_a_field', errors='raise',
+                                       param1='a'))
+
+    def test_aiter_load(self):
+        async def _iter():
+            cases = []
+            async for case, ds in self.exp.aiter_load(
+                    'temp', preprocess=self._preprocess, max_open=3,
+                    max_workers=8):
+                cases.append(case)
+                await asyncio.sleep(0.01)
+            return cases
+
+        with mock.patch('experiment.aio._close', side_effect=self._close):
+            cases = asyncio.run(_iter())
+        self.assertEqual(sorted(cases), sorted(self.exp.all_cases()))
+        self.assertLessEqual(self.max_open, 3)
+        self.assertEqual(self.n_open, 0)
+
+    def test_aiter_load_stop_early(self):
+        """ Cases still loading when iteration stops are closed once they
+        finish. """
+        async def _iter():
+            cases = self.exp.aiter_load('temp', preprocess=self._preprocess,
+                                        max_open=4, max_workers=4)
+            async for case, ds in cases:
+                break
+            await cases.aclose()
+            # Give the in-flight loads time to finish
+            await asyncio.sleep(0.2)
+
+        with mock.patch('experiment.aio._close', side_effect=self._close):
+            asyncio.run(_iter())
+        self.assertGreater(self.n_loaded, 1)
+        self.assertEqual(self.n_open, 0)
+
+    def test_aiter_load_errors(self):
+        async def _iter(**kwargs):
+            return [case async for case, _ in
+                    self.exp.aiter_load('not_a_field', **kwargs)]
+
+        self.assertEqual(asyncio.run(_iter()), [])
+        with self.assertRaises(CaseLoadError):
+            asyncio.run(_iter(errors='raise'))
+
+
+@unittest.skipIf(zarr is None, "requires zarr")
+class TestMasterStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = os.path.join(self.tmp_dir, 'temp.zarr')
+        self.exp = make_sample_exp()
+        self.expected = self.exp.load('temp', master=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_master(self):
+        written = self.exp.write_master('temp', self.store)
+        self.assertNotIn('case_written', written.coords)
+        self.assertEqual(written.temp.dims, self.expected.temp.dims)
+        self.assertEqual(written.temp.data.chunksize[:3], (1, 1, 1))
+        np.testing.assert_allclose(written.temp.values,
+                                   self.expected.temp.values)
+
+        reopened = self.exp.open_master(self.store)
+        np.testing.assert_allclose(reopened.temp.values,
+                                   self.expected.temp.values)
+
+    def test_stacked(self):
+        written = self.exp.write_master('temp', self.store, layout='stacked')
+        expected = self.expected.stack(case=list(self.exp.cases)) \
+            .transpose('case', ...)
+        self.assertEqual(written.indexes['case'].names,
+                         list(self.exp.cases))
+        np.testing.assert_allclose(written.temp.values,
+                                   expected.temp.values)
+
+    def test_resume(self):
+        self.exp.write_master('temp', self.store)
+
+        # Simulate an interrupted write of the first case
+        group = zarr.open_group(self.store)
+        group['case_written'][0, 0, 0] = False
+        group['temp'][0, 0, 0] = np.nan
+        partial = self.exp.open_master(self.store)
+        self.assertEqual(int(partial.case_written.sum()),
+                         len(list(self.exp.all_cases())) - 1)
+        self.assertTrue(np.isnan(partial.temp[0, 0, 0]).all())
+
+        writes = []
+        write_case = experiment.store._write_case
+
+        def _counted(exp, field, case, *args):
+            writes.append(case)
+            return write_case(exp, field, case, *args)
+
+        with mock.patch('experiment.store._write_case', _counted):
+            written = self.exp.write_master('temp', self.store)
+        self.assertEqual(writes, [self.exp.case_tuple('a', 1, 'alpha')])
+        np.testing.assert_allclose(written.temp.values,
+                                   self.expected.temp.values)
+
+        with self.assertRaises(ValueError):
+            self.exp.write_master('temp', self.store, layout='stacked')
+
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.tmp_dir, 'sample')
+        shutil.copytree(SAMPLE_DATA_DIR, self.data_dir)
+        self.exp = make_sample_exp(data_dir=self.data_dir)
+        self.catalog_path = os.path.join(self.tmp_dir, 'catalog.db')
+
+    def tearDown(self):
+        if self.exp.catalog is not None:
+            self.exp.catalog.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_build_and_refresh(self):
+        catalog = self.exp.build_catalog(self.catalog_path, fields=['temp'])
+        self.assertEqual(len(catalog), 18)
+
+        path = self.exp.get_file_path('temp', param1='a', param2=1,
+                                      param3='alpha')
+        record = catalog.lookup(path)
+        self.assertEqual(record.case, ('a', 1, 'alpha'))
+        self.assertIn('temp', record.variables)
+        self.assertEqual(record.dims, {'time': 10, 'x': 5, 'y': 5})
+
+        # Only changed or removed files are touched on refresh
+        self.assertEqual(catalog.refresh(self.exp, 'temp'), (0, 0))
+        os.utime(path, (0, 0))
+        os.remove(self.exp.get_file_path('temp', param1='c', param2=3,
+                                         param3='beta'))
+        self.assertEqual(catalog.refresh(self.exp, 'temp'), (1, 1))
+        self.assertEqual(len(catalog), 17)
+
+    def test_upgrade(self):
+        """ Catalogs written before calendars were recorded are re-read on
+        their next refresh. """
+        self.exp.build_catalog(self.catalog_path, fields=['temp'])
+        self.exp.catalog.close()
+        conn = sqlite3.connect(self.catalog_path)
+        with conn:
+            conn.execute("ALTER TABLE files DROP COLUMN time_calendar")
+        conn.close()
+
+        self.exp.catalog = Catalog(self.catalog_path)
+        self.assertEqual(self.exp.catalog.refresh(self.exp, 'temp'), (18, 0))
+        record = self.exp.catalog.records('temp')[0]
+        self.assertIsNotNone(record.time_calendar)
+
+    def test_load_from_catalog(self):
+        self.exp.build_catalog(self.catalog_path, fields=['temp'])
+        self.exp.catalog.close()
+        self.exp.catalog = None
+
+        yaml_path = os.path.join(self.tmp_dir, 'sample.yaml')
+        self.exp.to_yaml(yaml_path)
+        exp = Experiment.from_yaml(yaml_path, catalog=self.catalog_path)
+        try:
+            self.assertEqual(len(exp.load('temp')), 18)
+            # Fields which weren't catalogued are found on disk
+            self.assertEqual(len(exp.load('pres')), 18)
+        finally:
+            exp.catalog.close()
+
+class TestSegmentedLoad(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """ Write a small timeseries archive with one file per year for each
+        field and case. """
+        cls.data_dir = tempfile.mkdtemp()
+        cls.exp = Experiment(
+            'segmented', [case_emis, ], timeseries=True,
+            data_dir=cls.data_dir, case_path='{emis}', output_prefix='',
+            output_suffix='_{emis}_{start}_{end}.nc', validate_data=False
+        )
+        for emis in case_emis.vals:
+            path = os.path.join(cls.data_dir, emis)
+            os.makedirs(path)
+            for year in [1990, 1991, 1992]:
+                times = pd.date_range(str(year), periods=12, freq='MS')
+                ds = xr.Dataset(
+                    {'TS': (('time', 'x'), np.full((12, 3), year, 'f8'))},
+                    coords={'time': times, 'x': np.arange(3)}
+                )
+                fn = 'TS_{}_{}_{}.nc'.format(emis, year, year)
+                ds.to_netcdf(os.path.join(path, fn))
+            # Neither of these is a segment of TS
+            open(os.path.join(path, 'TS_{}_notes.nc'.format(emis)),
+                 'w').close()
+            open(os.path.join(path, 'PS_{}_1990_1990.nc'.format(emis)),
+                 'w').close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir)
+
+    def test_parse_date(self):
+        from experiment.segments import parse_date, time_window
+        self.assertEqual(parse_date('1986'), (1986, 1, 1))
+        self.assertEqual(parse_date('1986', end=True), (1986, 12, 31))
+        self.assertEqual(parse_date('19860301'), (1986, 3, 1))
+        self.assertEqual(parse_date('1986-03', end=True), (1986, 3, 31))
+        self.assertEqual(time_window(slice('1990-06', None)),
+                         ((1990, 6, 1), None))
+        self.assertEqual(time_window((1990, pd.Timestamp('1991-02-03'))),
+                         ((1990, 1, 1), (1991, 2, 3)))
+        with self.assertRaises(ValueError):
+            parse_date('90')
+
+    def test_segment_files(self):
+        self.assertTrue(self.exp.segmented)
+        self.assertFalse(make_sample_exp().segmented)
+        self.assertEqual(self.exp.case_suffix(emis='policy'),
+                         '_policy_*_*.nc')
+
+        files = self.exp.get_segment_files('TS', emis='policy')
+        self.assertEqual([os.path.basename(f) for f in files],
+                         ['TS_policy_1990_1990.nc', 'TS_policy_1991_1991.nc',
+                          'TS_policy_1992_1992.nc'])
+        self.assertEqual(
+            self.exp.get_segment_files('TS', time=slice('1991', None),
+                                       emis='policy'), files[1:]
+        )
+        self.assertEqual(
+            self.exp.get_segment_files('TS', time=('1990-06', '1991-01'),
+                                       emis='policy'), files[:2]
+        )
+        self.assertEqual(
+            self.exp.get_segment_files('TS', time=slice(None, '1989'),
+                                       emis='policy'), []
+        )
+
+    def test_archive_files(self):
+        files = dict((case_kws['emis'], paths) for case_kws, paths in
+                     self.exp.walk_files('TS'))
+        self.assertEqual(files['policy'],
+                         self.exp.get_segment_files('TS', emis='policy'))
+        self.assertEqual(self.exp.get_files('TS')['TS'],
+                         [files[emis] for emis in case_emis.vals])
+        with self.assertRaises(ValueError):
+            self.exp.get_file_path('TS', emis='policy')
+
+        report = self.exp.validate(fields=['TS', 'PS', 'not_a_field'])
+        self.assertEqual(report.missing_files['TS'], [])
+        self.assertEqual(report.missing_files['PS'], [])
+        self.assertEqual(len(report.missing_files['not_a_field']), 3)
+
+        schemas = self.exp.scan_metadata('TS')
+        self.assertEqual(len(schemas), 3)
+        for case_schemas in schemas.values():
+            self.assertEqual(len(case_schemas), 3)
+            self.assertEqual(case_schemas[0].dims['time'], 12)
+
+    def test_catalog(self):
+        exp = copy(self.exp)
+        catalog_path = os.path.join(self.data_dir, 'catalog.db')
+        try:
+            catalog = exp.build_catalog(catalog_path, fields='TS')
+            self.assertEqual(len(catalog), 9)
+            self.assertEqual(catalog.refresh(exp, 'TS'), (0, 0))
+            self.assertEqual(
+                exp.get_segment_files('TS', time=slice('1991', None),
+                                      emis='policy'),
+                self.exp.get_segment_files('TS', time=slice('1991', None),
+                                           emis='policy')
+            )
+            master = exp.load('TS', master=True)
+            self.assertEqual(master['TS'].shape, (3, 36, 3))
+            # Fields which weren't catalogued are found on disk
+            self.assertEqual(
+                exp.get_segment_files('PS', emis='policy'),
+                [os.path.join(self.data_dir, 'policy',
+                              'PS_policy_1990_1990.nc')]
+            )
+        finally:
+            catalog.close()
+            os.remove(catalog_path)
+
+    def test_load(self):
+        ds = self.exp.load('TS', emis='policy')
+        self.assertEqual(ds['TS'].shape, (36, 3))
+        self.assertEqual(sorted(set(ds['TS'].values[:, 0])),
+                         [1990, 1991, 1992])
+
+        with mock.patch('experiment.io.xr.open_mfdataset',
+                        wraps=xr.open_mfdataset) as open_mfdataset:
+            master = self.exp.load('TS', master=True,
+                                   time=slice('1991', '1992'))
+        for call in open_mfdataset.call_args_list:
+            self.assertEqual(len(call[0][0]), 2)
+        self.assertEqual(master['TS'].shape, (3, 24, 3))
+        self.assertEqual(sorted(set(master['TS'].values.ravel())),
+                         [1991, 1992])
+
+        # The data are trimmed to exactly the window
+        ds = self.exp.load('TS', time=('1990-06', '1991-01'),
+                           emis='no_policy')
+        self.assertEqual(ds['TS'].shape, (8, 3))
+        self.assertEqual(list(ds['TS'].values[[0, -1], 0]), [1990, 1991])
+
+    def test_iter_and_async_load(self):
+        """ The iterative and async loaders subset the data just like
+        `load`. """
+        window = dict(time=slice('1991', '1992'), isel=dict(x=[0, 2]))
+        with mock.patch('experiment.io.xr.open_mfdataset',
+                        wraps=xr.open_mfdataset) as open_mfdataset:
+            for case, ds in self.exp.iter_load('TS', **window):
+                self.assertEqual(ds['TS'].shape, (24, 2))
+        self.assertEqual(open_mfdataset.call_count, 3)
+        for call in open_mfdataset.call_args_list:
+            self.assertEqual(len(call[0][0]), 2)
+
+        data = asyncio.run(self.exp.aload('TS', **window))
+        self.assertEqual(len(data), 3)
+        for ds in data.values():
+            self.assertEqual(ds['TS'].shape, (24, 2))
+        ds = asyncio.run(self.exp.aload('TS', emis='policy', **window))
+        self.assertEqual(ds['TS'].shape, (24, 2))
+
+        async def _shapes():
+            return [ds['TS'].shape async for _, ds in
+                    self.exp.aiter_load('TS', sel=dict(x=1),
+                                        time=('1992', '1992'))]
+        self.assertEqual(asyncio.run(_shapes()), [(12, )] * 3)
+
+
+class TestLoadTimeslice(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """ Write a small timeslice archive: one file per month and case,
+        each holding every field. """
+        cls.data_dir = tempfile.mkdtemp()
+        cls.exp = Experiment(
+            'timeslice', [case_emis, case_model_config], timeseries=False,
+            data_dir=cls.data_dir, case_path='{emis}/{model_config}',
+            output_prefix='{emis}.{model_config}.h0.', output_suffix='.nc',
+            validate_data=False
+        )
+        times = pd.date_range('2000-01-01', periods=4, freq='MS')
+        for case_path, case_kws in cls.exp._walk_cases(with_kws=True):
+            path = os.path.join(cls.data_dir, case_path)
+            os.makedirs(path)
+            prefix = cls.exp.case_prefix(**case_kws)
+            for i, t in enumerate(times):
+                ds = xr.Dataset(
+                    {'TS': (('time', 'x'), np.full((1, 3), i, dtype='f8')),
+                     'PS': (('time', 'x'), np.ones((1, 3)))},
+                    coords={'time': [t], 'x': np.arange(3)}
+                )
+                fn = prefix + t.strftime('%Y-%m') + '.nc'
+                ds.to_netcdf(os.path.join(path, fn))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir)
+
+    def test_timeslice_files(self):
+        files = self.exp.get_timeslice_files(emis='policy',
+                                             model_config='no_sun')
+        self.assertEqual(len(files), 4)
+        self.assertEqual(files, sorted(files))
+
+    def test_load_timeslice(self):
+        ds = self.exp.load('TS', emis='policy', model_config='no_sun')
+        self.assertNotIn('PS', ds)
+        self.assertEqual(ds['TS'].shape, (4, 3))
+        self.assertEqual(list(ds['TS'].values[:, 0]), [0, 1, 2, 3])
+
+        data = self.exp.load('TS', executor='threads')
+        self.assertEqual(list(data.keys()), list(self.exp.all_cases()))
+
+    def test_load_time_window(self):
+        """ Only the timeslices in the window of time are opened. """
+        window = slice('2000-02', '2000-03')
+        with mock.patch('experiment.io.xr.open_mfdataset',
+                        wraps=xr.open_mfdataset) as open_mfdataset:
+            ds = self.exp.load('TS', emis='policy', model_config='no_sun',
+                               time=window)
+            master = self.exp.load('TS', master=True, time=window)
+        for call in open_mfdataset.call_args_list:
+            self.assertEqual(len(call[0][0]), 2)
+        self.assertEqual(list(ds['TS'].values[:, 0]), [1, 2])
+        self.assertEqual(master['TS'].shape, (3, 3, 2, 3))
+
+    def test_catalog(self):
+        exp = copy(self.exp)
+        catalog_path = os.path.join(self.data_dir, 'catalog.db')
+        try:
+            catalog = exp.build_catalog(catalog_path)
+            self.assertEqual(len(catalog), 36)
+            self.assertEqual(exp.get_timeslice_files(emis='policy',
+                                                     model_config='no_sun'),
+                             self.exp.get_timeslice_files(
+                                 emis='policy', model_config='no_sun'))
+            # Refreshing an attached catalog still scans the archive
+            self.assertEqual(catalog.refresh(exp), (0, 0))
+            self.assertEqual(len(catalog), 36)
+
+            data = exp.load('TS')
+            self.assertEqual(len(data), 9)
+            self.assertEqual(list(data[('policy', 'no_sun')]['TS']
+                                  .values[:, 0]), [0, 1, 2, 3])
+
+            # Timeslices outside a window of time are skipped using the
+            # times in the catalog, without reading their headers
+            with mock.patch('experiment.loading.load_metadata') as read:
+                data = exp.load('TS', time=('2000-04', None))
+            self.assertFalse(read.called)
+            self.assertEqual(list(data[('policy', 'no_sun')]['TS']
+                                  .values[:, 0]), [3])
+        finally:
+            catalog.close()
+            os.remove(catalog_path)
@@ -0,0 +1,345 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import dask.array as da
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from experiment.chunking import resolve_chunks
+from experiment.io import (load_timeslice, load_variable,
+                           _rebase_time_units)
+
+
+class TestLoadVariable(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """ Write a raw, multi-field history file. """
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.tmp_dir, 'history.nc')
+        times = pd.date_range('2000-01-01', periods=4, freq='D')
+        ds = xr.Dataset(
+            {'TS': (('time', 'x'), np.arange(12.).reshape(4, 3),
+                    {'coordinates': 'area'}),
+             'PS': (('time', 'x'), np.ones((4, 3))),
+             'PRECT': (('time', 'y'), np.zeros((4, 2))),
+             'time_bnds': (('time', 'nbnd'), np.zeros((4, 2))),
+             'area': (('x', ), np.ones(3))},
+            coords={'time': times, 'x': np.arange(3), 'y': np.arange(2)}
+        )
+        ds['time'].attrs['bounds'] = 'time_bnds'
+        ds['time'].encoding['units'] = 'days since 2000-01-01'
+        ds.to_netcdf(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_load_all(self):
+        ds = load_variable('TS', self.path)
+        for name in ['TS', 'PS', 'PRECT', 'y']:
+            self.assertIn(name, ds.variables)
+
+    def test_squeeze(self):
+        """ Only the field, its dims, coordinates and bounds are kept. """
+        ds = load_variable('TS', self.path, squeeze=True)
+        self.assertEqual(set(ds.variables),
+                         {'TS', 'time', 'x', 'area', 'time_bnds'})
+        self.assertEqual(ds['TS'].shape, (4, 3))
+
+    def test_variables(self):
+        ds = load_variable('TS', self.path, variables=['PRECT'])
+        self.assertIn('PRECT', ds)
+        self.assertIn('y', ds.variables)
+        self.assertNotIn('PS', ds)
+
+        ds = load_variable('TS', self.path, squeeze=True,
+                           drop_variables=['area'])
+        self.assertNotIn('area', ds.variables)
+
+        with self.assertRaises(KeyError):
+            load_variable('TS', self.path, variables=['not_a_field'])
+
+
+class TestDecodeCF(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """ Write a file with packed, partially-missing data and times on a
+        non-standard calendar. """
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.tmp_dir, 'packed.nc')
+        packed = np.arange(24, dtype='i2').reshape(8, 3)
+        packed[0, 0] = -999
+        time_attrs = {'units': 'days since 0001-01-01', 'calendar': 'noleap'}
+        ds = xr.Dataset(
+            {'TS': (('time', 'x'), packed,
+                    {'scale_factor': 0.5, 'add_offset': 100.,
+                     'missing_value': np.int16(-999)})},
+            coords={'time': ('time', np.arange(8.), time_attrs),
+                    'x': np.arange(3)}
+        )
+        ds.to_netcdf(cls.path, engine='netcdf4')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def _count_reads(self):
+        """ Patch the netCDF4 backend to record each variable read. """
+        from xarray.backends.netCDF4_ import NetCDF4ArrayWrapper
+        reads = []
+        getitem = NetCDF4ArrayWrapper._getitem
+
+        def _getitem(wrapper, key):
+            reads.append(wrapper.variable_name)
+            return getitem(wrapper, key)
+        return reads, mock.patch.object(NetCDF4ArrayWrapper, '_getitem',
+                                        _getitem)
+
+    def test_raw(self):
+        ds = load_variable('TS', self.path)
+        self.assertEqual(ds['TS'].dtype, np.dtype('i2'))
+        self.assertEqual(ds['time'].dtype, np.dtype('f8'))
+
+    def test_decode(self):
+        ds = load_variable('TS', self.path, decode_cf=True)
+        self.assertEqual(ds['TS'].dtype, np.dtype('f8'))
+        self.assertTrue(np.isnan(ds['TS'].values[0, 0]))
+        self.assertEqual(ds['TS'].values[0, 1], 100.5)
+        self.assertEqual(ds['time'].values[1].calendar, 'noleap')
+
+    def test_decode_is_lazy(self):
+        """ Decoding shouldn't read any of the field's data until it's
+        computed, chunk-by-chunk. """
+        reads, patch = self._count_reads()
+        with patch:
+            ds = load_variable('TS', self.path, decode_cf=True,
+                               engine='netcdf4', chunks={'time': 4})
+            self.assertNotIn('TS', reads)
+            self.assertIsInstance(ds['TS'].data, da.Array)
+            self.assertEqual(ds['TS'].chunks, ((4, 4), (3, )))
+
+            first = ds['TS'].isel(time=slice(0, 4)).values
+            self.assertEqual(reads.count('TS'), 1)
+        self.assertTrue(np.isnan(first[0, 0]))
+        self.assertEqual(first[1, 0], 101.5)
+
+        reads, patch = self._count_reads()
+        with patch:
+            ds = load_variable('TS', self.path, decode_cf=True,
+                               engine='netcdf4')
+            self.assertNotIn('TS', reads)
+
+
+class TestFixTimes(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """ Write monthly-mean files as CESM does, each record stamped with
+        the end of its averaging interval, on a no-leap calendar. """
+        cls.tmp_dir = tempfile.mkdtemp()
+        month_ends = np.cumsum([31, 28, 31, 30, 31, 30])
+        lower = np.concatenate([[0], month_ends[:-1]]).astype('f8')
+        upper = month_ends.astype('f8')
+        time_attrs = {'units': 'days since 0001-01-01 00:00:00',
+                      'calendar': 'noleap', 'bounds': 'time_bnds'}
+        cls.paths = []
+        for i in range(2):
+            sl = slice(3 * i, 3 * (i + 1))
+            ds = xr.Dataset(
+                {'TS': (('time', 'x'), np.ones((3, 2))),
+                 'time_bnds': (('time', 'nbnd'),
+                               np.stack([lower[sl], upper[sl]], axis=1))},
+                coords={'time': ('time', upper[sl], time_attrs),
+                        'x': np.arange(2)}
+            )
+            path = os.path.join(cls.tmp_dir, 'h0.{}.nc'.format(i))
+            ds.to_netcdf(path)
+            cls.paths.append(path)
+        cls.midpoints = (lower + upper) / 2.
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_no_fix(self):
+        # Times are only fixed on request
+        for kws in [{}, dict(fix_times=False)]:
+            ds = load_variable('TS', self.paths[0], **kws)
+            self.assertEqual(list(ds['time'].values), [31, 59, 90])
+            self.assertEqual(ds['time'].attrs['units'],
+                             'days since 0001-01-01 00:00:00')
+        ds = load_timeslice('TS', self.paths)
+        self.assertEqual(list(ds['time'].values), [31, 59, 90, 120, 151, 181])
+
+    def test_fix_times(self):
+        ds = load_variable('TS', self.paths[0], fix_times=True)
+        np.testing.assert_array_equal(ds['time'].values, self.midpoints[:3])
+        self.assertEqual(ds['time'].attrs['units'],
+                         'days since 2001-01-01 00:00:00')
+        self.assertEqual(ds['time_bnds'].attrs.get('units', None), None)
+
+        ds = load_variable('TS', self.paths[0], fix_times=True,
+                           decode_cf=True)
+        stamps = ds['time'].values
+        self.assertEqual(stamps[0].calendar, 'noleap')
+        self.assertEqual([(t.year, t.month, t.day) for t in stamps],
+                         [(2001, 1, 16), (2001, 2, 15), (2001, 3, 16)])
+
+    def test_fix_times_lazy(self):
+        """ Dask-backed bounds spanning several files are handled in one
+        go, and the data itself stays lazy. """
+        ds = load_timeslice('TS', self.paths, fix_times=True, chunks={})
+        np.testing.assert_array_equal(ds['time'].values, self.midpoints)
+        self.assertIsInstance(ds['TS'].data, da.Array)
+
+    def test_rebase_units(self):
+        self.assertEqual(_rebase_time_units('days since 0850-01-01'),
+                         'days since 2001-01-01')
+        self.assertEqual(_rebase_time_units('hours since 1-1-1 0:0:0'),
+                         'hours since 2001-1-1 0:0:0')
+        for units in ['days since 1850-01-01', 'seconds',
+                      'days since yesterday']:
+            self.assertEqual(_rebase_time_units(units), units)
+
+
+class TestChunks(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """ Write a file chunked on disk one record at a time. """
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.tmp_dir, 'chunked.nc')
+        ds = xr.Dataset(
+            {'TS': (('time', 'lat', 'lon'), np.ones((100, 16, 32), 'f4'))},
+            coords={'time': np.arange(100.)}
+        )
+        ds.to_netcdf(cls.path, engine='netcdf4', encoding={
+            'TS': {'chunksizes': (1, 16, 32)}
+        })
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_resolve(self):
+        dims, shape, dtype = ('time', 'lat', 'lon'), (100, 16, 32), 'f4'
+        # 2KiB records, so 25 records per 50KiB chunk
+        self.assertEqual(
+            list(resolve_chunks('50KiB', dims, shape, dtype, (1, 16, 32))
+                 .values()), [25, 16, 32]
+        )
+        # Multiples of the on-disk chunks along each dimension
+        self.assertEqual(
+            list(resolve_chunks('4KiB', dims, shape, dtype, (10, 4, 8))
+                 .values()), [10, 4, 8]
+        )
+        self.assertEqual(
+            list(resolve_chunks({'time': 'auto', 'lat': 8}, dims, shape,
+                                dtype, (1, 16, 32)).values()),
+            [100, 8, 32]
+        )
+        with self.assertRaises(ValueError):
+            resolve_chunks({'lev': 1}, dims, shape, dtype)
+
+    def test_load_policy(self):
+        ds = load_variable('TS', self.path, chunks='50KiB')
+        self.assertEqual(ds['TS'].chunks, ((25, 25, 25, 25), (16, ), (32, )))
+
+        ds = load_variable('TS', self.path, chunks={'time': 10})
+        self.assertEqual(ds['TS'].chunks[0], (10, ) * 10)
+
+    def test_timeslice_policy(self):
+        """ Snapshots from separate files are merged into larger chunks. """
+        paths = []
+        for i in range(4):
+            path = os.path.join(self.tmp_dir, 'slice.{}.nc'.format(i))
+            ds = xr.Dataset({'TS': (('time', 'x'), np.ones((1, 8)))},
+                            coords={'time': [float(i)]})
+            ds.to_netcdf(path)
+            paths.append(path)
+        ds = load_timeslice('TS', paths, fix_times=False, chunks='auto')
+        self.assertEqual(ds['TS'].chunks, ((4, ), (8, )))
+
+
+class TestSubset(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """ Write a year of daily data, chunked on disk by month. """
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.tmp_dir, 'daily.nc')
+        times = pd.date_range('2000-01-01', periods=366, freq='D')
+        ds = xr.Dataset(
+            {'TS': (('time', 'lat', 'lon'),
+                    np.arange(366.)[:, None, None] * np.ones((1, 4, 8)))},
+            coords={'time': times, 'lat': np.linspace(-45, 45, 4),
+                    'lon': np.arange(0, 360, 45.)}
+        )
+        ds['time'].encoding['units'] = 'days since 2000-01-01'
+        ds.to_netcdf(cls.path, engine='netcdf4', encoding={
+            'TS': {'chunksizes': (31, 4, 8)}
+        })
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_time_window(self):
+        ds = load_variable('TS', self.path, fix_times=False,
+                           time=slice('2000-02', '2000-03'))
+        # Only the time coordinate was decoded to find the window
+        self.assertEqual(ds['time'].dtype.kind, 'i')
+        self.assertEqual(ds.sizes['time'], 29 + 31)
+        self.assertEqual(ds['TS'].values[0, 0, 0], 31)
+
+        decoded = load_variable('TS', self.path, fix_times=False,
+                                decode_cf=True, time=(2000, '2000-01-10'))
+        self.assertEqual(decoded.sizes['time'], 10)
+        self.assertEqual(decoded.indexes['time'][-1],
+                         pd.Timestamp('2000-01-10'))
+
+    def test_isel_sel(self):
+        ds = load_variable('TS', self.path, fix_times=False,
+                           isel={'time': slice(0, 5)},
+                           sel={'lat': slice(0, None), 'lon': [90, 180]})
+        self.assertEqual(ds['TS'].shape, (5, 2, 2))
+
+    def test_chunked_after_subset(self):
+        ds = load_variable('TS', self.path, fix_times=False, chunks='auto',
+                           time=slice('2000-06', '2000-06'))
+        self.assertEqual(ds['TS'].chunks, ((30, ), (4, ), (8, )))
+        ds = load_variable('TS', self.path, fix_times=False,
+                           chunks={'time': 10}, isel={'time': slice(0, 25)})
+        self.assertEqual(ds['TS'].chunks[0], (10, 10, 5))
+
+    def test_timeslice_units(self):
+        """ Files counting time from different dates are concatenated in
+        order, and can be subset. """
+        paths = []
+        for year in [2001, 2002]:
+            path = os.path.join(self.tmp_dir, 'year.{}.nc'.format(year))
+            ds = xr.Dataset(
+                {'TS': (('time', ), np.full(12, float(year)))},
+                coords={'time': pd.date_range(str(year), periods=12,
+                                              freq='MS')}
+            )
+            ds['time'].encoding['units'] = 'days since {}-01-01'.format(year)
+            ds.to_netcdf(path)
+            paths.append(path)
+        ds = load_timeslice('TS', paths, fix_times=False)
+        self.assertEqual(ds['time'].attrs['units'], 'days since 2001-01-01')
+        self.assertTrue((np.diff(ds['time'].values) > 0).all())
+
+        ds = load_timeslice('TS', paths, fix_times=False,
+                            time=slice('2001-12', '2002-01'))
+        self.assertEqual(list(ds['TS'].values), [2001, 2002])
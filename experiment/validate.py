@@ -0,0 +1,155 @@
+"""
+Batched validation of an Experiment's archive against its case layout.
+
+Rather than stat-ing every expected case directory (and file) one at a
+time, each parent directory in the archive is listed exactly once with
+`os.scandir`, and the expected paths are checked against those in-memory
+listings. Directory listings are run concurrently, which helps a great
+deal on networked or parallel filesystems.
+
+Archives which split each case's output across several files (see
+`Experiment.segmented`) can't be checked against a single expected name, so
+for those each case's files are globbed instead - still concurrently.
+
+"""
+import os
+
+from collections import OrderedDict, namedtuple
+from functools import partial
+
+from . import logger
+from . parallel import get_executor
+
+#: Hack for Py2/3 basestring type compatibility
+if 'basestring' not in globals():
+    basestring = str
+
+
+class ValidationReport(namedtuple('ValidationReport',
+                                  ['n_cases', 'missing_cases',
+                                   'missing_files'])):
+    """ Summary of the cases (and files) missing from an archive.
+
+    Attributes
+    ----------
+    n_cases : int
+        The number of cases which were checked
+    missing_cases : list of case tuples
+        Cases whose directory couldn't be found
+    missing_files : OrderedDict
+        Mapping of each field checked to the list of case tuples for
+        which its file couldn't be found
+    """
+
+    @property
+    def ok(self):
+        """ True if nothing was missing. """
+        return not (self.missing_cases or
+                    any(self.missing_files.values()))
+
+    def __str__(self):
+        lines = ["Checked {} case(s)".format(self.n_cases)]
+        if self.missing_cases:
+            lines.append("   missing {} case director(ies): {}".format(
+                len(self.missing_cases),
+                ", ".join(repr(tuple(c)) for c in self.missing_cases)
+            ))
+        for field, cases in self.missing_files.items():
+            if cases:
+                lines.append("   missing {} file(s) for {}: {}".format(
+                    len(cases), field,
+                    ", ".join(repr(tuple(c)) for c in cases)
+                ))
+        return "\n".join(lines)
+
+
+def _list_dir(path):
+    """ Return the set of entry names in a directory, or None if it
+    can't be listed. """
+    try:
+        it = os.scandir(path)
+    except OSError:
+        return None
+    with it:
+        return set(entry.name for entry in it)
+
+
+def validate_experiment(exp, fields=None, max_workers=8):
+    """ Check which of an Experiment's cases (and, optionally, which of
+    their files) are present in its archive.
+
+    Parameters
+    ----------
+    exp : Experiment
+        The Experiment to validate
+    fields : str or list of str (optional)
+        Field names whose timeseries files should be checked for every
+        case, in addition to the case directories
+    max_workers : int
+        Maximum number of directories to list concurrently
+
+    Returns
+    -------
+    ValidationReport
+
+    """
+    all_cases = [exp.case_tuple(*case) for case in exp.all_cases()]
+    if fields is None:
+        fields = []
+    elif isinstance(fields, basestring):
+        fields = [fields, ]
+
+    # Split every expected path into its parent directory and entry name
+    case_dirs = exp._templates().case_path.render_many(all_cases)
+    case_dirs = [os.path.split(os.path.abspath(
+                     os.path.join(exp.data_dir, path)))
+                 for path in case_dirs]
+    segmented = exp.segmented
+    field_files = OrderedDict(
+        (field, [os.path.split(os.path.abspath(path))
+                 for path in exp._render_files(field, all_cases)])
+        for field in ([] if segmented else fields)
+    )
+
+    parents = set(parent for parent, _ in case_dirs)
+    for split_paths in field_files.values():
+        parents.update(parent for parent, _ in split_paths)
+
+    # List every parent directory exactly once
+    logger.debug("Validating directory - listing {} directories".format(
+        len(parents)
+    ))
+    pool, owned = get_executor("threads", max_workers)
+    try:
+        parents = list(parents)
+        listings = dict(zip(parents, pool.map(_list_dir, parents)))
+        segments = OrderedDict()
+        if segmented:
+            # A case's file is present if it has any segments at all
+            for field in fields:
+                segments[field] = list(pool.map(
+                    partial(exp._glob_segment_files, field), all_cases
+                ))
+    finally:
+        if owned:
+            pool.shutdown()
+
+    def _exists(parent, name):
+        listing = listings[parent]
+        return (listing is not None) and (name in listing)
+
+    missing_cases = [case for case, (parent, name) in zip(all_cases, case_dirs)
+                     if not _exists(parent, name)]
+    missing_files = OrderedDict()
+    for field, case_segments in segments.items():
+        missing_files[field] = [
+            case for case, paths in zip(all_cases, case_segments)
+            if not paths
+        ]
+    for field, split_paths in field_files.items():
+        missing_files[field] = [
+            case for case, (parent, name) in zip(all_cases, split_paths)
+            if not _exists(parent, name)
+        ]
+
+    return ValidationReport(len(all_cases), missing_cases, missing_files)
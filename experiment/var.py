@@ -50,7 +50,6 @@ class Var(object):
 
     """
     # TODO: Extend `Mapping` interface so that one doesn't need to use the `data` property to access data
-    # TODO: Implement `__enter__` and `__exit__` such that data is loaded and deleted from the `Var` instance
     # TODO: Logging of actions on `Var` instance for writing to new file history after analysis.
     # TODO:Change `oldvar` to automatically populate a 1-element list if not other values passed
 
@@ -220,6 +219,23 @@ class Var(object):
     def __hash__(self):
         return hash( self._get_atts() )
 
+    def close(self):
+        """ Close any datasets loaded into this Var, and discard them. """
+        datasets = []
+        if self._data is not None:
+            datasets.extend(self._data.values())
+        if getattr(self, 'master', None) is not None:
+            datasets.append(self.master)
+            self.master = None
+        for ds in datasets:
+            close = getattr(ds, 'close', None)
+            if close is not None:
+                close()
+
+        self._data = None
+        self._cases = None
+        self._loaded = False
+
     def __enter__(self):
         return self
 
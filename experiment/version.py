@@ -0,0 +1,2 @@
+
+__version__ = '0.0.1.dev-e2b11cb'
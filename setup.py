@@ -35,10 +35,9 @@ CLASSIFIERS = [
     'Operating System :: OS Independent',
     'Intended Audience :: Science/Research',
     'Programming Language :: Python',
-    'Programming Language :: Python :: 2',
-    'Programming Language :: Python :: 2.7',
     'Programming Language :: Python :: 3',
-    'Programming Language :: Python :: 3.5',
+    'Programming Language :: Python :: 3 :: Only',
+    'Programming Language :: Python :: 3.9',
     'Topic :: Scientific/Engineering',
 
 ]
@@ -97,17 +96,21 @@ setup(
     version = VERSION,
     download_url = DOWNLOAD_URL,
 
+    python_requires = '>=3.9',
     packages = find_packages(),
     package_data = {},
 
     classifiers = CLASSIFIERS, install_requires=['version',
                                                  'numpy',
-                                                 'xarray',
-                                                 'dask',
+                                                 'xarray>=2023.8',
+                                                 'dask>=2023.8',
                                                  'h5py',
                                                  'netcdf4',
                                                  'numpy',
                                                  'pyyaml',
                                                  'pytest',
-                                                 'tqdm']
+                                                 'tqdm'],
+    extras_require = {
+        'zarr': ['zarr'],
+    },
 )